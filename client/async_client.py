@@ -0,0 +1,318 @@
+'''An asyncio client, for downloading many files at once.
+Run with
+"python async_client.py <address> <port number> <file name>... [options]"
+
+Options:
+    --concurrency N  files downloaded at the same time
+    --timeout S      seconds allowed for each file
+
+Speaks the same FileRequest/FileResponse exchange as client.py,
+but on asyncio.open_connection(), so hundreds of files can be in
+flight from one process.  At most concurrency files are fetched
+at once, each over a kept-alive connection from a small pool,
+and each file must arrive within its own timeout.  The payload is
+written to disk as it arrives, never held in memory.
+
+Can be imported and used as a library:
+
+    async with AsyncFileClient("localhost", 5000, concurrency=64) as c:
+        results = await c.fetch_many(paths)
+
+Results and errors are the FetchResult and FetchError types
+from client.py.
+'''
+
+from records import FileRequest, FileResponse, STATUS_OK, STATUS_OVERLOADED, \
+    FLAG_KEEP_ALIVE
+from client import FetchResult, FetchError, FileNotOnServerError, \
+    ServerOverloadedError, TransferError, ConnectionClosedError, \
+    _add_directory_for, print_recieved_message
+import asyncio
+import socket
+from common import *
+import sys
+import os
+import time
+
+CONCURRENCY = 32        # Files fetched at the same time
+FILE_TIMEOUT = 60.0     # Seconds allowed for each file
+READ_SIZE = 65536       # Most bytes read from the stream at once
+
+
+class AsyncFileClient(object):
+    """Fetches files from one server with asyncio.  Can be used
+    as an async context manager, which closes the idle
+    connections."""
+    
+    def __init__(self, address_str, port_num, concurrency=CONCURRENCY,
+                 timeout=FILE_TIMEOUT, keep_alive=True):
+        self.server = (address_str, port_num)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self._idle = []    # (reader, writer, time it was returned)
+    
+    
+    async def __aenter__(self):
+        return self
+    
+    
+    async def __aexit__(self, *exc_info):
+        await self.close()
+    
+    
+    async def close(self):
+        """Closes every idle connection."""
+        idle, self._idle = self._idle, []
+        for _, writer, _ in idle:
+            writer.close()
+        for _, writer, _ in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+    
+    
+    async def fetch(self, path, dest=None, overwrite=False):
+        """Fetches path from the server and writes it to dest
+        (default path) within the client's timeout.  Returns a
+        FetchResult.  Raises FileNotOnServerError,
+        ServerOverloadedError, TransferError or FetchError."""
+        try:
+            return await asyncio.wait_for(
+                self._fetch(path, dest, overwrite), self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise TransferError(TIMOUT_ERR)
+    
+    
+    async def fetch_many(self, paths, dests=None, overwrite=False):
+        """Fetches each of paths (to the matching dests, default
+        the same paths), at most concurrency at once.  Returns a
+        list of FetchResults in the same order as paths; a fetch
+        that failed has status None and its FetchError in error."""
+        if dests is None:
+            dests = paths
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def fetch_one(path, dest):
+            async with semaphore:
+                start_time = time.monotonic()
+                try:
+                    return await self.fetch(path, dest, overwrite)
+                except FetchError as err:
+                    return FetchResult(
+                        path, dest, None, err.num_bytes,
+                        time.monotonic() - start_time, err
+                    )
+        
+        return await asyncio.gather(*(
+            fetch_one(path, dest) for path, dest in zip(paths, dests)
+        ))
+    
+    
+    async def _connect(self):
+        """Returns (reader, writer) for a new connection to the
+        server.  Raises FetchError if it can't connect."""
+        try:
+            return await asyncio.open_connection(*self.server)
+        except socket.gaierror:
+            raise FetchError(CANT_CONVERT_ADRESS_ERR)
+        except OSError:
+            raise TransferError(COULDNT_CONNECT_ERR)
+    
+    
+    async def _get_connection(self):
+        """Returns (reader, writer, reused), taking the most recently
+        used idle connection if there is one."""
+        while self._idle:
+            reader, writer, returned_at = self._idle.pop()
+            if time.monotonic() - returned_at < KEEPALIVE_TIMEOUT / 2:
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._connect()
+        return reader, writer, False
+    
+    
+    async def _fetch(self, path, dest, overwrite):
+        """fetch() without the timeout."""
+        if dest is None:
+            dest = path
+        if not overwrite and file_exists_locally(dest):
+            raise FetchError(
+                FILE_ALREADY_EXISTS_ERR.format(os.path.basename(dest))
+            )
+        
+        start_time = time.monotonic()
+        reader, writer, reused = await self._get_connection()
+        try:
+            try:
+                status, num_bytes = await self._request(
+                    path, dest, reader, writer
+                )
+            except ConnectionClosedError:
+                # The server may have closed an idle pooled connection
+                if not reused:
+                    raise
+                writer.close()
+                reader, writer = await self._connect()
+                status, num_bytes = await self._request(
+                    path, dest, reader, writer
+                )
+        except BaseException:
+            writer.close()
+            raise
+        
+        # The response was read in full, so the connection can be reused
+        if self.keep_alive and len(self._idle) < self.concurrency:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        
+        if status == STATUS_OVERLOADED:
+            raise ServerOverloadedError(SERVER_OVERLOADED_ERR, num_bytes)
+        elif status != STATUS_OK:
+            raise FileNotOnServerError(FILE_NOT_ON_SERVER_ERR, num_bytes)
+        
+        return FetchResult(
+            path, dest, status, num_bytes, time.monotonic() - start_time, None
+        )
+    
+    
+    async def _request(self, path, dest, reader, writer):
+        """Sends a FileRequest for path and recieves the
+        FileResponse, writing any file to dest.  Returns
+        (StatusCode, total bytes recieved)."""
+        flags = FLAG_KEEP_ALIVE if self.keep_alive else 0
+        file_request = FileRequest(path, flags)
+        
+        # Send FileRequest
+        try:
+            writer.write(file_request.get_bytearray())
+            await writer.drain()
+        except OSError:
+            raise ConnectionClosedError(COULDNT_SEND_ERR)
+        
+        # Recieve the header
+        try:
+            header = await reader.readexactly(FileResponse.header_byte_len())
+        except asyncio.IncompleteReadError as err:
+            if not err.partial:
+                raise ConnectionClosedError(CONNECTION_LOST_ERR)
+            raise TransferError(INVALID_FILE_RESPONSE_ERR, len(err.partial))
+        except OSError:
+            raise ConnectionClosedError(CONNECTION_LOST_ERR)
+        header = FileResponse.header_to_host_byte_ord(header)
+        
+        # Check header validity
+        if not FileResponse.is_valid_header(header):
+            raise FetchError(INVALID_FILE_RESPONSE_ERR)
+        status, DataLen = FileResponse.get_status_DataLen(header)
+        
+        # Is there a file following the header?
+        n_bytes = 0
+        if status == STATUS_OK:
+            n_bytes = await download_file_from_stream(dest, reader, DataLen)
+        
+        return status, len(header) + n_bytes
+
+
+async def download_file_from_stream(file_name, reader, file_size):
+    """Asyncio version of client.download_file_from_socket().
+    Writes exactly file_size bytes from reader to file_name as
+    they arrive.  Raises TransferError if the connection closes
+    early or fails (the partial file is removed, also if the 
+    download is cancelled), or FetchError if the file can't be 
+    written."""
+    outfile = None
+    downloaded_bytes = 0
+    try:
+        # Make sure there is a directory to put the file in
+        _add_directory_for(file_name)
+        
+        outfile = open(file_name, 'wb')
+        
+        while downloaded_bytes < file_size:
+            try:
+                data_block = await reader.read(
+                    min(READ_SIZE, file_size - downloaded_bytes)
+                )
+            except OSError:
+                raise TransferError(CONNECTION_LOST_ERR, downloaded_bytes)
+            
+            # Has the connection closed before the whole file?
+            if len(data_block) == 0:
+                raise TransferError(TRUNCATED_FILE_ERR.format(
+                    downloaded_bytes, file_size
+                ), downloaded_bytes)
+            
+            outfile.write(data_block)
+            downloaded_bytes += len(data_block)
+    
+    except TransferError:
+        raise
+    except IOError:
+        raise FetchError(COULDNT_WRITE_FILE_ERR, downloaded_bytes)
+    finally:
+        if outfile is not None:
+            outfile.close()
+        if downloaded_bytes < file_size and os.path.exists(file_name):
+            os.remove(file_name)
+    
+    return downloaded_bytes
+
+
+def get_address_portno_filenames():
+    """Gets the address, port number and file names from the
+    command line (skipping --options and their values).
+    Returns tuple: (address_str, port_num, file_names)"""
+    args = []
+    skip_next = False
+    for arg in sys.argv[1:]:
+        if skip_next:
+            skip_next = False
+        elif arg.startswith("--"):
+            skip_next = True
+        else:
+            args.append(arg.strip())
+    
+    if len(args) < 3:
+        error(MISSING_ARG_ERR)
+    
+    return args[0], convert_portno_str(args[1]), args[2:]
+
+
+async def fetch_all(address_str, port_num, file_names):
+    """Fetches file_names, printing a message for each.  Returns
+    True if every file was recieved."""
+    async with AsyncFileClient(
+        address_str, port_num,
+        get_option("--concurrency", CONCURRENCY, int),
+        get_option("--timeout", FILE_TIMEOUT, float)
+    ) as client:
+        results = await client.fetch_many(file_names)
+    
+    all_received = True
+    for result in results:
+        if isinstance(result.error, FileNotOnServerError):
+            print_recieved_message(result.path, result.num_bytes, False)
+        elif result.error is not None:
+            error(str(result.error), exit_all=False)
+        else:
+            print_recieved_message(result.path, result.num_bytes)
+        all_received = all_received and result.error is None
+    
+    return all_received
+
+
+def main():
+    """Main function to run the asyncio client.  Needs to be
+    run from the command line.  See Module docstring."""
+    address_str, port_num, file_names = get_address_portno_filenames()
+    
+    if not asyncio.run(fetch_all(address_str, port_num, file_names)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
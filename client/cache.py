@@ -0,0 +1,254 @@
+"""A local cache of downloaded files, which any number of
+clients (threads or processes) can share by using the same
+directory.
+
+Each cached file is kept in DIRECTORY/objects, named by a hash
+of the server and path it was fetched from, along with its
+validator: the size and mtime the server gave for it.  A
+FileClient with a cache sends FLAG_VALIDATE and the validator
+of its cached copy with each request, and if the server
+replies STATUS_NOT_MODIFIED the file is taken from the cache
+rather than transfered again.
+
+The cache holds at most max_bytes of files.  When storing a
+file would go over, the least recently used files are evicted.
+A file bigger than max_bytes is never cached.
+
+The index, DIRECTORY/index.json, records the server, path,
+size, mtime and last use of each file.  It is only read and
+rewritten while holding an flock() on DIRECTORY/index.lock,
+and cached files are replaced atomically, so CI jobs running
+side by side can share one cache.
+
+Files are copied into and out of the cache, or with link=True
+hard linked, which is faster and takes no extra space, but
+means a fetched file must never be changed in place.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+CACHE_BYTES = 1024**3    # Default byte budget of a cache
+
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+OBJECTS_DIR = "objects"
+
+
+# The validator of a cached file, as sent with FLAG_VALIDATE
+CacheEntry = namedtuple("CacheEntry", "size mtime")
+
+
+class FileCache(object):
+    """A directory of cached files with a byte budget and least
+    recently used eviction.  Thread and process safe."""
+    
+    def __init__(self, directory, max_bytes=CACHE_BYTES, link=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.link = link
+        # flock() doesn't exclude other threads of this process
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, OBJECTS_DIR), exist_ok=True)
+    
+    
+    @staticmethod
+    def key(server, path):
+        """Returns the name a file from server and path is cached
+        under."""
+        return hashlib.sha256(
+            "{}\0{}".format(server, path).encode("UTF-8")
+        ).hexdigest()
+    
+    
+    def lookup(self, server, path):
+        """Returns the CacheEntry of the cached copy of path from
+        server, or None if there isn't one."""
+        key = self.key(server, path)
+        with self._locked_index() as index:
+            record = index.get(key)
+            if record is None:
+                return None
+            
+            # Drop an entry whose file has gone or been changed
+            try:
+                if os.path.getsize(self._object_path(key)) == \
+                   record["size"]:
+                    return CacheEntry(record["size"], record["mtime"])
+            except OSError:
+                pass
+            self._remove(index, key)
+            return None
+    
+    
+    def copy_out(self, server, path, entry, dest):
+        """Writes the cached copy of path from server to dest, if
+        it still has the validator entry.  Returns False if it
+        has been evicted or replaced since lookup()."""
+        if entry is None:
+            return False
+        
+        key = self.key(server, path)
+        with self._locked_index() as index:
+            record = index.get(key)
+            if record is None or \
+               (record["size"], record["mtime"]) != tuple(entry):
+                return False
+            record["used"] = time.time()
+        
+        # Another client may evict it meanwhile, but never change it
+        try:
+            _add_directory_for(dest)
+            _copy_or_link(self._object_path(key), dest, self.link)
+        except OSError:
+            return False
+        return True
+    
+    
+    def store(self, server, path, file_name, mtime):
+        """Caches file_name as the copy of path from server with
+        the server's mtime, then evicts least recently used files
+        until the cache is within max_bytes.  A file that can't
+        be cached is skipped."""
+        key = self.key(server, path)
+        object_path = self._object_path(key)
+        try:
+            size = os.path.getsize(file_name)
+            if size > self.max_bytes:
+                return
+            
+            # Copy outside the lock, then swap it in atomically
+            temp_path = "{}.{}.{}".format(
+                object_path, os.getpid(), threading.get_ident()
+            )
+            _copy_or_link(file_name, temp_path, self.link)
+        except OSError:
+            return
+        
+        try:
+            with self._locked_index() as index:
+                os.replace(temp_path, object_path)
+                index[key] = {
+                    "server": server, "path": path, "size": size,
+                    "mtime": mtime, "used": time.time(),
+                }
+                self._evict(index, key)
+        except OSError:
+            _remove_file(temp_path)
+    
+    
+    def forget(self, server, path):
+        """Removes any cached copy of path from server."""
+        with self._locked_index() as index:
+            self._remove(index, self.key(server, path))
+    
+    
+    def total_bytes(self):
+        """Returns the number of bytes of files cached."""
+        with self._locked_index() as index:
+            return sum(record["size"] for record in index.values())
+    
+    
+    def _object_path(self, key):
+        """Returns the path a file cached under key is kept at."""
+        return os.path.join(self.directory, OBJECTS_DIR, key)
+    
+    
+    @contextmanager
+    def _locked_index(self):
+        """Locks the index against other threads and processes,
+        and yields it as a dict.  The index is written back
+        unless an exception is raised."""
+        with self._lock:
+            lock_file = open(os.path.join(self.directory, LOCK_FILE), "a")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                lock_file.close()    # Also releases the flock()
+    
+    
+    def _read_index(self):
+        """Returns the index, or an empty one if it is missing or
+        unreadable."""
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+    
+    
+    def _write_index(self, index):
+        """Replaces the index file with index."""
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        temp_path = "{}.{}".format(index_path, os.getpid())
+        with open(temp_path, "w") as outfile:
+            json.dump(index, outfile)
+        os.replace(temp_path, index_path)
+    
+    
+    def _remove(self, index, key):
+        """Removes key from index and deletes its file."""
+        index.pop(key, None)
+        _remove_file(self._object_path(key))
+    
+    
+    def _evict(self, index, keep):
+        """Removes the least recently used files, other than
+        keep, until the cache is within max_bytes."""
+        total = sum(record["size"] for record in index.values())
+        for key in sorted(index, key=lambda key: index[key]["used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]["size"]
+            self._remove(index, key)
+
+
+def _add_directory_for(file_name):
+    """Creates the directory file_name is in, if it is missing."""
+    base_dir = os.path.dirname(file_name)
+    if base_dir:
+        os.makedirs(base_dir, exist_ok=True)
+
+
+def _copy_or_link(src, dest, link):
+    """Replaces dest with a hard link to src if link is True
+    (and the link can be made), else with a copy of src."""
+    temp_path = "{}.{}.{}.tmp".format(
+        dest, os.getpid(), threading.get_ident()
+    )
+    try:
+        if link:
+            try:
+                os.link(src, temp_path)
+            except OSError:
+                shutil.copyfile(src, temp_path)
+        else:
+            shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dest)
+    except OSError:
+        _remove_file(temp_path)
+        raise
+
+
+def _remove_file(file_name):
+    """Deletes file_name if it exists."""
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
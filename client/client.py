@@ -1,22 +1,142 @@
 '''This contains the main function for the client.
 Run with "python client.py <address> <port number> <file name>"
+or, for a server on the same host listening with --unix PATH,
+"python client.py unix:PATH <file name>"
+
+Options:
+    --cache DIR         keep downloaded files in a cache at DIR
+    --cache-size N      bytes the cache may hold (see cache.py)
+    --tune-buffers 0|1  grow the recieve buffer to the bandwidth-delay
+                        product (see transport.py)
+    --max-buffer N      largest recieve buffer to grow to
 
 Runs a client that sends a FileRequest to a server.  The client then 
+recieves a FileResponse and writes the file (if the server has it)
+to the same relative path locally.
+
+The client can also be imported and used as a library:
+
+    with FileClient("localhost", 5000) as client:
+        result = client.fetch("some/file.txt", "local/copy.txt")
+        results = client.fetch_many(["a.txt", "b.txt", "c.txt"])
+
+A FileClient keeps a ConnectionPool of warm connections to its
+server (requests are sent with FLAG_KEEP_ALIVE), and reports
+problems by raising FetchError rather than exiting.
+
+Over a "unix:PATH" address the client sets FLAG_PASS_FD, so the
+server passes the open file rather than sending its bytes, and
+the file is copied locally (see copy_file_from_fd()); as a
+reflink where the filesystem supports it.
+
+A FileClient given a FileCache (see cache.py) sends
+FLAG_VALIDATE with the size and mtime of its cached copy of a
+file, and takes the file from the cache when the server replies
+STATUS_NOT_MODIFIED.
 
+FileClient.list_files() lists the files on the server (from its
+file index) a page of ListResponse at a time, optionally only
+those under a prefix or matching a glob:
+
+    with FileClient("localhost", 5000) as client:
+        paths = [entry.path for entry in client.list_files("logs/")]
+        results = client.fetch_many(paths)
+
+Requests are sent with FLAG_CHECKSUM, and the CRC32 trailer the
+server sends after the file is checked against the bytes as they
+are written.  A file that doesn't match is removed and fetched
+again, up to CHECKSUM_RETRIES times.
 '''
 
-from records import FileRequest, FileResponse, BLOCK_SIZE
+from records import FileRequest, FileResponse, ListRequest, ListResponse, \
+    BLOCK_SIZE, STATUS_OK, STATUS_OVERLOADED, STATUS_FD_PASSED, \
+    STATUS_NOT_MODIFIED, FILE_RESPONSE_TYPE, FILE_RESPONSE_EXT_TYPE, \
+    CHECKSUM_LEN, MAX_LIST_ENTRIES, ENCODING_TYPE, FLAG_KEEP_ALIVE, \
+    FLAG_PASS_FD, FLAG_VALIDATE, FLAG_CHECKSUM, FLAG_GLOB
+from cache import FileCache, CACHE_BYTES
+from transport import TransportPolicy
 import socket
 from common import *
 import sys
 import os
+import time
+import threading
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+POOL_SIZE = 4    # Idle connections kept per server, and fetch_many threads
+COPY_SIZE = 2**30       # Most bytes copied between files in one call
+FICLONE = 0x40049409    # Linux ioctl to share another file's blocks
+CHECKSUM_RETRIES = 2    # Refetches of a file that fails its checksum
+
+
+# The outcome of one fetch.  status is the FileResponse StatusCode,
+# num_bytes counts header + file bytes recieved, elapsed is in
+# seconds, and error is None or the FetchError (from fetch_many()).
+FetchResult = namedtuple(
+    "FetchResult", "path dest status num_bytes elapsed error"
+)
+
+
+# A recieved FileResponse header.  num_bytes is the length of the
+# header, mtime and file_size are None unless it was extended, and
+# fd is the file descriptor passed with it, if any.
+ResponseHeader = namedtuple(
+    "ResponseHeader", "status data_len num_bytes mtime file_size fd"
+)
+
+
+# A file listed by the server.  size is in bytes and mtime in
+# seconds, as in an extended FileResponse.
+ListEntry = namedtuple("ListEntry", "path size mtime")
+
+
+class FetchError(Exception):
+    """Raised when a file couldn't be fetched.  The message is
+    one of the *_ERR strings in common.py."""
+    def __init__(self, message, num_bytes=0):
+        super().__init__(message)
+        self.num_bytes = num_bytes
+
+
+class FileNotOnServerError(FetchError):
+    """Raised when the server doesn't have the requested file."""
+
+
+class ServerOverloadedError(FetchError):
+    """Raised when the server refuses the request because it is
+    overloaded.  Back off, or retry against another server."""
+
+
+class TransferError(FetchError):
+    """Raised when the connection fails, times out or closes
+    part way through a transfer."""
+
+
+class ConnectionClosedError(TransferError):
+    """Raised when the connection is closed or reset before the
+    FileResponse arrives."""
+
+
+class ChecksumError(TransferError):
+    """Raised when a file arrives in full but doesn't match the
+    CRC32 trailer the server sent with it."""
 
 
 def get_address_portno_filename():
     """Gets the address, port number and file name from the 
-    command line.  Returns tuple: (address_str, port_num, file_name)"""
+    command line.  A "unix:PATH" address has no port number, 
+    and port_num is None.  
+    Returns tuple: (address_str, port_num, file_name)"""
     try:
         address_str = sys.argv[1].strip()
+        if address_str.startswith(UNIX_PREFIX):
+            return address_str, None, sys.argv[2].strip()
         port_num_str = sys.argv[2].strip()
         file_name = sys.argv[3].strip()
     except IndexError:
@@ -40,156 +160,718 @@ def _add_directory_for(file_name):
         pass
 
 
-def download_file_from_socket(file_name, client_socket, file_size):
-    """Takes a file_name (directory) and a socket. And downloads 
-    the file from the socket in blocks.  Assumes the next byte 
-    from the socket is the first byte of the file."""
+def download_file_from_socket(file_name, client_socket, file_size,
+                              checksum=False, tuner=None):
+    """Takes a file_name (directory), a socket and the DataLen
+    of the file.  Downloads exactly file_size bytes from the
+    socket in blocks, telling tuner (a ConnectionTuner, if given)
+    of the progress.  Assumes the next byte from the socket is
+    the first byte of the file.  With checksum, the CRC32
+    trailer that follows is recieved and checked against the
+    bytes as they were written.  Raises TransferError if the
+    connection closes early, fails or times out, ChecksumError 
+    if the file doesn't match (either way the partial file is
+    removed), or FetchError if the file can't be written."""
     outfile = None
+    downloaded_bytes = 0
+    complete = False
+    crc = 0
     try:
         # Make sure there is a directory to put the file in
         _add_directory_for(file_name)  
         
         outfile = open(file_name, 'wb')
         
-        downloaded_bytes = 0
-        reached_EOF = False
-        while not reached_EOF:
+        while downloaded_bytes < file_size:
             
             #data_block acts as a buffer
-            data_block = recv_all(BLOCK_SIZE, client_socket)
-            
-            if data_block is None:
-                reached_EOF = True
-                break
-            
-            # Have we recieved the whole file?
-            if downloaded_bytes + len(data_block) >= file_size:
-                reached_EOF = True
+            data_block = _recv_block(
+                min(BLOCK_SIZE, file_size - downloaded_bytes), 
+                client_socket, downloaded_bytes
+            )
             
             outfile.write(data_block)
             downloaded_bytes += len(data_block)
+            if checksum:
+                crc = zlib.crc32(data_block, crc)
+            if tuner is not None:
+                tuner.block_done(downloaded_bytes)
         
-    except socket.timeout:
-        error(TIMOUT_ERR)
-    except IOError:
-        error(COULDNT_WRITE_FILE_ERR)
+            # Has the connection closed before the whole file?
+            if len(data_block) == 0:
+                raise TransferError(TRUNCATED_FILE_ERR.format(
+                    downloaded_bytes, file_size
+                ), downloaded_bytes)
+        
+        if checksum:
+            trailer = _recv_block(
+                CHECKSUM_LEN, client_socket, downloaded_bytes
+            )
+            if len(trailer) < CHECKSUM_LEN:
+                raise TransferError(TRUNCATED_FILE_ERR.format(
+                    downloaded_bytes, file_size
+                ), downloaded_bytes + len(trailer))
+            if FileResponse.get_checksum_from_trailer(trailer) != crc:
+                raise ChecksumError(
+                    CHECKSUM_MISMATCH_ERR, downloaded_bytes + CHECKSUM_LEN
+                )
+        complete = True
+    
+    except TransferError:
+        raise
+    except OSError:
+        # Socket errors are TransferErrors by now, so this is the file
+        raise FetchError(COULDNT_WRITE_FILE_ERR, downloaded_bytes)
     finally:
         if outfile is not None:
             outfile.close()
-        if client_socket is not None:
-            client_socket.close()
+        if not complete and os.path.exists(file_name):
+            os.remove(file_name)
     
     return downloaded_bytes
 
 
-
-def print_recieved_message(file_name, num_bytes_received, success=True):
-    """Prints a message describing what was recieved from the 
-    server."""
-    if success:
-        print(RECEIVED_FILE_MESSAGE.format(
-            os.path.basename(file_name), num_bytes_received
-        ))
-    else:
-        print(COULDNT_RECEIVE_FILE_MESSAGE.format(
-            os.path.basename(file_name), num_bytes_received
-        ))
-
+def _copy_fd_range(out_fd, in_fd, file_size):
+    """Copies the first file_size bytes of in_fd to out_fd in 
+    the kernel, with copy_file_range() or else sendfile(), 
+    falling back to read() and write().  Stops early if in_fd 
+    is shorter.  Returns the number of bytes copied."""
+    copied_bytes = 0
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    while copied_bytes < file_size:
+        count = min(COPY_SIZE, file_size - copied_bytes)
+        num_bytes = None
+        if copy_file_range is not None:
+            try:
+                num_bytes = copy_file_range(
+                    in_fd, out_fd, count, copied_bytes, copied_bytes
+                )
+            except OSError:
+                copy_file_range = None  # e.g. across filesystems
+        if num_bytes is None and sendfile is not None:
+            try:
+                num_bytes = sendfile(out_fd, in_fd, copied_bytes, count)
+            except OSError:
+                sendfile = None
+        if num_bytes is None:
+            data_block = os.pread(in_fd, min(count, BLOCK_SIZE * 16), 
+                                  copied_bytes)
+            num_bytes = os.write(out_fd, data_block)
+        
+        if num_bytes == 0:
+            break
+        copied_bytes += num_bytes
+    
+    return copied_bytes
 
 
-def main():
-    """Main function to run the client.  Needs to be 
-    run from the command line.  See Module docstring."""    
-    client_socket = None
+def copy_file_from_fd(file_name, in_fd, file_size):
+    """Takes a file_name (directory), a file descriptor passed 
+    by the server and the DataLen of the file.  Writes the 
+    first file_size bytes of the file to file_name, sharing 
+    its blocks (a reflink) where the filesystem allows, else 
+    copying in the kernel.  Raises TransferError if the file 
+    is shorter than file_size (the partial file is removed), 
+    or FetchError if it can't be written."""
+    out_fd = None
+    copied_bytes = 0
     try:
+        # Make sure there is a directory to put the file in
+        _add_directory_for(file_name)
         
-        # Get command line arguments
-        address_str, port_num, file_name = get_address_portno_filename()
-        
+        out_fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
         
-        # Get address from address string
+        # A reflink shares the whole file, so trim it to DataLen
         try:
-            address = socket.getaddrinfo(address_str, port_num)
+            if fcntl is None:
+                raise OSError("No reflinks")
+            fcntl.ioctl(out_fd, FICLONE, in_fd)
+            copied_bytes = min(os.fstat(out_fd).st_size, file_size)
+            os.ftruncate(out_fd, copied_bytes)
         except OSError:
-            error(CANT_CONVERT_ADRESS_ERR)
+            copied_bytes = _copy_fd_range(out_fd, in_fd, file_size)
         
-        
-        # Check that the requested file doesen't already exist locally
-        if file_exists_locally(file_name):
-            error(FILE_ALREADY_EXISTS_ERR.format(os.path.basename(file_name)))        
-        
-        
-        # Create a socket
+        # Was the file cut short after the server sized it?
+        if copied_bytes < file_size:
+            raise TransferError(TRUNCATED_FILE_ERR.format(
+                copied_bytes, file_size
+            ), copied_bytes)
+    
+    except TransferError:
+        raise
+    except OSError:
+        raise FetchError(COULDNT_WRITE_FILE_ERR, copied_bytes)
+    finally:
+        if out_fd is not None:
+            os.close(out_fd)
+        if copied_bytes < file_size and os.path.exists(file_name):
+            os.remove(file_name)
+    
+    return copied_bytes
+
+
+def send_file_request(file_request, client_socket):
+    """Sends a FileRequest (or ListRequest) on client_socket.
+    Raises TransferError on a timeout, or ConnectionClosedError
+    if the connection has been closed."""
+    try:
+        send_all(file_request.get_bytearray(), client_socket)
+    except socket.timeout:
+        raise TransferError(TIMOUT_ERR)
+    except OSError:
+        raise ConnectionClosedError(COULDNT_SEND_ERR)
+
+
+def _recv_block(num_bytes, client_socket, received_bytes=0):
+    """Recieves up to num_bytes from client_socket with 
+    recv_all(), part way through a response of which 
+    received_bytes have arrived already.  Returns fewer if the 
+    connection closes.  Raises TransferError if it fails or 
+    times out."""
+    try:
+        return recv_all(num_bytes, client_socket)
+    except socket.timeout:
+        raise TransferError(TIMOUT_ERR, received_bytes)
+    except OSError:
+        raise TransferError(CONNECTION_LOST_ERR, received_bytes)
+
+
+def _recv_exactly(num_bytes, client_socket, received_bytes=0):
+    """Recieves num_bytes from client_socket, part way through a
+    response of which received_bytes have arrived already.
+    Raises TransferError if the connection closes early or times
+    out."""
+    data = _recv_block(num_bytes, client_socket, received_bytes)
+    if len(data) < num_bytes:
+        raise TransferError(
+            INVALID_FILE_RESPONSE_ERR, received_bytes + len(data)
+        )
+    return data
+
+
+def recv_list_response(client_socket):
+    """Recieves and checks a ListResponse from client_socket.
+    Returns (entries, more, total bytes recieved), where entries
+    is a list of ListEntry.  Raises ConnectionClosedError if the
+    connection closes before the header starts,
+    ServerOverloadedError if the server turned the connection
+    away, else TransferError or FetchError."""
+    try:
+        raw_header = recv_all(ListResponse.header_byte_len(), client_socket)
+    except socket.timeout:
+        raise TransferError(TIMOUT_ERR)
+    except OSError:
+        raise ConnectionClosedError(CONNECTION_LOST_ERR)
+    if len(raw_header) == 0:
+        raise ConnectionClosedError(CONNECTION_LOST_ERR)
+    if len(raw_header) < ListResponse.header_byte_len():
+        raise TransferError(INVALID_FILE_RESPONSE_ERR, len(raw_header))
+    header = ListResponse.header_to_host_byte_ord(raw_header)
+    status, num_entries, more = ListResponse.get_status_NumEntries_More(
+        header
+    )
+    
+    # An overloaded server rejects the connection with a FileResponse
+    if not ListResponse.is_valid_header(header):
+        if FileResponse.get_type_from_header(header) == FILE_RESPONSE_TYPE \
+           and status == STATUS_OVERLOADED:
+            raise ServerOverloadedError(SERVER_OVERLOADED_ERR, len(header))
+        raise FetchError(INVALID_FILE_RESPONSE_ERR, len(header))
+    
+    # Then each entry's header and path
+    num_bytes = len(raw_header)
+    entries = []
+    for _ in range(num_entries):
+        entry_header = _recv_exactly(
+            ListResponse.entry_header_byte_len(), client_socket, num_bytes
+        )
+        num_bytes += len(entry_header)
+        size, mtime, path_len = ListResponse.get_entry_fields(entry_header)
+        path = _recv_exactly(path_len, client_socket, num_bytes)
+        num_bytes += len(path)
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(TIMEOUT)
-        except OSError:
-            error(COULDNT_CREATE_ERR)
+            entries.append(ListEntry(path.decode(ENCODING_TYPE), size, mtime))
+        except UnicodeDecodeError:
+            raise FetchError(INVALID_FILE_RESPONSE_ERR, num_bytes)
+    
+    if status == STATUS_OVERLOADED:
+        raise ServerOverloadedError(SERVER_OVERLOADED_ERR, num_bytes)
+    elif status != STATUS_OK:
+        raise FetchError(INVALID_FILE_RESPONSE_ERR, num_bytes)
+    return entries, bool(more), num_bytes
+
+
+def recv_response_header(client_socket, pass_fd=False):
+    """Recieves and checks a FileResponse header, extended or
+    not, from client_socket.  With pass_fd, also recieves a file
+    descriptor passed with it, which the caller must close.
+    Returns a ResponseHeader.  Raises ConnectionClosedError if
+    the connection closes before the header starts, else
+    TransferError or FetchError."""
+    # Recieve a number of bytes equal to the length of the header
+    # (and the file descriptor, if the server passed one)
+    fd = None
+    try:
+        if pass_fd:
+            raw_header, fd = recv_fd(
+                FileResponse.header_byte_len(), client_socket
+            )
+        else:
+            raw_header = recv_all(
+                FileResponse.header_byte_len(), client_socket
+            )
+    except socket.timeout:
+        raise TransferError(TIMOUT_ERR)
+    except OSError:
+        raise ConnectionClosedError(CONNECTION_LOST_ERR)
+    
+    try:
+        if len(raw_header) == 0:
+            raise ConnectionClosedError(CONNECTION_LOST_ERR)
+        if len(raw_header) < FileResponse.header_byte_len():
+            raise TransferError(INVALID_FILE_RESPONSE_ERR, len(raw_header))
+        server_file_response_header = FileResponse.header_to_host_byte_ord(
+            raw_header
+        )
         
+        # Check header validity
+        if not FileResponse.is_valid_header(server_file_response_header):
+            raise FetchError(INVALID_FILE_RESPONSE_ERR)
         
-        # Try to connect
-        try:
-            client_socket.connect(address[0][4])
-        except (OSError, ConnectionRefusedError):
-            error(COULDNT_CONNECT_ERR)
+        # Extract status and DataLen from header.
+        status, DataLen = FileResponse.get_status_DataLen(
+            server_file_response_header
+        )
         
+        # An extended header has the file's Mtime and FileSize next
+        mtime = None
+        file_size = None
+        if FileResponse.get_type_from_header(server_file_response_header) \
+           == FILE_RESPONSE_EXT_TYPE:
+            ext_len = FileResponse.ext_header_byte_len() - len(raw_header)
+            try:
+                raw_header += recv_all(ext_len, client_socket)
+            except socket.timeout:
+                raise TransferError(TIMOUT_ERR, len(raw_header))
+            except OSError:
+                raise TransferError(CONNECTION_LOST_ERR, len(raw_header))
+            if len(raw_header) < FileResponse.ext_header_byte_len():
+                raise TransferError(INVALID_FILE_RESPONSE_ERR, len(raw_header))
+            ext_header = FileResponse.ext_header_to_host_byte_ord(raw_header)
+            mtime = FileResponse.get_mtime_from_ext_header(ext_header)
+            file_size = FileResponse.get_file_size_from_ext_header(ext_header)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        raise
+    
+    return ResponseHeader(
+        status, DataLen, len(raw_header), mtime, file_size, fd
+    )
+
+
+class ConnectionPool(object):
+    """A thread safe pool of idle, connected sockets to one
+    server.  Connections idle for longer than the server's
+    KEEPALIVE_TIMEOUT are closed rather than reused."""
+    
+    def __init__(self, addresses, max_idle=POOL_SIZE, timeout=TIMEOUT,
+                 transport=None):
+        """Takes a list of the server's addresses from
+        socket.getaddrinfo() (family, type, proto, canonname,
+        sockaddr), and the TransportPolicy new connections are
+        set up with."""
+        self.addresses = list(addresses)
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.transport = transport or TransportPolicy()
+        self._idle = []    # (socket, time it was returned)
+        self._lock = threading.Lock()
+    
+    
+    def connect(self):
+        """Returns a new socket connected to the server, trying
+        each of its addresses in turn (the last one that worked
+        first).  Raises TransferError if it can't connect."""
+        message = COULDNT_CONNECT_ERR
+        for address in list(self.addresses):
+            family, sock_type, proto, _, sockaddr = address
+            try:
+                sock = socket.socket(family, sock_type, proto)
+                sock.settimeout(self.timeout)
+            except OSError:
+                message = COULDNT_CREATE_ERR
+                continue
+            
+            try:
+                sock.connect(sockaddr)
+            except OSError:
+                sock.close()
+                continue
+            
+            self.transport.configure_client(sock)
+            
+            # Try this address first from now on
+            with self._lock:
+                if self.addresses[0] != address:
+                    self.addresses.remove(address)
+                    self.addresses.insert(0, address)
+            return sock
         
-        # Build a FileRequest
-        file_request = FileRequest(file_name)
+        raise TransferError(message)
+    
+    
+    def get(self):
+        """Returns (socket, reused).  Takes the most recently used
+        idle connection if there is one, else connects."""
+        with self._lock:
+            while self._idle:
+                sock, returned_at = self._idle.pop()
+                if time.monotonic() - returned_at < KEEPALIVE_TIMEOUT / 2:
+                    return sock, True
+                sock.close()
+        return self.connect(), False
+    
+    
+    def put(self, sock):
+        """Returns a connection with no response pending to the
+        pool, or closes it if the pool is full."""
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+    
+    
+    def close(self):
+        """Closes every idle connection."""
+        with self._lock:
+            for sock, _ in self._idle:
+                sock.close()
+            self._idle = []
+
+
+class FileClient(object):
+    """Fetches files from one server over pooled connections.
+    Can be used as a context manager, which closes the pool."""
+    
+    def __init__(self, address_str, port_num=None, pool_size=POOL_SIZE,
+                 timeout=TIMEOUT, keep_alive=True, pass_fd=True, cache=None,
+                 checksum=True, transport=None):
+        """Takes the server's address and port, or a "unix:PATH"
+        address and no port.  Raises FetchError if the address
+        can't be resolved.  Without keep_alive each fetch uses a
+        new connection, and without checksum too a plain
+        FileRequest, which any version of the server understands.
+        With pass_fd, fetches over AF_UNIX ask for the file
+        descriptor (FLAG_PASS_FD).  With a FileCache, files are
+        validated against and stored in the cache.  With checksum,
+        files are checked against a CRC32 (FLAG_CHECKSUM).  Sockets
+        are tuned by transport (default TransportPolicy())."""
+        if address_str.startswith(UNIX_PREFIX):
+            if not hasattr(socket, "AF_UNIX"):
+                raise FetchError(NO_UNIX_SOCKETS_ERR)
+            addresses = [(
+                socket.AF_UNIX, socket.SOCK_STREAM, 0, "",
+                address_str[len(UNIX_PREFIX):]
+            )]
+        else:
+            try:
+                addresses = socket.getaddrinfo(
+                    address_str, port_num, type=socket.SOCK_STREAM
+                )
+            except OSError:
+                raise FetchError(CANT_CONVERT_ADRESS_ERR)
         
+        self.server = (address_str, port_num)
+        if port_num is None:
+            self.server_name = address_str
+        else:
+            self.server_name = "{}:{}".format(address_str, port_num)
+        self.cache = cache
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.checksum = checksum
+        self.pass_fd = pass_fd and \
+            addresses[0][0] == getattr(socket, "AF_UNIX", None)
+        self.transport = transport or TransportPolicy()
+        self.pool = ConnectionPool(
+            addresses, pool_size, timeout, self.transport
+        )
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    
+    def close(self):
+        """Closes the pooled connections."""
+        self.pool.close()
+    
+    
+    def fetch(self, path, dest=None, overwrite=False):
+        """Fetches path from the server and writes it to dest
+        (default path).  Returns a FetchResult.  Raises
+        FileNotOnServerError, ServerOverloadedError,
+        TransferError or FetchError."""
+        if dest is None:
+            dest = path
+        if not overwrite and file_exists_locally(dest):
+            raise FetchError(
+                FILE_ALREADY_EXISTS_ERR.format(os.path.basename(dest))
+            )
         
-        # Send FileRequest
-        try:
-            n_bytes_sent = send_all(file_request.get_bytearray(), client_socket)
-        except OSError:
-            error(COULDNT_SEND_ERR)
+        start_time = time.monotonic()
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.lookup(self.server_name, path)
+            # dest may be a hard link to a cached file, so never
+            # write through it
+            if self.cache.link and os.path.exists(dest):
+                os.remove(dest)
         
+        status, num_bytes, mtime = self._fetch_checked(path, dest, entry)
+        if status == STATUS_NOT_MODIFIED and \
+           not self.cache.copy_out(self.server_name, path, entry, dest):
+            # The cached copy was evicted meanwhile, so fetch it in full
+            status, more_bytes, mtime = self._fetch_checked(
+                path, dest, None
+            )
+            num_bytes += more_bytes
+            if status == STATUS_NOT_MODIFIED:
+                raise FetchError(INVALID_FILE_RESPONSE_ERR, num_bytes)
+    
+        if status == STATUS_OVERLOADED:
+            raise ServerOverloadedError(SERVER_OVERLOADED_ERR, num_bytes)
+        elif status not in (STATUS_OK, STATUS_FD_PASSED, STATUS_NOT_MODIFIED):
+            if self.cache is not None:
+                self.cache.forget(self.server_name, path)
+            raise FileNotOnServerError(FILE_NOT_ON_SERVER_ERR, num_bytes)
         
-        # Recieve a number of bytes equal to the length of the header
-        server_file_response_header = recv_all(
-            FileResponse.header_byte_len(), client_socket
-        )
-        server_file_response_header = FileResponse.header_to_host_byte_ord(
-            server_file_response_header
+        if self.cache is not None and status != STATUS_NOT_MODIFIED and \
+           mtime is not None:
+            self.cache.store(self.server_name, path, dest, mtime)
+        
+        return FetchResult(
+            path, dest, status, num_bytes, time.monotonic() - start_time, None
         )
+    
+    
+    def list_files(self, pattern="", glob=False, page_size=MAX_LIST_ENTRIES):
+        """Yields a ListEntry for each file on the server whose
+        path starts with pattern (or with glob, matches it as a
+        glob), in path order.  Each page of up to page_size is
+        requested as it is needed.  Raises ServerOverloadedError,
+        TransferError or FetchError."""
+        flags = FLAG_KEEP_ALIVE if self.keep_alive else 0
+        if glob:
+            flags |= FLAG_GLOB
+        after = ""
+        while True:
+            list_request = ListRequest(pattern, flags, after, page_size)
+            
+            def request_page(client_socket):
+                send_file_request(list_request, client_socket)
+                return recv_list_response(client_socket)
+            
+            entries, more, _ = self._on_pooled_connection(request_page)
+            yield from entries
+            if not more or not entries:
+                return
+            after = entries[-1].path
+    
+    
+    def fetch_many(self, paths, dests=None, overwrite=False):
+        """Fetches each of paths (to the matching dests, default
+        the same paths) using up to pool_size connections at once.
+        Returns a list of FetchResults in the same order as paths;
+        a fetch that failed has status None and its FetchError in
+        error."""
+        if dests is None:
+            dests = paths
         
+        def fetch_one(path_dest):
+            path, dest = path_dest
+            start_time = time.monotonic()
+            try:
+                return self.fetch(path, dest, overwrite)
+            except FetchError as err:
+                return FetchResult(
+                    path, dest, None, err.num_bytes,
+                    time.monotonic() - start_time, err
+                )
         
-        # Check header validity
-        if not FileResponse.is_valid_header(server_file_response_header):
-            error(INVALID_FILE_RESPONSE_ERR)
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return list(executor.map(fetch_one, zip(paths, dests)))
+    
+    
+    def _fetch_checked(self, path, dest, entry):
+        """_fetch(), fetching the file again if it fails its
+        checksum, up to CHECKSUM_RETRIES times.  The bytes of
+        every attempt are counted."""
+        num_bytes = 0
+        for attempt in range(CHECKSUM_RETRIES + 1):
+            try:
+                status, more_bytes, mtime = self._fetch(path, dest, entry)
+                return status, num_bytes + more_bytes, mtime
+            except ChecksumError as err:
+                num_bytes += err.num_bytes
+                if attempt == CHECKSUM_RETRIES:
+                    err.num_bytes = num_bytes
+                    raise
+    
+    
+    def _fetch(self, path, dest, entry):
+        """Requests path over a pooled connection (see
+        _request()).  Returns (StatusCode, total bytes recieved,
+        Mtime or None)."""
+        return self._on_pooled_connection(
+            lambda client_socket: self._request(
+                path, dest, client_socket, entry
+            )
+        )
+    
+    
+    def _on_pooled_connection(self, request):
+        """Calls request(client_socket) with a pooled connection,
+        retrying once on a new connection if a pooled one was
+        closed by the server, and returns what it returns.
+        request must read the whole response."""
+        client_socket, reused = self.pool.get()
+        try:
+            try:
+                response = request(client_socket)
+            except ConnectionClosedError:
+                # The server may have closed an idle pooled connection
+                if not reused:
+                    raise
+                client_socket.close()
+                client_socket = self.pool.connect()
+                response = request(client_socket)
+        except BaseException:
+            client_socket.close()
+            raise
         
+        # The response was read in full, so the connection can be reused
+        if self.keep_alive:
+            self.pool.put(client_socket)
+        else:
+            client_socket.close()
         
-        # Extract status and DataLen from header.
-        status, DataLen = FileResponse.get_status_DataLen(
-            server_file_response_header
-        )
+        return response
+    
+    
+    def _request(self, path, dest, client_socket, entry=None):
+        """Sends a FileRequest for path on client_socket and
+        recieves the FileResponse, writing any file to dest.  With
+        a cache the request is validated against entry, the
+        CacheEntry of the cached copy (if any).  Returns
+        (StatusCode, total bytes recieved, Mtime or None)."""
+        flags = FLAG_KEEP_ALIVE if self.keep_alive else 0
+        if self.pass_fd:
+            flags |= FLAG_PASS_FD
+        if self.checksum:
+            flags |= FLAG_CHECKSUM
+        fields = None
+        if self.cache is not None:
+            # Without a cached copy, still ask for the Mtime
+            flags |= FLAG_VALIDATE
+            if entry is None:
+                fields = {"ValidSize": 0, "ValidMtime": 0}
+            else:
+                fields = {"ValidSize": entry.size, "ValidMtime": entry.mtime}
+        file_request = FileRequest(path, flags, fields)
         
+        send_file_request(file_request, client_socket)
+        header = recv_response_header(client_socket, self.pass_fd)
         
         # Is there a file following the header?
-        if status == 1:
-            # Write bytearray to local file
-            n_bytes = download_file_from_socket(file_name, client_socket, DataLen)
-        else:
-            # No file data downloaded
-            n_bytes = 0
+        n_bytes = 0
+        try:
+            if header.status == STATUS_OK:
+                # Write bytearray to local file
+                n_bytes = download_file_from_socket(
+                    dest, client_socket, header.data_len, self.checksum,
+                    self.transport.tuner(client_socket, sending=False)
+                )
+                if self.checksum:
+                    n_bytes += CHECKSUM_LEN
+            elif header.status == STATUS_FD_PASSED:
+                if header.fd is None:
+                    raise FetchError(MISSING_FD_ERR)
+                n_bytes = copy_file_from_fd(dest, header.fd, header.data_len)
+        finally:
+            if header.fd is not None:
+                os.close(header.fd)
+        
         # Find: total-bytes = header_bytes + file_bytes
-        total_bytes_recieved = len(server_file_response_header) + n_bytes
+        return header.status, header.num_bytes + n_bytes, header.mtime
+
+
+
+def print_recieved_message(file_name, num_bytes_received, success=True):
+    """Prints a message describing what was recieved from the 
+    server."""
+    if success:
+        print(RECEIVED_FILE_MESSAGE.format(
+            os.path.basename(file_name), num_bytes_received
+        ))
+    else:
+        print(COULDNT_RECEIVE_FILE_MESSAGE.format(
+            os.path.basename(file_name), num_bytes_received
+        ))
+
+
+
+def main():
+    """Main function to run the client.  Needs to be 
+    run from the command line.  See Module docstring."""    
+    # Get command line arguments
+    address_str, port_num, file_name = get_address_portno_filename()
         
         
-        # Print an informational message 
-        # (differentiates between sucessful send and not sucessful)
-        print_recieved_message(file_name, total_bytes_recieved, status)
+    # Check that the requested file doesen't already exist locally
+    if file_exists_locally(file_name):
+        error(FILE_ALREADY_EXISTS_ERR.format(os.path.basename(file_name)))
         
         
-    except socket.timeout:
-        error(TIMOUT_ERR)
-    finally:
-        if client_socket is not None:
-            client_socket.close()
+    # Use the cache only if one was asked for
+    cache = None
+    cache_dir = get_option("--cache")
+    if cache_dir is not None:
+        try:
+            cache = FileCache(
+                cache_dir, get_option("--cache-size", CACHE_BYTES, int)
+            )
+        except OSError:
+            error(BAD_OPTION_ERR.format("--cache"))
+    
+    # A single FileRequest, checked against its CRC32
+    try:
+        with FileClient(address_str, port_num, keep_alive=False,
+                        cache=cache,
+                        transport=TransportPolicy.from_command_line()
+                        ) as client:
+            result = client.fetch(file_name)
+    except FileNotOnServerError as err:
+        result = FetchResult(file_name, file_name, 0, err.num_bytes, 0, err)
+    except FetchError as err:
+        error(str(err))
+        
         
+    # Print an informational message
+    # (differentiates between sucessful send and not sucessful)
+    print_recieved_message(
+        file_name, result.num_bytes, result.error is None
+    )
 
 
        
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,449 @@
+'''A load generator for the server, for finding its saturation
+point and how it fails.
+Run with
+"python loadgen.py <address> <port number> <file name>[:weight]... [options]"
+
+Options:
+    --duration S        seconds to run for (default 30)
+    --connections N     closed loop: N clients each send a request as
+                        soon as their last one is answered (default 100)
+    --rate R            open loop instead: R requests per second, with
+                        random (Poisson) arrivals
+    --max-in-flight N   open loop: requests allowed in flight at once;
+                        arrivals beyond this are counted as dropped
+    --miss-ratio F      fraction of requests for files that don't exist
+    --keep-alive F      fraction of requests sent on kept-alive
+                        connections (FLAG_KEEP_ALIVE)
+    --slow-ratio F      fraction of requests read by a slow reader
+    --slow-rate N       bytes per second a slow reader reads
+    --timeout S         seconds allowed for each request
+    --interval S        seconds between progress reports
+
+Speaks FileRequest/FileResponse directly on asyncio streams, so
+one process can hold thousands of connections.  Payloads are
+read and thrown away rather than written to disk.  Each file
+name may be given a weight (e.g. big.bin:1 small.bin:20) to set
+the mix of file sizes requested.
+
+Every interval a line reports the requests completed per second,
+payload bytes per second, errors and 99th percentile latency over
+that interval.  At the end the latency percentiles (total and
+time to the response header), the StatusCodes recieved and the
+errors by kind are printed.
+'''
+
+from records import FileRequest, FileResponse, STATUS_OK, \
+    STATUS_FILE_MISSING, STATUS_OVERLOADED, FLAG_KEEP_ALIVE
+import asyncio
+from collections import Counter, namedtuple
+import math
+import random
+from common import *
+import sys
+import os
+import time
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+DURATION = 30.0         # Seconds to run for
+CONNECTIONS = 100       # Closed loop clients
+MAX_IN_FLIGHT = 10000   # Open loop requests in flight at once
+MISS_RATIO = 0.0        # Fraction of requests for missing files
+KEEP_ALIVE_RATIO = 0.0  # Fraction of requests on kept-alive connections
+SLOW_RATIO = 0.0        # Fraction of requests read slowly
+SLOW_RATE = 4096        # Bytes per second a slow reader reads
+REQUEST_TIMEOUT = 30.0  # Seconds allowed for each request
+INTERVAL = 1.0          # Seconds between progress reports
+READ_SIZE = 65536       # Most bytes read from the stream at once
+SLOW_TICK = 0.1         # Seconds between a slow reader's reads
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+PROGRESS_MESSAGE = "{:7.1f}s {:8.1f} req/s {:10.0f} bytes/s {:6d} errors \
+p99 {:8.4f}s {:6d} in flight"
+SUMMARY_MESSAGE = "{} requests in {:.1f}s, {:.1f} req/s, {:.0f} bytes/s."
+LATENCY_MESSAGE = "{:>9} latency: {}  max {:.4f}s"
+COUNT_MESSAGE = "  {}: {}"
+
+STATUS_NAMES = {
+    STATUS_FILE_MISSING: "missing", STATUS_OK: "ok",
+    STATUS_OVERLOADED: "overloaded",
+}
+
+# The outcome of one request.  latency and ttfb (time to the
+# response header) are in seconds, and error is None or the kind
+# of error.
+RequestResult = namedtuple(
+    "RequestResult", "status num_bytes latency ttfb error"
+)
+
+
+class LoadStats(object):
+    """Collects RequestResults, in total and per interval."""
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.results = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.in_flight = 0
+        self._interval_results = []
+        self._interval_start = self.start_time
+    
+    
+    def record(self, result):
+        """Adds the result of one request."""
+        self.results.append(result)
+        self._interval_results.append(result)
+        if result.error is not None:
+            self.errors[result.error] += 1
+        else:
+            self.statuses[result.status] += 1
+    
+    
+    def count_dropped(self):
+        """Counts an open loop arrival that couldn't be sent."""
+        self.errors["dropped"] += 1
+    
+    
+    def report_interval(self):
+        """Prints the progress since the last call."""
+        results, self._interval_results = self._interval_results, []
+        now = time.monotonic()
+        interval = max(now - self._interval_start, 1e-9)
+        self._interval_start = now
+        latencies = sorted(r.latency for r in results if r.error is None)
+        print(PROGRESS_MESSAGE.format(
+            now - self.start_time, len(results) / interval,
+            sum(r.num_bytes for r in results) / interval,
+            sum(1 for r in results if r.error is not None),
+            percentile(latencies, 99), self.in_flight
+        ))
+        sys.stdout.flush()
+    
+    
+    def report_summary(self):
+        """Prints the totals, latency percentiles, StatusCodes and
+        errors."""
+        elapsed = time.monotonic() - self.start_time
+        print(SUMMARY_MESSAGE.format(
+            len(self.results), elapsed, len(self.results) / elapsed,
+            sum(r.num_bytes for r in self.results) / elapsed
+        ))
+        
+        answered = [r for r in self.results if r.error is None]
+        for name, values in (
+            ("total", sorted(r.latency for r in answered)),
+            ("header", sorted(r.ttfb for r in answered)),
+        ):
+            print(LATENCY_MESSAGE.format(name, "  ".join(
+                "p{} {:.4f}s".format(p, percentile(values, p))
+                for p in PERCENTILES
+            ), values[-1] if values else 0.0))
+        
+        print("StatusCodes:")
+        for status, count in sorted(self.statuses.items()):
+            name = STATUS_NAMES.get(status, status)
+            print(COUNT_MESSAGE.format(name, count))
+        print("Errors:")
+        for kind, count in self.errors.most_common():
+            print(COUNT_MESSAGE.format(kind, count))
+
+
+def percentile(sorted_values, p):
+    """Returns the p-th percentile (nearest rank) of a sorted
+    list, or 0.0 if it is empty."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(p * len(sorted_values) / 100) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def error_kind(err):
+    """Returns a short name for the kind of err."""
+    if isinstance(err, asyncio.TimeoutError):
+        return "timeout"
+    elif isinstance(err, asyncio.IncompleteReadError):
+        return "truncated"
+    elif isinstance(err, ConnectionRefusedError):
+        return "refused"
+    elif isinstance(err, ConnectionResetError):
+        return "reset"
+    elif isinstance(err, ValueError):
+        return "invalid response"
+    elif isinstance(err, OSError) and err.errno is not None:
+        return os.strerror(err.errno).lower()
+    return type(err).__name__
+
+
+class LoadGenerator(object):
+    """Sends a mix of FileRequests to one server and records
+    the results in a LoadStats."""
+    
+    def __init__(self, address_str, port_num, files, weights=None,
+                 miss_ratio=MISS_RATIO, keep_alive_ratio=KEEP_ALIVE_RATIO,
+                 slow_ratio=SLOW_RATIO, slow_rate=SLOW_RATE,
+                 timeout=REQUEST_TIMEOUT, interval=INTERVAL):
+        self.server = (address_str, port_num)
+        self.files = files
+        self.weights = weights
+        self.miss_ratio = miss_ratio
+        self.keep_alive_ratio = keep_alive_ratio
+        self.slow_ratio = slow_ratio
+        self.slow_rate = slow_rate
+        self.timeout = timeout
+        self.interval = interval
+        self.stats = LoadStats()
+        self._idle = []    # Kept-alive (reader, writer)
+    
+    
+    async def run_closed(self, connections, duration):
+        """Runs connections clients, each sending its next request
+        as soon as the last is answered, for duration seconds."""
+        deadline = time.monotonic() + duration
+        
+        async def client():
+            while time.monotonic() < deadline:
+                await self.request()
+        
+        await self._with_reports(asyncio.gather(
+            *(client() for _ in range(connections))
+        ))
+    
+    
+    async def run_open(self, rate, duration, max_in_flight=MAX_IN_FLIGHT):
+        """Starts requests at random times, rate per second on
+        average, for duration seconds, whether or not earlier ones
+        have been answered.  Then waits for those in flight."""
+        async def arrivals():
+            tasks = set()
+            next_time = time.monotonic()
+            deadline = next_time + duration
+            while next_time < deadline:
+                next_time += random.expovariate(rate)
+                await asyncio.sleep(max(next_time - time.monotonic(), 0))
+                if self.stats.in_flight >= max_in_flight:
+                    self.stats.count_dropped()
+                    continue
+                task = asyncio.ensure_future(self.request())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        
+        await self._with_reports(arrivals())
+    
+    
+    async def close(self):
+        """Closes the kept-alive connections."""
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+    
+    
+    async def _with_reports(self, awaitable):
+        """Awaits awaitable, reporting progress every interval."""
+        async def reporter():
+            while True:
+                await asyncio.sleep(self.interval)
+                self.stats.report_interval()
+        
+        reports = asyncio.ensure_future(reporter())
+        try:
+            await awaitable
+        finally:
+            reports.cancel()
+            await self.close()
+    
+    
+    async def request(self):
+        """Sends one request from the mix and records the
+        result."""
+        if random.random() < self.miss_ratio:
+            path = "loadgen-missing-{}".format(random.getrandbits(32))
+        else:
+            path = random.choices(self.files, self.weights)[0]
+        keep_alive = random.random() < self.keep_alive_ratio
+        slow = random.random() < self.slow_ratio
+        
+        self.stats.in_flight += 1
+        start_time = time.monotonic()
+        progress = {"ttfb": 0.0, "num_bytes": 0}
+        try:
+            status = await asyncio.wait_for(
+                self._request(path, keep_alive, slow, start_time, progress),
+                self.timeout
+            )
+            result = RequestResult(
+                status, progress["num_bytes"],
+                time.monotonic() - start_time, progress["ttfb"], None
+            )
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError) as err:
+            result = RequestResult(
+                None, progress["num_bytes"],
+                time.monotonic() - start_time, progress["ttfb"],
+                error_kind(err)
+            )
+        finally:
+            self.stats.in_flight -= 1
+        self.stats.record(result)
+    
+    
+    async def _request(self, path, keep_alive, slow, start_time, progress):
+        """Sends a FileRequest for path and reads the FileResponse,
+        recording the time to its header and the payload bytes
+        read in progress.  Returns the StatusCode."""
+        reader = writer = None
+        reused = False
+        if keep_alive and self._idle:
+            reader, writer = self._idle.pop()
+            reused = True
+        else:
+            reader, writer = await asyncio.open_connection(*self.server)
+        
+        try:
+            try:
+                status, data_len = await self._send_request(
+                    path, keep_alive, reader, writer
+                )
+            except (OSError, asyncio.IncompleteReadError):
+                # The server may have closed an idle kept-alive connection
+                if not reused:
+                    raise
+                writer.close()
+                reader, writer = await asyncio.open_connection(*self.server)
+                status, data_len = await self._send_request(
+                    path, keep_alive, reader, writer
+                )
+            progress["ttfb"] = time.monotonic() - start_time
+            
+            if status == STATUS_OK:
+                await self._read_payload(reader, data_len, slow, progress)
+        except BaseException:
+            writer.close()
+            raise
+        
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return status
+    
+    
+    async def _send_request(self, path, keep_alive, reader, writer):
+        """Sends a FileRequest for path and reads the FileResponse
+        header.  Returns (StatusCode, DataLen).  Raises ValueError
+        if the header is invalid."""
+        flags = FLAG_KEEP_ALIVE if keep_alive else 0
+        writer.write(FileRequest(path, flags).get_bytearray())
+        await writer.drain()
+        
+        header = await reader.readexactly(FileResponse.header_byte_len())
+        header = FileResponse.header_to_host_byte_ord(header)
+        if not FileResponse.is_valid_header(header):
+            raise ValueError(INVALID_FILE_RESPONSE_ERR)
+        return FileResponse.get_status_DataLen(header)
+    
+    
+    async def _read_payload(self, reader, data_len, slow, progress):
+        """Reads and discards data_len bytes, at no more than
+        slow_rate bytes per second if slow."""
+        tick_bytes = max(int(self.slow_rate * SLOW_TICK), 1)
+        while progress["num_bytes"] < data_len:
+            remaining = data_len - progress["num_bytes"]
+            if slow:
+                data_block = await reader.read(min(tick_bytes, remaining))
+            else:
+                data_block = await reader.read(min(READ_SIZE, remaining))
+            if len(data_block) == 0:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            progress["num_bytes"] += len(data_block)
+            if slow:
+                await asyncio.sleep(SLOW_TICK)
+
+
+def raise_open_file_limit():
+    """Raises the limit on open files as far as allowed, since
+    every connection needs one."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (OSError, ValueError):
+        pass
+
+
+def get_address_portno_files():
+    """Gets the address, port number and file names (with their
+    weights) from the command line, skipping --options and their
+    values.  Returns tuple: (address_str, port_num, files,
+    weights)"""
+    args = []
+    skip_next = False
+    for arg in sys.argv[1:]:
+        if skip_next:
+            skip_next = False
+        elif arg.startswith("--"):
+            skip_next = True
+        else:
+            args.append(arg.strip())
+    
+    if len(args) < 3:
+        error(MISSING_ARG_ERR)
+    
+    files = []
+    weights = []
+    for arg in args[2:]:
+        file_name, _, weight = arg.rpartition(":")
+        try:
+            if not file_name:
+                raise ValueError()
+            weights.append(float(weight))
+            files.append(file_name)
+        except ValueError:
+            files.append(arg)
+            weights.append(1.0)
+    
+    return args[0], convert_portno_str(args[1]), files, weights
+
+
+def main():
+    """Main function to run the load generator.  Needs to be
+    run from the command line.  See Module docstring."""
+    address_str, port_num, files, weights = get_address_portno_files()
+    raise_open_file_limit()
+    
+    generator = LoadGenerator(
+        address_str, port_num, files, weights,
+        get_option("--miss-ratio", MISS_RATIO, float),
+        get_option("--keep-alive", KEEP_ALIVE_RATIO, float),
+        get_option("--slow-ratio", SLOW_RATIO, float),
+        get_option("--slow-rate", SLOW_RATE, int),
+        get_option("--timeout", REQUEST_TIMEOUT, float),
+        get_option("--interval", INTERVAL, float),
+    )
+    duration = get_option("--duration", DURATION, float)
+    rate = get_option("--rate", None, float)
+    
+    try:
+        if rate is not None:
+            asyncio.run(generator.run_open(
+                rate, duration,
+                get_option("--max-in-flight", MAX_IN_FLIGHT, int)
+            ))
+        else:
+            asyncio.run(generator.run_closed(
+                get_option("--connections", CONNECTIONS, int), duration
+            ))
+    except KeyboardInterrupt:
+        pass
+    
+    generator.stats.report_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,650 @@
+'''Striped downloads of one file from several servers at once.
+Run with
+"python striped.py <address> <port number> <file name> [options]"
+or "python striped.py unix:PATH <file name> [options]"
+
+Options:
+    --replica ADDRESS:PORT  another server with the same files, may be
+                            given more than once (or unix:PATH)
+    --chunk-size N          bytes fetched from a server per request
+    --connections N         connections to each server
+
+The file is split into chunks of chunk_size bytes, each fetched
+with a FLAG_RANGE FileRequest and written into place with
+os.pwrite(), so chunks from different servers can arrive in any
+order.  Every server is first asked for an empty range, which
+gives the size of the file and a first measure of its latency.
+A server that doesn't have the file, or has a different size of
+it than most servers do, is left out.
+
+Chunks are handed out from one queue, so faster servers come
+back for more work sooner.  Each Replica keeps moving averages
+of its latency and throughput, and once the queue is short a
+server that would take HEDGE_FACTOR times longer than a faster
+one to fetch a chunk leaves it to the faster one.  When the
+queue is empty, an idle connection to a fast server also fetches
+a chunk that a slow server is still working on (a hedged
+request), and whichever finishes first wins.  A server that fails
+MAX_FAILURES times in a row is dropped, and its chunks are
+fetched from the others.  A chunk that can't be written to the
+local file ends the fetch, without counting against any server.
+
+Each chunk is requested with FLAG_CHECKSUM and checked against
+its CRC32 as it is written, so a corrupted chunk is fetched again
+(counting as a failure of its server) rather than the whole file.
+
+Can be imported and used as a library:
+
+    with StripedClient([("10.0.0.1", 5000), ("10.0.0.2", 5000)]) as c:
+        result = c.fetch("toolchain.tar")
+'''
+
+from records import FileRequest, FileResponse, STATUS_OK, \
+    STATUS_OVERLOADED, CHECKSUM_LEN, FLAG_KEEP_ALIVE, FLAG_RANGE, \
+    FLAG_CHECKSUM
+from client import FileClient, FetchResult, FetchError, \
+    FileNotOnServerError, ServerOverloadedError, TransferError, \
+    ConnectionClosedError, ChecksumError, send_file_request, \
+    recv_response_header, _add_directory_for, print_recieved_message, \
+    get_address_portno_filename
+import socket
+from common import *
+import sys
+import os
+import time
+import threading
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 4 * 1024**2    # Bytes fetched from a server per request
+CONNECTIONS = 2             # Connections to each server
+RECV_SIZE = 65536           # Most bytes recieved at once
+MAX_FAILURES = 3            # Failures in a row before a server is dropped
+SMOOTHING = 0.3             # Weight of the newest sample in the averages
+HEDGE_FACTOR = 2.0          # How much faster a server must be to step in
+WAIT_INTERVAL = 0.05        # Seconds an idle connection waits for work
+
+
+class _Cancelled(Exception):
+    """Raised in a connection fetching a chunk that another
+    connection has finished first."""
+
+
+class _WriteError(FetchError):
+    """Raised when a chunk can't be written to the local file.
+    Ends the whole fetch, as no server is to blame."""
+
+
+class Replica(object):
+    """One server holding the file, with moving averages of its
+    latency (seconds to the response header) and throughput
+    (payload bytes per second)."""
+    
+    def __init__(self, client):
+        self.client = client
+        self.name = client.server_name
+        self.latency = None
+        self.throughput = None
+        self.bytes_fetched = 0
+        self.failures = 0
+        self.failed = False
+        self._lock = threading.Lock()
+    
+    
+    def record_latency(self, latency):
+        """Adds a measure of the time to the response header."""
+        with self._lock:
+            self.latency = _smooth(self.latency, latency)
+    
+    
+    def record_transfer(self, num_bytes, elapsed):
+        """Adds a measure of num_bytes of payload recieved in
+        elapsed seconds, and clears the failure count."""
+        with self._lock:
+            self.bytes_fetched += num_bytes
+            self.failures = 0
+            if elapsed > 0:
+                self.throughput = _smooth(
+                    self.throughput, num_bytes / elapsed
+                )
+    
+    
+    def record_failure(self):
+        """Counts a failed request.  Returns True if the server
+        has now failed too often and is dropped."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= MAX_FAILURES:
+                self.failed = True
+            return self.failed
+    
+    
+    def estimate(self, num_bytes):
+        """Returns the seconds this server is expected to take to
+        fetch num_bytes, or 0.0 until it has been measured."""
+        if self.throughput is None:
+            return 0.0
+        return (self.latency or 0.0) + num_bytes / self.throughput
+
+
+def _smooth(average, sample):
+    """Returns the moving average average updated with sample."""
+    if average is None:
+        return sample
+    return (1 - SMOOTHING) * average + SMOOTHING * sample
+
+
+class _Chunk(object):
+    """A range of the file, and the connections fetching it."""
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+        self.done = False
+        self.fetchers = {}    # Replica -> time.monotonic() it started
+
+
+class _StripedFetch(object):
+    """The shared state of one striped fetch: the queue of
+    chunks and those in flight."""
+    
+    def __init__(self, path, out_fd, chunks, replicas, connections):
+        self.path = path
+        self.out_fd = out_fd
+        self.replicas = replicas
+        self.connections = connections
+        self.pending = deque(chunks)
+        self.in_flight = []
+        self.remaining = len(chunks)
+        self.num_bytes = 0
+        self.error = None
+        self._cond = threading.Condition()
+    
+    
+    def next_chunk(self, replica):
+        """Blocks until there is a chunk for replica to fetch,
+        and returns it.  Returns None once the fetch is over, or
+        replica has been dropped."""
+        with self._cond:
+            while True:
+                if self.remaining == 0 or self.error is not None or \
+                   replica.failed:
+                    return None
+                
+                chunk = None
+                if self.pending:
+                    if not self._leave_to_faster(replica, self.pending[0]):
+                        chunk = self.pending.popleft()
+                        self.in_flight.append(chunk)
+                else:
+                    chunk = self._chunk_to_hedge(replica)
+                
+                if chunk is not None:
+                    chunk.fetchers[replica] = time.monotonic()
+                    return chunk
+                self._cond.wait(WAIT_INTERVAL)
+    
+    
+    def finish(self, chunk, replica, num_bytes):
+        """Marks chunk fetched by replica.  Returns False if
+        another connection had already finished it."""
+        with self._cond:
+            self.num_bytes += num_bytes
+            chunk.fetchers.pop(replica, None)
+            if chunk.done:
+                return False
+            chunk.done = True
+            self.in_flight.remove(chunk)
+            self.remaining -= 1
+            self._cond.notify_all()
+            return True
+    
+    
+    def fail(self, chunk, replica, err, num_bytes):
+        """Puts chunk back in the queue after replica failed to
+        fetch it (unless another connection has it), and ends the
+        fetch with err if no server is left."""
+        with self._cond:
+            self.num_bytes += num_bytes
+            chunk.fetchers.pop(replica, None)
+            if not chunk.done and not chunk.fetchers:
+                self.in_flight.remove(chunk)
+                self.pending.appendleft(chunk)
+            if all(r.failed for r in self.replicas):
+                self.error = err
+            self._cond.notify_all()
+    
+    
+    def abort(self, chunk, replica, err):
+        """Ends the fetch with err, an unexpected exception raised
+        while replica was fetching chunk.  fetch() re-raises it
+        once every connection has stopped."""
+        with self._cond:
+            chunk.fetchers.pop(replica, None)
+            if not chunk.done and not chunk.fetchers:
+                self.in_flight.remove(chunk)
+                self.pending.appendleft(chunk)
+            if self.error is None:
+                self.error = err
+            self._cond.notify_all()
+    
+    
+    def drop(self, replica):
+        """Drops replica, whose copy of the file has gone or
+        changed."""
+        with self._cond:
+            replica.failed = True
+            self._cond.notify_all()
+    
+    
+    def _leave_to_faster(self, replica, chunk):
+        """Returns True if replica should leave chunk for servers
+        much faster than it, which are enough to take every
+        chunk still queued."""
+        mine = replica.estimate(chunk.length)
+        faster = [
+            r for r in self.replicas if r is not replica and not r.failed
+            and r.throughput is not None
+            and r.estimate(chunk.length) * HEDGE_FACTOR < mine
+        ]
+        return len(self.pending) <= len(faster) * self.connections
+    
+    
+    def _chunk_to_hedge(self, replica):
+        """Returns the in flight chunk that replica could finish
+        soonest relative to the server fetching it, if replica
+        would be HEDGE_FACTOR times quicker, else None.  A server
+        not yet measured is hedged once it has spent 
+        HEDGE_FACTOR times longer on its chunk than replica 
+        would take."""
+        now = time.monotonic()
+        best_chunk = None
+        best_gain = HEDGE_FACTOR
+        for chunk in self.in_flight:
+            if chunk.done or len(chunk.fetchers) != 1 or \
+               replica in chunk.fetchers:
+                continue
+            (other, started), = chunk.fetchers.items()
+            mine = replica.estimate(chunk.length)
+            if mine <= 0:
+                continue
+            if other.throughput is None:
+                # Not measured yet, but it has already taken this long
+                theirs = now - started
+            else:
+                theirs = started + other.estimate(chunk.length) - now
+            if theirs / mine > best_gain:
+                best_chunk = chunk
+                best_gain = theirs / mine
+        return best_chunk
+
+
+class StripedClient(object):
+    """Fetches files in parallel from several servers with the
+    same files.  Can be used as a context manager, which closes
+    the pooled connections."""
+    
+    def __init__(self, servers, chunk_size=CHUNK_SIZE,
+                 connections=CONNECTIONS, timeout=TIMEOUT):
+        """Takes a list of (address_str, port_num) of the servers
+        (port_num None for a "unix:PATH" address).  Raises
+        FetchError if an address can't be resolved."""
+        self.chunk_size = chunk_size
+        self.connections = connections
+        self.replicas = [
+            Replica(FileClient(
+                address_str, port_num, connections, timeout,
+                keep_alive=True, pass_fd=False
+            ))
+            for address_str, port_num in servers
+        ]
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    
+    def close(self):
+        """Closes the pooled connections to every server."""
+        for replica in self.replicas:
+            replica.client.close()
+    
+    
+    def fetch(self, path, dest=None, overwrite=False):
+        """Fetches path, striped across the servers, and writes
+        it to dest (default path).  Returns a FetchResult whose
+        num_bytes counts what was recieved from every server.
+        Raises FileNotOnServerError, ServerOverloadedError,
+        TransferError or FetchError, or any other exception a
+        connection raised while fetching a chunk."""
+        if dest is None:
+            dest = path
+        if not overwrite and file_exists_locally(dest):
+            raise FetchError(
+                FILE_ALREADY_EXISTS_ERR.format(os.path.basename(dest))
+            )
+        
+        start_time = time.monotonic()
+        file_size, replicas, num_bytes = self._probe(path)
+        chunks = [
+            _Chunk(offset, min(self.chunk_size, file_size - offset))
+            for offset in range(0, file_size, self.chunk_size)
+        ]
+        
+        out_fd = None
+        complete = False
+        try:
+            _add_directory_for(dest)
+            out_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            os.ftruncate(out_fd, file_size)
+            
+            state = _StripedFetch(
+                path, out_fd, chunks, replicas, self.connections
+            )
+            workers = [
+                threading.Thread(
+                    target=self._worker, args=(replica, state), daemon=True
+                )
+                for replica in replicas for _ in range(self.connections)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            
+            if state.error is not None:
+                raise state.error
+            complete = True
+        except OSError:
+            raise FetchError(COULDNT_WRITE_FILE_ERR)
+        finally:
+            if out_fd is not None:
+                os.close(out_fd)
+            if not complete and os.path.exists(dest):
+                os.remove(dest)
+        
+        return FetchResult(
+            path, dest, STATUS_OK, num_bytes + state.num_bytes,
+            time.monotonic() - start_time, None
+        )
+    
+    
+    def _probe(self, path):
+        """Asks every server that hasn't been dropped for an empty
+        range of path, measuring its latency.  Returns (file
+        size, the Replicas that have the file at that size, bytes
+        recieved).  Raises the first server's FetchError if none
+        has the file."""
+        def probe(replica):
+            start_time = time.monotonic()
+            try:
+                header = self._request_range(replica, path, 0, 0)
+            except FetchError as err:
+                return err
+            replica.record_latency(time.monotonic() - start_time)
+            return header
+        
+        replicas = [r for r in self.replicas if not r.failed]
+        with ThreadPoolExecutor(max_workers=len(replicas) or 1) as executor:
+            headers = list(executor.map(probe, replicas))
+        
+        num_bytes = sum(
+            header.num_bytes for header in headers
+            if not isinstance(header, FetchError)
+        )
+        sizes = Counter(
+            header.file_size for header in headers
+            if not isinstance(header, FetchError)
+            and header.status == STATUS_OK
+        )
+        if not sizes:
+            for header in headers:
+                if isinstance(header, FetchError):
+                    raise header
+                elif header.status == STATUS_OVERLOADED:
+                    raise ServerOverloadedError(SERVER_OVERLOADED_ERR)
+            raise FileNotOnServerError(FILE_NOT_ON_SERVER_ERR, num_bytes)
+        
+        # Most servers have the right version, the first breaks ties
+        file_size = sizes.most_common(1)[0][0]
+        return file_size, [
+            replica for replica, header in zip(replicas, headers)
+            if not isinstance(header, FetchError)
+            and header.status == STATUS_OK and header.file_size == file_size
+        ], num_bytes
+    
+    
+    def _worker(self, replica, state):
+        """Fetches chunks from replica on one connection until the
+        fetch is over or replica is dropped."""
+        while True:
+            chunk = state.next_chunk(replica)
+            if chunk is None:
+                return
+            
+            start_time = time.monotonic()
+            num_bytes = 0
+            try:
+                num_bytes = self._fetch_chunk(replica, state, chunk)
+            except _Cancelled:
+                state.finish(chunk, replica, 0)
+                continue
+            except _WriteError as err:
+                state.abort(chunk, replica, err)
+                return
+            except FetchError as err:
+                replica.record_failure()
+                state.fail(chunk, replica, err, err.num_bytes)
+                continue
+            except Exception as err:
+                # A bug or a bad response, so stop rather than retry
+                state.abort(chunk, replica, err)
+                return
+            
+            if state.finish(chunk, replica, num_bytes):
+                replica.record_transfer(
+                    chunk.length, time.monotonic() - start_time
+                )
+    
+    
+    def _fetch_chunk(self, replica, state, chunk):
+        """Fetches chunk from replica and writes it into place.
+        Returns the number of bytes recieved.  Raises _Cancelled
+        if another connection finishes chunk first."""
+        client_socket, reused = replica.client.pool.get()
+        try:
+            try:
+                start_time = time.monotonic()
+                header = self._send_range_request(
+                    client_socket, state.path, chunk.offset, chunk.length,
+                    True
+                )
+            except ConnectionClosedError:
+                # The server may have closed an idle pooled connection
+                if not reused:
+                    raise
+                client_socket.close()
+                client_socket = replica.client.pool.connect()
+                start_time = time.monotonic()
+                header = self._send_range_request(
+                    client_socket, state.path, chunk.offset, chunk.length,
+                    True
+                )
+            replica.record_latency(time.monotonic() - start_time)
+            
+            if header.status == STATUS_OVERLOADED:
+                raise ServerOverloadedError(
+                    SERVER_OVERLOADED_ERR, header.num_bytes
+                )
+            elif header.status != STATUS_OK or \
+                 header.data_len != chunk.length:
+                # The file has gone or changed on this server
+                state.drop(replica)
+                raise FileNotOnServerError(
+                    FILE_NOT_ON_SERVER_ERR, header.num_bytes
+                )
+            
+            num_bytes = download_range_to_fd(
+                state.out_fd, chunk.offset, client_socket, chunk.length,
+                lambda: chunk.done, True
+            )
+        except BaseException:
+            # The rest of any response is still on the way
+            client_socket.close()
+            raise
+        
+        replica.client.pool.put(client_socket)
+        return header.num_bytes + num_bytes
+    
+    
+    def _request_range(self, replica, path, offset, length):
+        """Requests length bytes of path from offset on a pooled
+        connection to replica, and returns the ResponseHeader.
+        Only for requests with no payload to read (length 0)."""
+        client_socket, _ = replica.client.pool.get()
+        try:
+            try:
+                header = self._send_range_request(
+                    client_socket, path, offset, length
+                )
+            except ConnectionClosedError:
+                client_socket.close()
+                client_socket = replica.client.pool.connect()
+                header = self._send_range_request(
+                    client_socket, path, offset, length
+                )
+        except BaseException:
+            client_socket.close()
+            raise
+        
+        replica.client.pool.put(client_socket)
+        return header
+    
+    
+    def _send_range_request(self, client_socket, path, offset, length,
+                            checksum=False):
+        """Sends a FLAG_RANGE FileRequest on client_socket (with
+        FLAG_CHECKSUM if checksum) and returns the ResponseHeader
+        recieved."""
+        flags = FLAG_KEEP_ALIVE | FLAG_RANGE
+        if checksum:
+            flags |= FLAG_CHECKSUM
+        file_request = FileRequest(
+            path, flags, {"Offset": offset, "Length": length}
+        )
+        send_file_request(file_request, client_socket)
+        return recv_response_header(client_socket)
+
+
+def download_range_to_fd(out_fd, offset, client_socket, length,
+                         cancelled=None, checksum=False):
+    """Recieves exactly length bytes from client_socket and
+    writes them to out_fd from offset, with os.pwrite().  With
+    checksum, the CRC32 trailer that follows is recieved and
+    checked too.  Raises TransferError if the connection closes
+    early or times out, ChecksumError if the range doesn't
+    match, _WriteError if out_fd can't be written, or _Cancelled 
+    if cancelled() becomes True.  Returns the number of bytes 
+    recieved."""
+    received_bytes = 0
+    crc = 0
+    try:
+        while received_bytes < length:
+            if cancelled is not None and cancelled():
+                raise _Cancelled()
+            
+            data_block = client_socket.recv(
+                min(RECV_SIZE, length - received_bytes)
+            )
+            
+            # Has the connection closed before the whole range?
+            if len(data_block) == 0:
+                raise TransferError(TRUNCATED_FILE_ERR.format(
+                    received_bytes, length
+                ), received_bytes)
+            
+            try:
+                written_bytes = 0
+                while written_bytes < len(data_block):
+                    written_bytes += os.pwrite(
+                        out_fd, data_block[written_bytes:],
+                        offset + received_bytes + written_bytes
+                    )
+            except OSError:
+                raise _WriteError(COULDNT_WRITE_FILE_ERR, received_bytes)
+            received_bytes += len(data_block)
+            if checksum:
+                crc = zlib.crc32(data_block, crc)
+        
+        if checksum:
+            trailer = recv_all(CHECKSUM_LEN, client_socket)
+            if len(trailer) < CHECKSUM_LEN:
+                raise TransferError(TRUNCATED_FILE_ERR.format(
+                    received_bytes, length
+                ), received_bytes + len(trailer))
+            received_bytes += CHECKSUM_LEN
+            if FileResponse.get_checksum_from_trailer(trailer) != crc:
+                raise ChecksumError(CHECKSUM_MISMATCH_ERR, received_bytes)
+    
+    except socket.timeout:
+        raise TransferError(TIMOUT_ERR, received_bytes)
+    except (TransferError, _WriteError, _Cancelled):
+        raise
+    except OSError:
+        raise TransferError(CONNECTION_LOST_ERR, received_bytes)
+    
+    return received_bytes
+
+
+def parse_server(server_str):
+    """Takes "ADDRESS:PORT" or "unix:PATH".  Returns tuple:
+    (address_str, port_num), where port_num is None for
+    unix:PATH.  Raises ValueError if it is badly formed."""
+    if server_str.startswith(UNIX_PREFIX):
+        return server_str, None
+    address_str, _, port_num_str = server_str.rpartition(":")
+    if not address_str or not port_num_str.isdigit() or \
+       not MIN_PORT_NUM <= int(port_num_str) <= MAX_PORT_NUM:
+        raise ValueError("Bad server {}".format(server_str))
+    return address_str, int(port_num_str)
+
+
+def main():
+    """Main function to run the striped client.  Needs to be
+    run from the command line.  See Module docstring."""
+    address_str, port_num, file_name = get_address_portno_filename()
+    servers = [(address_str, port_num)] + \
+        get_options("--replica", parse_server)
+    
+    if file_exists_locally(file_name):
+        error(FILE_ALREADY_EXISTS_ERR.format(os.path.basename(file_name)))
+    
+    try:
+        with StripedClient(
+            servers,
+            get_option("--chunk-size", CHUNK_SIZE, int),
+            get_option("--connections", CONNECTIONS, int)
+        ) as client:
+            result = client.fetch(file_name)
+            replicas = client.replicas
+    except FileNotOnServerError as err:
+        print_recieved_message(file_name, err.num_bytes, False)
+        sys.exit(1)
+    except FetchError as err:
+        error(str(err))
+    
+    print_recieved_message(file_name, result.num_bytes)
+    for replica in replicas:
+        print(REPLICA_STATS_MESSAGE.format(
+            replica.name, replica.bytes_fetched, replica.throughput or 0,
+            replica.latency or 0
+        ))
+
+
+if __name__ == "__main__":
+    main()
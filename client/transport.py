@@ -0,0 +1 @@
+../transport.py
\ No newline at end of file
@@ -2,13 +2,25 @@
 client.py and server.py
 """
 
+import array
 import os
+import socket
+import sys
+import time
 
 MIN_PORT_NUM = 1024
 MAX_PORT_NUM = 64000
 
 TIMEOUT = 1.0    # Timeout in seconds
 
+READ_TIMEOUT = 5.0        # Deadline in seconds to receive a whole request
+WRITE_TIMEOUT = 5.0       # Max seconds a single send() may stall for
+MIN_THROUGHPUT = 16384    # Bytes per second a connection must sustain
+THROUGHPUT_GRACE = 2.0    # Seconds before MIN_THROUGHPUT is enforced
+KEEPALIVE_TIMEOUT = 15.0  # Seconds a kept-alive connection may be idle
+
+UNIX_PREFIX = "unix:"     # Address prefix for an AF_UNIX socket path
+
 BAD_PORT_NUMBER_ERR = "ERROR port number is not in not in the range {} to {} \
 or it is a bad format.".format(MIN_PORT_NUM, MAX_PORT_NUM)
 COULDNT_BIND_ERR = "ERROR on binding to socket."
@@ -20,16 +32,38 @@ MISSING_ARG_ERR = "ERROR missing one or more command line arguments."
 FILE_ALREADY_EXISTS_ERR = "ERROR the file {} already exists locally."
 CANT_CONVERT_ADRESS_ERR = "ERROR nodename nor servname provided, or not known."
 TIMOUT_ERR = "ERROR timeout"
+CLIENT_TIMEOUT_ERR = "ERROR timeout on connection from {}, connection closed."
+SLOW_CLIENT_ERR = "ERROR connection from {} is below {} bytes/s, \
+connection closed."
+CONNECTION_CLOSED_ERR = "ERROR connection from {} closed before the \
+request was received."
 INVALID_FILE_REQUEST_ERR = "ERROR invalid FileRequest"
 INVALID_FILE_RESPONSE_ERR = "ERROR invalid FileResponse"
 COULDNT_WRITE_FILE_ERR = "ERROR couldn't write file to disk."
 FILE_NOT_ON_SERVER_ERR = "ERROR the server couldn't retrieve the file."
+TRUNCATED_FILE_ERR = "ERROR the connection closed after {} of {} bytes."
+CONNECTION_LOST_ERR = "ERROR the server closed the connection."
+SERVER_OVERLOADED_ERR = "ERROR the server is overloaded, try again later."
+BAD_OPTION_ERR = "ERROR bad value for command line option {}."
+BAD_LIMITS_FILE_ERR = "ERROR couldn't load rate limits from {}."
+NO_UNIX_SOCKETS_ERR = "ERROR AF_UNIX sockets aren't supported here."
+MISSING_FD_ERR = "ERROR the server didn't pass the file descriptor."
+CHECKSUM_MISMATCH_ERR = "ERROR the file recieved doesn't match its checksum."
+FILE_SHRANK_ERR = "ERROR {} got shorter while it was sent to {}, \
+connection closed."
 
 SENT_FILE_MESSAGE = 'Sent "{}" to client, {} bytes sent.'
 COULDNT_SENT_FILE_MESSAGE = 'The file "{}" does not exist, and could not be \
 transfered.  FileResponse sent to client.  {} bytes sent.'
+OVERLOADED_MESSAGE = 'Server overloaded, refused to send "{}".'
+REJECTED_CONNECTION_MESSAGE = 'Server overloaded, refused connection from {}.'
+LIMITS_LOADED_MESSAGE = 'Loaded rate limits from "{}".'
+PASSED_FD_MESSAGE = 'Passed "{}" to client as a file descriptor, {} bytes.'
+NOT_MODIFIED_MESSAGE = 'Client already has the current "{}", not sent.'
+LISTED_MESSAGE = 'Listed files matching "{}" to client, {} bytes sent.'
 
 RECEIVED_FILE_MESSAGE = 'Received "{}" from server, {} bytes received.'
+REPLICA_STATS_MESSAGE = '  {}: {} bytes, {:.0f} bytes/s, {:.3f}s latency.'
 COULDNT_RECEIVE_FILE_MESSAGE = 'The file "{}" does not exist on the server, \
 and could not be transfered.  FileResponse recieved from server.  {} bytes \
 transfered.'
@@ -44,25 +78,42 @@ def error(message="", exit_all=True):
         print(message)
 
 
-def send_all(data, sock):
+def _apply_deadline(sock, deadline):
+    """Sets the timeout of sock to the time remaining until 
+    deadline (a time.monotonic() value).  Raises socket.timeout 
+    if the deadline has already passed."""
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("Deadline passed.")
+    sock.settimeout(remaining)
+
+
+def send_all(data, sock, deadline=None):
     """Takes a bytearray and an open socket.  
     Equivalent to socket.sendall but counts and returns 
     the number of bytes transfered.  Calls socket.send() 
-    until all bytes are sent."""
+    until all bytes are sent.  If a deadline (time.monotonic() 
+    value) is given, raises socket.timeout once it passes."""
     sent_bytes = 0
     while sent_bytes < len(data):
+        _apply_deadline(sock, deadline)
         sent_bytes += sock.send(data[sent_bytes:])
     
     return sent_bytes
 
 
-def recv_all(num_bytes, sock):
+def recv_all(num_bytes, sock, deadline=None):
     """Takes a number of bytes to recieve, and an open socket.
-    Calls socket.send() until all bytes are sent."""
+    Calls socket.recv() until all bytes are recieved or the 
+    connection is closed.  If a deadline (time.monotonic() 
+    value) is given, raises socket.timeout once it passes."""
     data = bytearray()
     next_block = bytearray()
     while len(data) < num_bytes:
         
+        _apply_deadline(sock, deadline)
         next_block = sock.recv(num_bytes - len(data))
         
         if len(next_block) <= 0:
@@ -72,6 +123,53 @@ def recv_all(num_bytes, sock):
     
     return data
 
+
+def send_fd(data, fd, sock, deadline=None):
+    """Like send_all(), but sock must be an AF_UNIX socket, and 
+    the open file descriptor fd is passed to the peer 
+    (SCM_RIGHTS) along with the first byte of data.  Returns 
+    the number of bytes sent."""
+    _apply_deadline(sock, deadline)
+    sent_bytes = sock.sendmsg([data], [(
+        socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd])
+    )])
+    return sent_bytes + send_all(data[sent_bytes:], sock, deadline)
+
+
+def recv_fd(num_bytes, sock, deadline=None):
+    """Like recv_all(), but sock must be an AF_UNIX socket, and 
+    a file descriptor passed with the data (see send_fd()) is 
+    also recieved.  Returns (data, fd), where fd is None if no 
+    file descriptor was passed.  The caller must close fd."""
+    fd_size = array.array("i").itemsize
+    data = bytearray()
+    fd = None
+    while len(data) < num_bytes:
+        
+        _apply_deadline(sock, deadline)
+        next_block, ancdata, _, _ = sock.recvmsg(
+            num_bytes - len(data), socket.CMSG_SPACE(fd_size)
+        )
+        
+        # Keep the first descriptor passed, close any others
+        for level, msg_type, msg_data in ancdata:
+            if level != socket.SOL_SOCKET or msg_type != socket.SCM_RIGHTS:
+                continue
+            fds = array.array("i")
+            fds.frombytes(msg_data[:len(msg_data) - len(msg_data) % fd_size])
+            for passed_fd in fds:
+                if fd is None:
+                    fd = passed_fd
+                else:
+                    os.close(passed_fd)
+        
+        if len(next_block) <= 0:
+            break
+        
+        data.extend(next_block)
+    
+    return data, fd
+
     
 def convert_portno_str(port_num):
     """Check that port number is a number is is in correct 
@@ -85,6 +183,37 @@ def convert_portno_str(port_num):
         error(BAD_PORT_NUMBER_ERR)
 
 
+def get_option(flag, default=None, convert=str):
+    """Looks for "--flag value" in the command line arguments.  
+    Returns convert(value), or default if the flag wasn't 
+    given.  Calls error() if value is missing or can't be 
+    converted."""
+    try:
+        index = sys.argv.index(flag)
+    except ValueError:
+        return default
+    
+    try:
+        return convert(sys.argv[index + 1].strip())
+    except (IndexError, ValueError):
+        error(BAD_OPTION_ERR.format(flag))
+
+
+def get_options(flag, convert=str):
+    """Like get_option(), but for a flag that may be given more 
+    than once.  Returns a list of every convert(value), in 
+    order."""
+    values = []
+    for index, arg in enumerate(sys.argv):
+        if arg != flag:
+            continue
+        try:
+            values.append(convert(sys.argv[index + 1].strip()))
+        except (IndexError, ValueError):
+            error(BAD_OPTION_ERR.format(flag))
+    return values
+
+
 def file_exists_locally(file_name):
     """Returns True if file_name exists AND it can be opened locally."""
     infile = None
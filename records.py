@@ -8,7 +8,18 @@ Each contain an OrderedDict that defines the format of their
 header.
 
 FileRequest creates an explicit bytearray of Header + FileName 
-which can then be sent over the network.
+which can then be sent over the network.  A FileRequest made 
+with flags has Type FILE_REQUEST_EXT_TYPE and a Flags byte 
+after the usual header (see FileRequest.EXT_HEADER_DICT), 
+followed by the fields of any flags that have them (see 
+FileRequest.FLAG_FIELDS).  Likewise a FileResponse made with 
+an mtime has Type FILE_RESPONSE_EXT_TYPE and Mtime and 
+FileSize fields after the usual header.  A FileResponse made 
+with checksum=True is followed by a CRC32 of its payload.
+
+ListRequest and ListResponse ask for and return a page of the 
+server's file index (path, size and mtime of each file), so a 
+client can find out what there is to fetch.
 
 FileResponse can also create an explicit bytearray of 
 Header + FileData, or can return Header + FileData in 
@@ -20,13 +31,14 @@ that it has a valid header, and read values from the header.
 
 The following is the inheritance tree.
 
-          Packet
-            |
-            V
-          Record
-          |    |
-          V    V
-FileRequest    FileResponse
+                  Packet
+                    |
+                    V
+                  Record
+       ___________|  |  |__________
+      |         |    |             |
+      V         V    V             V
+FileRequest  FileResponse  ListRequest  ListResponse
 
 """
 
@@ -35,6 +47,7 @@ import socket
 from packet import Packet
 import math
 import os
+import zlib
 
 BYTE_LEN = 8
 BLOCK_SIZE = 4096
@@ -42,10 +55,34 @@ ENCODING_TYPE = "UTF-8"
 
 FILE_REQUEST_MAGIC_NO = 0x497E
 FILE_REQUEST_TYPE = 1
+FILE_REQUEST_EXT_TYPE = 3
 MAX_FILENAME_LEN = 1024
 
+FLAG_KEEP_ALIVE = 0x01    # Server keeps the connection open after replying
+FLAG_PASS_FD = 0x02       # Over AF_UNIX, pass the open file, not its bytes
+FLAG_VALIDATE = 0x04      # Request carries the size and mtime of a cached copy
+FLAG_RANGE = 0x08         # Request is for Length bytes from Offset only
+FLAG_CHECKSUM = 0x10      # Response payload is followed by a CRC32 trailer
+FLAG_GLOB = 0x20          # ListRequest Pattern is a glob, not a prefix
+
 FILE_RESPONSE_MAGIC_NO = 0x497E
 FILE_RESPONSE_TYPE = 2
+FILE_RESPONSE_EXT_TYPE = 4
+
+LIST_REQUEST_TYPE = 5
+LIST_RESPONSE_TYPE = 6
+MAX_LIST_ENTRIES = 1000   # Most entries in one ListResponse
+
+STATUS_FILE_MISSING = 0   # File doesn't exist on the server
+STATUS_OK = 1             # File follows the header
+STATUS_OVERLOADED = 2     # Server is overloaded, retry later
+STATUS_FD_PASSED = 3      # File descriptor sent with the header, no payload
+STATUS_NOT_MODIFIED = 4   # The client's cached copy is current, no payload
+CHECKSUM_LEN = 4          # Bytes of the CRC32 trailer
+VALID_STATUS_CODES = (
+    STATUS_FILE_MISSING, STATUS_OK, STATUS_OVERLOADED, STATUS_FD_PASSED,
+    STATUS_NOT_MODIFIED
+)
 
 
 
@@ -63,6 +100,15 @@ class Record(Packet):
         self._append_header_dictionary(header_dict)
         self._append_payload(payload_bytes)
     
+    @staticmethod
+    def copy_header_dict(header_dict):
+        """Returns a copy of a class HEADER_DICT, so an instance 
+        can set its dynamic fields without changing the class 
+        (and so other threads building records)."""
+        return OrderedDict(
+            (name, list(field)) for name, field in header_dict.items()
+        )
+    
     def _append_header_dictionary(self, dictionary, in_network_order=True):
         """Helper function that takes an OrderedDict of values 
         (bit_len, value).  Adds each value to the internal 
@@ -103,7 +149,7 @@ class Record(Packet):
             value = network_to_host(bit_len, value)
             pkt_host.append(value, bit_len)
             
-            l_bit = r_bit + 1
+            l_bit = r_bit
         
         return pkt_host.get_bytearray()
     
@@ -124,6 +170,19 @@ class FileRequest(Record):
     "Type", 8
     "FilenameLen", 16
     ""
+    
+    If the request has any flags (FLAG_*) set, Type is 
+    FILE_REQUEST_EXT_TYPE and the header is EXT_HEADER_DICT, 
+    which is HEADER_DICT followed by:
+    "Flags", 8
+    So the first header_byte_len() bytes of either kind of 
+    request can be read and checked the same way.  Flags with 
+    fields of their own (FLAG_FIELDS) are followed by those 
+    fields, in the order of FLAG_FIELDS, before the filename:
+    FLAG_VALIDATE: "ValidSize", 32 and "ValidMtime", 32 
+    (the size and mtime, in seconds, of the client's copy)
+    FLAG_RANGE: "Offset", 32 and "Length", 32 
+    (the part of the file wanted)
     '''
     
     HEADER_DICT = OrderedDict((
@@ -132,10 +191,40 @@ class FileRequest(Record):
                 ("FilenameLen", [16, None]),
             ))    
     
-    def __init__(self, file_name):
-        """Takes a filename string."""        
+    EXT_HEADER_DICT = OrderedDict((
+                ("MagicNo", [16, FILE_REQUEST_MAGIC_NO]), 
+                ("Type", [8, FILE_REQUEST_EXT_TYPE]), 
+                ("FilenameLen", [16, None]),
+                ("Flags", [8, None]),
+            ))
+    
+    FLAG_FIELDS = OrderedDict((
+                (FLAG_VALIDATE, OrderedDict((
+                    ("ValidSize", [32, None]), 
+                    ("ValidMtime", [32, None]),
+                ))),
+                (FLAG_RANGE, OrderedDict((
+                    ("Offset", [32, None]), 
+                    ("Length", [32, None]),
+                ))),
+            ))
+    
+    def __init__(self, file_name, flags=0, fields=None):
+        """Takes a filename string, and optionally flags 
+        (FLAG_* or'ed together) and a dict of the values of 
+        their FLAG_FIELDS, by field name."""        
         file_name_bytes = file_name.encode(ENCODING_TYPE)
         
+        if flags:
+            self.HEADER_DICT = self.copy_header_dict(
+                FileRequest.EXT_HEADER_DICT
+            )
+            self.HEADER_DICT["Flags"][-1] = flags
+            for flag_dict in FileRequest._flag_field_dicts(flags):
+                for name, (bit_len, _) in flag_dict.items():
+                    self.HEADER_DICT[name] = [bit_len, fields[name]]
+        else:
+            self.HEADER_DICT = self.copy_header_dict(FileRequest.HEADER_DICT)
         self.HEADER_DICT["FilenameLen"][-1] = len(file_name_bytes)
         
         super().__init__(self.HEADER_DICT, file_name_bytes)
@@ -152,6 +241,82 @@ class FileRequest(Record):
         )
     
     
+    @staticmethod
+    def ext_header_to_host_byte_ord(packet_bytearray):
+        """Takes a bytearray.  Assumes the begining of 
+        packet_bytearray is an extended header (EXT_HEADER_DICT) 
+        in network byte order.  Returns a bytearray representing 
+        a header in host order."""
+        return Record.header_to_host_byte_ord(
+            packet_bytearray, FileRequest.EXT_HEADER_DICT
+        )
+    
+    
+    @staticmethod
+    def get_type_from_header(packet_bytearray):
+        """Takes a bytearray representing a FileRequest header.  
+        Returns the Type (FILE_REQUEST_TYPE or 
+        FILE_REQUEST_EXT_TYPE)."""
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        MagicNo_len = FileRequest.HEADER_DICT["MagicNo"][0]
+        Type_len = FileRequest.HEADER_DICT["Type"][0]
+        return pkt.get_from_bits(MagicNo_len, MagicNo_len+Type_len)
+    
+    
+    @staticmethod
+    def get_flags_from_ext_header(packet_bytearray):
+        """Takes a bytearray representing an extended FileRequest 
+        header (in host order).  Extracts the Flags."""
+        header_len = FileRequest.header_byte_len()
+        try:
+            return packet_bytearray[header_len]
+        except IndexError:
+            raise ValueError("Invalid FileRequest header")
+    
+    
+    @staticmethod
+    def _flag_field_dicts(flags):
+        """Returns the FLAG_FIELDS dicts of the flags set in 
+        flags, in order."""
+        return [
+            flag_dict for flag, flag_dict in FileRequest.FLAG_FIELDS.items()
+            if flags & flag
+        ]
+    
+    
+    @staticmethod
+    def flag_fields_byte_len(flags):
+        """Returns the len in bytes of the fields that follow the 
+        Flags byte for these flags."""
+        return math.ceil(sum(
+            bit_len for flag_dict in FileRequest._flag_field_dicts(flags)
+            for bit_len, _ in flag_dict.values()
+        ) / BYTE_LEN)
+    
+    
+    @staticmethod
+    def get_flag_fields(packet_bytearray, flags):
+        """Takes a bytearray of the fields that follow the Flags 
+        byte (in network byte order), and the flags.  Returns a 
+        dict of the field values by name."""
+        fields_dict = OrderedDict()
+        for flag_dict in FileRequest._flag_field_dicts(flags):
+            fields_dict.update(flag_dict)
+        if not fields_dict:
+            return {}
+        
+        host_bytearray = Record.header_to_host_byte_ord(
+            packet_bytearray, fields_dict
+        )
+        pkt = Packet(len(host_bytearray)*BYTE_LEN, host_bytearray)
+        fields = {}
+        l_bit = 0
+        for name, (bit_len, _) in fields_dict.items():
+            fields[name] = pkt.get_from_bits(l_bit, l_bit + bit_len)
+            l_bit += bit_len
+        return fields
+    
+    
     @staticmethod
     def get_filenameLen_from_header(packet_bytearray):
         """Takes a bytearray representing a FileRequest 
@@ -162,7 +327,7 @@ class FileRequest(Record):
             Type_len = FileRequest.HEADER_DICT["Type"][0]
             FilenameLen_len = FileRequest.HEADER_DICT["FilenameLen"][0]
             FilenameLen = pkt.get_from_bits(
-                1+MagicNo_len+Type_len, MagicNo_len+Type_len+FilenameLen_len
+                MagicNo_len+Type_len, MagicNo_len+Type_len+FilenameLen_len
             )
             return FilenameLen
         except IndexError:
@@ -174,7 +339,7 @@ class FileRequest(Record):
         """Takes a bytearray is checks if it is a valid FileRequest 
         header.  For the method to return True: 
         MagicNo == 0x497E, 
-        Type == 1, 
+        Type == 1 or Type == 3, 
         1 <= FilenameLen <= 1,024
         """
         is_valid = True
@@ -188,12 +353,12 @@ class FileRequest(Record):
         if MagicNo != FILE_REQUEST_MAGIC_NO:
             is_valid = False
         
-        Type = pkt.get_from_bits(1+MagicNo_len, MagicNo_len+Type_len)
-        if Type != FILE_REQUEST_TYPE:
+        Type = pkt.get_from_bits(MagicNo_len, MagicNo_len+Type_len)
+        if Type not in (FILE_REQUEST_TYPE, FILE_REQUEST_EXT_TYPE):
             is_valid = False
         
         FilenameLen = pkt.get_from_bits(
-            1+MagicNo_len+Type_len, MagicNo_len+Type_len+FilenameLen_len
+            MagicNo_len+Type_len, MagicNo_len+Type_len+FilenameLen_len
         )
         if not (1 <= FilenameLen <= MAX_FILENAME_LEN):
             is_valid = False
@@ -215,6 +380,13 @@ class FileRequest(Record):
     def header_byte_len():
         """Returns the len of the header in bits."""
         return math.ceil(FileRequest.header_bit_len() / BYTE_LEN)    
+    
+    @staticmethod
+    def ext_header_byte_len():
+        """Returns the len of the extended header in bytes."""
+        return math.ceil(sum(
+            bit_len for bit_len, _ in FileRequest.EXT_HEADER_DICT.values()
+        ) / BYTE_LEN)
 
 
 class FileResponse(Record):
@@ -234,6 +406,37 @@ class FileResponse(Record):
     "DataLen", 32
     ""
     
+    A FileResponse made with an mtime has Type 
+    FILE_RESPONSE_EXT_TYPE and the header is EXT_HEADER_DICT, 
+    which is HEADER_DICT followed by:
+    "Mtime", 32
+    "FileSize", 32
+    (the mtime of the file on the server, in seconds, and the 
+    size of the whole file).  It is sent in reply to a 
+    FileRequest with FLAG_VALIDATE or FLAG_RANGE.  If the 
+    ValidSize and ValidMtime of the request match the file, 
+    the StatusCode is STATUS_NOT_MODIFIED and no payload follows.
+    
+    A FileResponse made with an offset and length has only that 
+    part of the file as its payload, and DataLen is the number 
+    of bytes of it (less than length if the file ends first).
+    
+    A FileResponse made with checksum=True (in reply to a 
+    FileRequest with FLAG_CHECKSUM) and StatusCode STATUS_OK 
+    has a trailer after the payload, even an empty one:
+    "Checksum", 32
+    (the zlib.crc32() of the payload).  It is computed as the 
+    blocks are read, so the file is only read once, and sent at 
+    the end of the last block rather than on its own.  If the 
+    file turns out shorter than DataLen, the trailer isn't 
+    sent and .truncated is set, and the server has to close the 
+    connection for the client to see that the payload is short.
+    
+    A STATUS_FD_PASSED response is only sent over an AF_UNIX 
+    socket, with the open file passed alongside the header 
+    (SCM_RIGHTS).  DataLen is then the size of that file, and 
+    no payload follows.
+    
     FileResponse is initialized with a file_name and a status 
     code.  Unlike FileRequest, FileResponse does not read 
     the payload into memory.  If .get_bytearray() is called, 
@@ -254,17 +457,50 @@ class FileResponse(Record):
             ("DataLen", [32, None]),
         ))
     
+    EXT_HEADER_DICT = OrderedDict((
+            ("MagicNo", [16, FILE_RESPONSE_MAGIC_NO]), 
+            ("Type", [8, FILE_RESPONSE_EXT_TYPE]), 
+            ("StatusCode", [8, None]),
+            ("DataLen", [32, None]),
+            ("Mtime", [32, None]),
+            ("FileSize", [32, None]),
+        ))
+    
     
-    def __init__(self, file_name, status_code):
-        """Takes a bytearray that containing a file, and a 
-        integer status_code.  If status_code == 0 then 
-        no payload is written to the packet."""
+    def __init__(self, file_name, status_code, mtime=None, offset=0, 
+                 length=None, checksum=False):
+        """Takes a file name, and a integer status_code.  If 
+        status_code != STATUS_OK then no payload is written to 
+        the packet, and DataLen is 0 (or the size of the file 
+        for STATUS_FD_PASSED).  If mtime (seconds) is given the 
+        header is extended with it and the file's size.  The 
+        payload is the length bytes from offset (default the 
+        whole file), followed by its CRC32 if checksum."""
         self.file_name = file_name
+        self.offset = offset
+        self.checksum = checksum and status_code == STATUS_OK
         self.bytes_read = 0
-        self.HEADER_DICT["StatusCode"][-1] = status_code
+        self.truncated = False    # File ended before DataLen
         try:
-            self.HEADER_DICT["DataLen"][-1] = os.path.getsize(file_name)
-        except FileNotFoundError:
+            file_size = os.path.getsize(file_name)
+        except OSError:
+            file_size = 0
+        
+        if mtime is not None:
+            self.HEADER_DICT = self.copy_header_dict(
+                FileResponse.EXT_HEADER_DICT
+            )
+            self.HEADER_DICT["Mtime"][-1] = mtime
+            self.HEADER_DICT["FileSize"][-1] = file_size
+        else:
+            self.HEADER_DICT = self.copy_header_dict(FileResponse.HEADER_DICT)
+        self.HEADER_DICT["StatusCode"][-1] = status_code
+        if status_code in (STATUS_OK, STATUS_FD_PASSED):
+            data_len = max(file_size - offset, 0)
+            if length is not None:
+                data_len = min(data_len, length)
+            self.HEADER_DICT["DataLen"][-1] = data_len
+        else:
             self.HEADER_DICT["DataLen"][-1] = 0
         
         super().__init__(self.HEADER_DICT, bytearray())
@@ -281,6 +517,57 @@ class FileResponse(Record):
         )
     
     
+    @staticmethod
+    def ext_header_to_host_byte_ord(packet_bytearray):
+        """Takes a bytearray.  Assumes the begining of 
+        packet_bytearray is an extended header (EXT_HEADER_DICT) 
+        in network byte order.  Returns a bytearray representing 
+        a header in host order."""
+        return Record.header_to_host_byte_ord(
+            packet_bytearray, FileResponse.EXT_HEADER_DICT
+        )
+    
+    
+    @staticmethod
+    def get_type_from_header(packet_bytearray):
+        """Takes a bytearray representing a FileResponse header.  
+        Returns the Type (FILE_RESPONSE_TYPE or 
+        FILE_RESPONSE_EXT_TYPE)."""
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        MagicNo_len = FileResponse.HEADER_DICT["MagicNo"][0]
+        Type_len = FileResponse.HEADER_DICT["Type"][0]
+        return pkt.get_from_bits(MagicNo_len, MagicNo_len+Type_len)
+    
+    
+    @staticmethod
+    def get_mtime_from_ext_header(packet_bytearray):
+        """Takes a bytearray representing an extended FileResponse 
+        header (in host order).  Extracts the Mtime."""
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        header_len = FileResponse.header_bit_len()
+        Mtime_len = FileResponse.EXT_HEADER_DICT["Mtime"][0]
+        try:
+            return pkt.get_from_bits(header_len, header_len + Mtime_len)
+        except IndexError:
+            raise ValueError("Invalid FileResponse header")
+    
+    
+    @staticmethod
+    def get_file_size_from_ext_header(packet_bytearray):
+        """Takes a bytearray representing an extended FileResponse 
+        header (in host order).  Extracts the FileSize."""
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        FileSize_start = FileResponse.header_bit_len() + \
+            FileResponse.EXT_HEADER_DICT["Mtime"][0]
+        FileSize_len = FileResponse.EXT_HEADER_DICT["FileSize"][0]
+        try:
+            return pkt.get_from_bits(
+                FileSize_start, FileSize_start + FileSize_len
+            )
+        except IndexError:
+            raise ValueError("Invalid FileResponse header")
+    
+    
     @staticmethod
     def get_status_DataLen(packet_bytearray):
         """Takes a bytearray representing a FileRequest 
@@ -292,11 +579,11 @@ class FileResponse(Record):
             StatusCode_len = FileResponse.HEADER_DICT["StatusCode"][0]
             DataLen_len = FileResponse.HEADER_DICT["DataLen"][0]
             StatusCode = pkt.get_from_bits(
-                1 + MagicNo_len + Type_len, 
+                MagicNo_len + Type_len, 
                 MagicNo_len + Type_len + StatusCode_len
             )
             DataLen = pkt.get_from_bits(
-                1 + MagicNo_len + Type_len + StatusCode_len, 
+                MagicNo_len + Type_len + StatusCode_len, 
                 MagicNo_len + Type_len + StatusCode_len + DataLen_len
             )
             return StatusCode, DataLen
@@ -304,6 +591,29 @@ class FileResponse(Record):
             raise ValueError("Invalid FileRequest header")
     
     
+    @staticmethod
+    def checksum_trailer(crc):
+        """Takes a zlib.crc32() value.  Returns the trailer that 
+        carries it, in network byte order."""
+        pkt = Packet(CHECKSUM_LEN * BYTE_LEN)
+        pkt.append(host_to_network(CHECKSUM_LEN * BYTE_LEN, crc), 
+                   CHECKSUM_LEN * BYTE_LEN)
+        return pkt.get_bytearray()
+    
+    
+    @staticmethod
+    def get_checksum_from_trailer(packet_bytearray):
+        """Takes the bytearray of a trailer (in network byte 
+        order).  Extracts the Checksum."""
+        if len(packet_bytearray) < CHECKSUM_LEN:
+            raise ValueError("Invalid FileResponse trailer")
+        pkt = Packet(CHECKSUM_LEN * BYTE_LEN, packet_bytearray)
+        return network_to_host(
+            CHECKSUM_LEN * BYTE_LEN, 
+            pkt.get_from_bits(0, CHECKSUM_LEN * BYTE_LEN)
+        )
+    
+    
     def read_byte_block(self):
         """A generator that opens a file handle 
         on file_name and returns an amount of bytes equal to 
@@ -325,9 +635,11 @@ class FileResponse(Record):
                 infile = None
             
             if infile is not None and (
-                self.HEADER_DICT["StatusCode"][-1] != 1 or \
+                self.HEADER_DICT["StatusCode"][-1] != STATUS_OK or \
                 self.HEADER_DICT["DataLen"][-1] == 0):
                 infile.seek(0, 2)  # Move file handle to EOF (Don't send file)
+            elif infile is not None:
+                infile.seek(self.offset)
             
             # Yeilds blocks of data
             yield from self._yield_blocks(infile, header_bytearray)
@@ -340,26 +652,46 @@ class FileResponse(Record):
     def _yield_blocks(self, infile, header_bytearray):
         """Helper method of self.read_byte_block().  Takes a file 
         handle and the bytearray of the header.  Yields a 
-        block of bytes equal to (or less than) BLOCK_SIZE."""
+        block of bytes equal to (or less than) BLOCK_SIZE.  Stops 
+        after DataLen bytes of the file, even if it has grown.  
+        The checksum trailer, if there is one, is added to the 
+        end of the last block.  Sets self.truncated if the file 
+        ends before DataLen."""
         header_len = len(header_bytearray)
+        total_len = header_len
+        if self.HEADER_DICT["StatusCode"][-1] == STATUS_OK:
+            total_len += self.HEADER_DICT["DataLen"][-1]
+        crc = 0
+        self.truncated = False
         while True:
+            block_len = min(BLOCK_SIZE, total_len - self.bytes_read)
             # Take a slice of the header, max of BLOCK_SIZE
             data_block = header_bytearray[self.bytes_read : min(
-                header_len, self.bytes_read + BLOCK_SIZE)]
+                header_len, self.bytes_read + block_len)]
             # If there is a file to be read, fill the rest of data_block
-            if infile is not None:
-                data_block.extend(infile.read(BLOCK_SIZE - len(data_block)))
+            if infile is not None and len(data_block) < block_len:
+                file_bytes = infile.read(block_len - len(data_block))
+                if self.checksum:
+                    crc = zlib.crc32(file_bytes, crc)
+                data_block.extend(file_bytes)
             
             self.bytes_read += len(data_block)  # Incrementor
             
             if not len(data_block) > 0:
+                self.truncated = self.bytes_read < total_len
                 break
             
-            yield data_block
-        
-        raise StopIteration("Reached EOF.")        
+            # Only vouch for a payload that was sent in full
+            if self.checksum and self.bytes_read == total_len:
+                trailer = FileResponse.checksum_trailer(crc)
+                self.bytes_read += len(trailer)
+                data_block.extend(trailer)
+                yield data_block
+                break
             
-        
+            yield data_block
+    
+    
     
     def get_bytearray(self):
         """Reads the whole file into memory and returns a 
@@ -367,13 +699,20 @@ class FileResponse(Record):
         file_response_data = super().get_bytearray()  # Add Header
         
         # If bad StatusCode or file doesen't exist return just the header
-        if self.HEADER_DICT["StatusCode"][-1] != 1 or \
-           self.HEADER_DICT["DataLen"][-1] == 0 or \
+        if self.HEADER_DICT["StatusCode"][-1] != STATUS_OK or \
            not os.path.exists(self.file_name):
             return file_response_data
         
-        with open(self.file_name, 'rb') as infile:
-            file_response_data.extend(infile.read())   # Add Payload
+        payload = b""
+        if self.HEADER_DICT["DataLen"][-1] > 0:
+            with open(self.file_name, 'rb') as infile:
+                infile.seek(self.offset)
+                payload = infile.read(self.HEADER_DICT["DataLen"][-1])
+        file_response_data.extend(payload)   # Add Payload
+        if self.checksum:
+            file_response_data.extend(
+                FileResponse.checksum_trailer(zlib.crc32(payload))
+            )
         
         self.bytes_read = len(file_response_data)
         return file_response_data
@@ -384,8 +723,8 @@ class FileResponse(Record):
         """Takes a bytearray is checks if it is a valid FileResponse 
         header.  For the method to return True: 
         MagicNo == 0x497E, 
-        Type == 2, 
-        StatusCode == 0 or StatusCode == 1
+        Type == 2 or Type == 4, 
+        StatusCode in VALID_STATUS_CODES
         """
         pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
         
@@ -396,19 +735,19 @@ class FileResponse(Record):
         
         MagicNo = pkt.get_from_bits(0, MagicNo_len)
         
-        Type = pkt.get_from_bits(1+MagicNo_len, MagicNo_len+Type_len)
+        Type = pkt.get_from_bits(MagicNo_len, MagicNo_len+Type_len)
         
         StatusCode = pkt.get_from_bits(
-            1 + MagicNo_len + Type_len, 
+            MagicNo_len + Type_len, 
             MagicNo_len + Type_len + StatusCode_len
         )
         
         is_valid = True
         if MagicNo != FILE_RESPONSE_MAGIC_NO:
             is_valid = False
-        elif Type != FILE_RESPONSE_TYPE:
+        elif Type not in (FILE_RESPONSE_TYPE, FILE_RESPONSE_EXT_TYPE):
             is_valid = False        
-        elif not (StatusCode == 0 or StatusCode == 1):
+        elif StatusCode not in VALID_STATUS_CODES:
             is_valid = False
         
         return is_valid
@@ -429,6 +768,287 @@ class FileResponse(Record):
     def header_byte_len():
         """Returns the len of the header in bits."""
         return math.ceil(FileResponse.header_bit_len() / BYTE_LEN)    
+    
+    
+    @staticmethod
+    def ext_header_byte_len():
+        """Returns the len of the extended header in bytes."""
+        return math.ceil(sum(
+            bit_len for bit_len, _ in FileResponse.EXT_HEADER_DICT.values()
+        ) / BYTE_LEN)
+
+
+
+class ListRequest(Record):
+    '''An object that creates a bytearray representing a 
+    ListRequest, which asks for a page of the server's file 
+    index.  The payload is the Pattern (PatternLen bytes) 
+    followed by the After path (AfterLen bytes).  Includes 
+    static methods for checking the validity of a recieved 
+    ListRequest and extracting its fields.
+    
+    By length in bits, a ListRequest header has the following 
+    fields:
+    "MagicNo", 16
+    "Type", 8
+    "PatternLen", 16
+    "Flags", 8
+    "AfterLen", 16
+    "MaxEntries", 16
+    ""
+    
+    The first three fields are laid out as in a FileRequest, so 
+    the server can read the first FileRequest.header_byte_len() 
+    bytes of any request and tell them apart by Type.
+    
+    The files listed are those whose paths start with Pattern, 
+    or with FLAG_GLOB set match Pattern as a glob (see 
+    fnmatch).  An empty Pattern lists every file.  Paths come 
+    in sorted order, starting after the path After (empty for 
+    the first page), and at most MaxEntries of them (0 for as 
+    many as the server allows, and never more than 
+    MAX_LIST_ENTRIES).  FLAG_KEEP_ALIVE works as for 
+    a FileRequest, so every page can be asked for on one 
+    connection.
+    '''
+    
+    HEADER_DICT = OrderedDict((
+                ("MagicNo", [16, FILE_REQUEST_MAGIC_NO]), 
+                ("Type", [8, LIST_REQUEST_TYPE]), 
+                ("PatternLen", [16, None]),
+                ("Flags", [8, None]),
+                ("AfterLen", [16, None]),
+                ("MaxEntries", [16, None]),
+            ))
+    
+    def __init__(self, pattern="", flags=0, after="", 
+                 max_entries=MAX_LIST_ENTRIES):
+        """Takes a pattern string, flags (FLAG_* or'ed together), 
+        the path to list after and the most entries wanted."""
+        pattern_bytes = pattern.encode(ENCODING_TYPE)
+        after_bytes = after.encode(ENCODING_TYPE)
+        
+        self.HEADER_DICT = self.copy_header_dict(ListRequest.HEADER_DICT)
+        self.HEADER_DICT["PatternLen"][-1] = len(pattern_bytes)
+        self.HEADER_DICT["Flags"][-1] = flags
+        self.HEADER_DICT["AfterLen"][-1] = len(after_bytes)
+        self.HEADER_DICT["MaxEntries"][-1] = max_entries
+        
+        super().__init__(self.HEADER_DICT, pattern_bytes + after_bytes)
+    
+    
+    @staticmethod
+    def header_to_host_byte_ord(packet_bytearray):
+        """Takes a bytearray.  Assumes the begining of 
+        packet_bytearray is a header in network byte order.  
+        Returns a bytearray representing a header in 
+        host order."""
+        return Record.header_to_host_byte_ord(
+            packet_bytearray, ListRequest.HEADER_DICT
+        )
+    
+    
+    @staticmethod
+    def get_fields_from_header(packet_bytearray):
+        """Takes a bytearray representing a ListRequest header 
+        (in host order).  Returns a dict of PatternLen, Flags, 
+        AfterLen and MaxEntries."""
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        fields = {}
+        l_bit = 0
+        try:
+            for name, (bit_len, _) in ListRequest.HEADER_DICT.items():
+                if name not in ("MagicNo", "Type"):
+                    fields[name] = pkt.get_from_bits(l_bit, l_bit + bit_len)
+                l_bit += bit_len
+        except IndexError:
+            raise ValueError("Invalid ListRequest header")
+        return fields
+    
+    
+    @staticmethod
+    def is_valid_header(packet_bytearray):
+        """Takes a bytearray is checks if it is a valid ListRequest 
+        header.  For the method to return True: 
+        MagicNo == 0x497E, 
+        Type == 5, 
+        PatternLen <= 1,024, 
+        AfterLen <= 1,024
+        """
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        MagicNo_len = ListRequest.HEADER_DICT["MagicNo"][0]
+        Type_len = ListRequest.HEADER_DICT["Type"][0]
+        
+        MagicNo = pkt.get_from_bits(0, MagicNo_len)
+        Type = pkt.get_from_bits(MagicNo_len, MagicNo_len+Type_len)
+        try:
+            fields = ListRequest.get_fields_from_header(packet_bytearray)
+        except ValueError:
+            return False
+        
+        return MagicNo == FILE_REQUEST_MAGIC_NO and \
+            Type == LIST_REQUEST_TYPE and \
+            fields["PatternLen"] <= MAX_FILENAME_LEN and \
+            fields["AfterLen"] <= MAX_FILENAME_LEN
+    
+    
+    @staticmethod
+    def header_byte_len():
+        """Returns the len of the header in bytes."""
+        return math.ceil(sum(
+            bit_len for bit_len, _ in ListRequest.HEADER_DICT.values()
+        ) / BYTE_LEN)
+
+
+class ListResponse(Record):
+    '''An object that creates a bytearray representing a 
+    ListResponse, one page of the server's file index.  
+    Includes static methods for checking the validity of a 
+    recieved ListResponse and reading its header and entries.
+    
+    By length in bits, a ListResponse header has the following 
+    fields:
+    "MagicNo", 16
+    "Type", 8
+    "StatusCode", 8
+    "NumEntries", 16
+    "More", 8
+    ""
+    
+    More is 1 if there are files after the last one in this 
+    page (ask again with it as After), else 0.  The header is 
+    followed by NumEntries entries, each an ENTRY_DICT:
+    "Size", 32
+    "Mtime", 32
+    "PathLen", 16
+    followed by the path (PathLen bytes).  Size and Mtime are 
+    as in an extended FileResponse.
+    '''
+    
+    HEADER_DICT = OrderedDict((
+            ("MagicNo", [16, FILE_RESPONSE_MAGIC_NO]), 
+            ("Type", [8, LIST_RESPONSE_TYPE]), 
+            ("StatusCode", [8, None]),
+            ("NumEntries", [16, None]),
+            ("More", [8, None]),
+        ))
+    
+    ENTRY_DICT = OrderedDict((
+            ("Size", [32, None]), 
+            ("Mtime", [32, None]), 
+            ("PathLen", [16, None]),
+        ))
+    
+    
+    def __init__(self, entries, more=False, status_code=STATUS_OK):
+        """Takes a list of (path, size, mtime) tuples, whether 
+        there are more files after them, and the StatusCode."""
+        self.HEADER_DICT = self.copy_header_dict(ListResponse.HEADER_DICT)
+        self.HEADER_DICT["StatusCode"][-1] = status_code
+        self.HEADER_DICT["NumEntries"][-1] = len(entries)
+        self.HEADER_DICT["More"][-1] = int(more)
+        self.entries = entries
+        
+        super().__init__(self.HEADER_DICT, bytearray())
+    
+    
+    def get_bytearray(self):
+        """Returns a bytearray of header + entries."""
+        list_response_data = super().get_bytearray()  # Add Header
+        for path, size, mtime in self.entries:
+            path_bytes = path.encode(ENCODING_TYPE)
+            entry_dict = self.copy_header_dict(ListResponse.ENTRY_DICT)
+            entry_dict["Size"][-1] = size
+            entry_dict["Mtime"][-1] = mtime
+            entry_dict["PathLen"][-1] = len(path_bytes)
+            list_response_data.extend(Record(entry_dict, b"").get_bytearray())
+            list_response_data.extend(path_bytes)
+        return list_response_data
+    
+    
+    @staticmethod
+    def header_to_host_byte_ord(packet_bytearray):
+        """Takes a bytearray.  Assumes the begining of 
+        packet_bytearray is a header in network byte order.  
+        Returns a bytearray representing a header in 
+        host order."""
+        return Record.header_to_host_byte_ord(
+            packet_bytearray, ListResponse.HEADER_DICT
+        )
+    
+    
+    @staticmethod
+    def get_status_NumEntries_More(packet_bytearray):
+        """Takes a bytearray representing a ListResponse header 
+        (in host order).  Returns (StatusCode, NumEntries, More)."""
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        values = []
+        l_bit = 0
+        try:
+            for name, (bit_len, _) in ListResponse.HEADER_DICT.items():
+                if name not in ("MagicNo", "Type"):
+                    values.append(pkt.get_from_bits(l_bit, l_bit + bit_len))
+                l_bit += bit_len
+        except IndexError:
+            raise ValueError("Invalid ListResponse header")
+        return tuple(values)
+    
+    
+    @staticmethod
+    def get_entry_fields(packet_bytearray):
+        """Takes a bytearray of an entry header, in network byte 
+        order.  Returns (Size, Mtime, PathLen)."""
+        host_bytearray = Record.header_to_host_byte_ord(
+            packet_bytearray, ListResponse.ENTRY_DICT
+        )
+        pkt = Packet(len(host_bytearray)*BYTE_LEN, host_bytearray)
+        values = []
+        l_bit = 0
+        for bit_len, _ in ListResponse.ENTRY_DICT.values():
+            values.append(pkt.get_from_bits(l_bit, l_bit + bit_len))
+            l_bit += bit_len
+        return tuple(values)
+    
+    
+    @staticmethod
+    def is_valid_header(packet_bytearray):
+        """Takes a bytearray is checks if it is a valid ListResponse 
+        header.  For the method to return True: 
+        MagicNo == 0x497E, 
+        Type == 6, 
+        StatusCode in VALID_STATUS_CODES
+        """
+        pkt = Packet(len(packet_bytearray)*BYTE_LEN, packet_bytearray)
+        MagicNo_len = ListResponse.HEADER_DICT["MagicNo"][0]
+        Type_len = ListResponse.HEADER_DICT["Type"][0]
+        StatusCode_len = ListResponse.HEADER_DICT["StatusCode"][0]
+        
+        MagicNo = pkt.get_from_bits(0, MagicNo_len)
+        Type = pkt.get_from_bits(MagicNo_len, MagicNo_len+Type_len)
+        StatusCode = pkt.get_from_bits(
+            MagicNo_len + Type_len, 
+            MagicNo_len + Type_len + StatusCode_len
+        )
+        
+        return MagicNo == FILE_RESPONSE_MAGIC_NO and \
+            Type == LIST_RESPONSE_TYPE and \
+            StatusCode in VALID_STATUS_CODES
+    
+    
+    @staticmethod
+    def header_byte_len():
+        """Returns the len of the header in bytes."""
+        return math.ceil(sum(
+            bit_len for bit_len, _ in ListResponse.HEADER_DICT.values()
+        ) / BYTE_LEN)
+    
+    
+    @staticmethod
+    def entry_header_byte_len():
+        """Returns the len of an entry header in bytes."""
+        return math.ceil(sum(
+            bit_len for bit_len, _ in ListResponse.ENTRY_DICT.values()
+        ) / BYTE_LEN)
 
 
 
@@ -0,0 +1,84 @@
+"""Admission control for the server.  
+
+Limits how much work the server takes on at once, so that under 
+overload clients get a fast, header-only FileResponse with 
+StatusCode STATUS_OVERLOADED (and can back off or try another 
+server) rather than queueing unboundedly in the kernel listen 
+backlog until they time out.
+
+There are two points of admission:
+  1. accept(): a connection is refused if MAX_CONNECTIONS are 
+     already open.  The rejection is sent without reading the 
+     request.
+  2. After the FileRequest is read: the transfer is refused if 
+     MAX_IN_FLIGHT_TRANSFERS are already being sent, or if its 
+     DataLen would take the bytes in flight over 
+     MAX_BYTES_IN_FLIGHT.  A transfer is always admitted when 
+     nothing else is in flight, so a file larger than 
+     MAX_BYTES_IN_FLIGHT can still be served.
+"""
+
+import threading
+
+LISTEN_BACKLOG = 128                  # Kernel accept queue length
+MAX_CONNECTIONS = 64                  # Open client connections
+MAX_IN_FLIGHT_TRANSFERS = 32          # FileResponses being sent
+MAX_BYTES_IN_FLIGHT = 512 * 1024**2   # Sum of DataLen being sent
+
+
+class AdmissionControl(object):
+    """Thread safe counters of open connections, in-flight 
+    transfers and bytes in flight, checked against the limits 
+    given to the constructor."""
+    
+    def __init__(self, max_connections=MAX_CONNECTIONS, 
+                 max_transfers=MAX_IN_FLIGHT_TRANSFERS, 
+                 max_bytes=MAX_BYTES_IN_FLIGHT):
+        self.max_connections = max_connections
+        self.max_transfers = max_transfers
+        self.max_bytes = max_bytes
+        
+        self.connections = 0
+        self.transfers = 0
+        self.bytes_in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+    
+    
+    def try_open_connection(self):
+        """Returns True and counts the connection if there is 
+        room for another open connection, else returns False."""
+        with self._lock:
+            if self.connections >= self.max_connections:
+                self.rejected += 1
+                return False
+            self.connections += 1
+            return True
+    
+    
+    def close_connection(self):
+        """Uncounts a connection opened by try_open_connection()."""
+        with self._lock:
+            self.connections -= 1
+    
+    
+    def try_admit(self, num_bytes):
+        """Takes the DataLen of a transfer.  Returns True and 
+        counts the transfer if it fits within the limits, else 
+        returns False."""
+        with self._lock:
+            if self.transfers > 0 and (
+                self.transfers >= self.max_transfers or 
+                self.bytes_in_flight + num_bytes > self.max_bytes):
+                self.rejected += 1
+                return False
+            self.transfers += 1
+            self.bytes_in_flight += num_bytes
+            return True
+    
+    
+    def release(self, num_bytes):
+        """Uncounts a transfer admitted by try_admit()."""
+        with self._lock:
+            self.transfers -= 1
+            self.bytes_in_flight -= num_bytes
@@ -0,0 +1,199 @@
+"""An in-memory index of the files the server serves, for
+answering ListRequests.
+
+The index holds the path, size and mtime of every regular file
+under the served directory, in sorted order.  It is built when
+the FileIndex is made and kept up to date by a background thread
+that rescans every rescan_interval seconds.  Each rescan only
+lists the directories whose mtime has changed since the last
+one (so files have been added, removed or renamed in them), and
+only stats the files in the others, so a rescan of a large
+unchanged tree costs no directory reads.  The new index is
+swapped in whole, so a listing never sees half a rescan.  Files
+whose paths aren't valid ENCODING_TYPE (names the filesystem
+holds as other bytes) are left out, as a ListResponse can't
+carry them and a client couldn't ask for them.
+
+A listing is found with a binary search for the first path after
+the client's After path (and at or past the literal start of the
+pattern), so each page costs about the same however far into a
+large listing it is.
+
+Like TransferLog, a forked worker process (see prefork.py) starts
+its own rescan thread the first time it lists files.
+"""
+
+from bisect import bisect_left, bisect_right
+import fnmatch
+import os
+import stat
+import threading
+import time
+from records import ENCODING_TYPE
+
+RESCAN_INTERVAL = 30.0    # Seconds between rescans of the served tree
+MAX_FIELD = 0xFFFFFFFF    # Largest Size or Mtime a ListResponse holds
+
+GLOB_CHARS = "*?["
+
+
+class FileIndex(object):
+    """A sorted index of (path, size, mtime) for every file under
+    root, rescanned in the background.  Thread safe."""
+    
+    def __init__(self, root=".", rescan_interval=RESCAN_INTERVAL):
+        self.root = root
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._dirs = {}       # directory -> (mtime, sub_dirs, file_names)
+        self._paths = []      # Sorted paths
+        self._entries = {}    # path -> (size, mtime)
+        self.rescan()
+    
+    
+    def __len__(self):
+        return len(self._paths)
+    
+    
+    def list(self, pattern="", glob=False, after="", max_entries=None):
+        """Returns (entries, more): up to max_entries
+        (path, size, mtime) tuples, in path order, of the files
+        after the path after that start with pattern (or with
+        glob, match it), and whether there are more after them."""
+        self._start()
+        with self._lock:
+            paths, entries = self._paths, self._entries
+        
+        # Only paths starting with the literal part can match
+        prefix = pattern
+        if glob:
+            prefix = literal_prefix(pattern)
+        if after >= prefix:
+            start = bisect_right(paths, after)
+        else:
+            start = bisect_left(paths, prefix)
+        
+        found = []
+        for i in range(start, len(paths)):
+            path = paths[i]
+            if not path.startswith(prefix):
+                break
+            if glob and not fnmatch.fnmatchcase(path, pattern):
+                continue
+            if max_entries is not None and len(found) >= max_entries:
+                return found, True
+            size, mtime = entries[path]
+            found.append((path, size, mtime))
+        return found, False
+    
+    
+    def rescan(self):
+        """Brings the index up to date with the served tree."""
+        old_dirs = self._dirs
+        new_dirs = {}
+        entries = {}
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            try:
+                dir_mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            
+            # Unchanged directories have the same names in them
+            cached = old_dirs.get(directory)
+            if cached is not None and cached[0] == dir_mtime:
+                sub_dirs, file_names = cached[1], cached[2]
+            else:
+                sub_dirs, file_names = list_directory(directory)
+            new_dirs[directory] = (dir_mtime, sub_dirs, file_names)
+            pending.extend(sub_dirs)
+            
+            for file_name in file_names:
+                try:
+                    st = os.stat(file_name)
+                except OSError:
+                    continue
+                path = self._served_path(file_name)
+                if stat.S_ISREG(st.st_mode) and can_encode(path):
+                    entries[path] = (
+                        min(st.st_size, MAX_FIELD),
+                        int(st.st_mtime) & MAX_FIELD
+                    )
+        
+        paths = sorted(entries)
+        with self._lock:
+            self._dirs = new_dirs
+            self._paths = paths
+            self._entries = entries
+    
+    
+    def _served_path(self, file_name):
+        """Returns file_name as a client would ask for it."""
+        path = os.path.relpath(file_name, self.root)
+        if os.sep != "/":
+            path = path.replace(os.sep, "/")
+        return path
+    
+    
+    def _start(self):
+        """Starts the rescan thread if this process hasn't yet."""
+        if self._pid == os.getpid() or self.rescan_interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(
+                target=self._rescan_forever, daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+    
+    
+    def _rescan_forever(self):
+        """The rescan thread."""
+        while True:
+            time.sleep(self.rescan_interval)
+            self.rescan()
+
+
+def list_directory(directory):
+    """Returns (sub_dirs, file_names), the paths of the
+    directories (not followed if they are symlinks) and of
+    everything else in directory."""
+    sub_dirs = []
+    file_names = []
+    try:
+        with os.scandir(directory) as it:
+            for dir_entry in it:
+                try:
+                    is_dir = dir_entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    sub_dirs.append(dir_entry.path)
+                else:
+                    file_names.append(dir_entry.path)
+    except OSError:
+        pass
+    return sub_dirs, file_names
+
+
+def can_encode(path):
+    """Returns True if path can be sent as ENCODING_TYPE."""
+    try:
+        path.encode(ENCODING_TYPE)
+        return True
+    except UnicodeEncodeError:
+        return False
+
+
+def literal_prefix(pattern):
+    """Returns the part of the glob pattern before its first
+    wildcard."""
+    for i, char in enumerate(pattern):
+        if char in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
@@ -0,0 +1,175 @@
+"""Pre-fork worker processes for the server.
+
+run_workers() forks num_workers worker processes, each running
+its own accept loop, so that request parsing and block sending
+use every core rather than the one the GIL allows.
+
+Where the platform has SO_REUSEPORT each worker binds its own
+listening socket to the same port, and the kernel spreads new
+connections across them.  Otherwise the supervisor creates one
+listening socket before forking and every worker accepts on it.
+
+The supervisor (the original process) only watches its workers.
+A worker that exits is replaced.  If a worker dies within
+MIN_WORKER_LIFETIME, the replacement is started after
+RESTART_DELAY, and after MAX_QUICK_FAILURES of those in a row
+the supervisor gives up.  SIGTERM or SIGINT stops every worker
+and then the supervisor, and SIGHUP is passed on to the workers.
+A worker stops on SIGTERM by raising SystemExit out of worker(),
+so it stops accepting and runs worker()'s own clean up (the
+server writes out its transfer log) before it exits.  A worker
+ignores SIGHUP until worker() sets its own handler.
+
+Each worker has its own AdmissionControl, scheduler and Shaper,
+so the limits set on the command line apply to every worker
+separately.
+"""
+
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+MIN_WORKER_LIFETIME = 1.0    # Seconds a worker must run to be healthy
+RESTART_DELAY = 1.0          # Seconds before replacing an unhealthy worker
+MAX_QUICK_FAILURES = 5       # Unhealthy workers in a row before giving up
+
+WORKER_EXITED_MESSAGE = "Worker {} exited with status {}, restarting it."
+WORKERS_FAILING_ERR = "ERROR workers keep failing, shutting down."
+NO_FORK_ERR = "ERROR --workers needs a platform with fork()."
+
+WORKER_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP} \
+    if hasattr(signal, "SIGHUP") else set()
+
+
+def can_reuse_port():
+    """Returns True if listening sockets can share a port with
+    SO_REUSEPORT."""
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+def _start_worker(make_socket, worker, shared_socket):
+    """Forks a worker process.  The child runs
+    worker(server_socket) and never returns from here.  Returns
+    the child's pid to the supervisor."""
+    sys.stdout.flush()
+    # Signals wait until the child has its own handlers
+    signal.pthread_sigmask(signal.SIG_BLOCK, WORKER_SIGNALS)
+    try:
+        pid = os.fork()
+    except OSError:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, WORKER_SIGNALS)
+        raise
+    if pid != 0:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, WORKER_SIGNALS)
+        return pid
+    
+    # In the worker process
+    exit_code = 1
+    try:
+        signal.signal(signal.SIGTERM, _stop_worker)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, WORKER_SIGNALS)
+        
+        if shared_socket is not None:
+            server_socket = shared_socket
+        else:
+            server_socket = make_socket(True)
+        worker(server_socket)
+        exit_code = 0
+    except SystemExit as err:
+        # error() exits with a message rather than a code
+        if isinstance(err.code, int):
+            exit_code = err.code
+        elif err.code is not None:
+            print(err.code, file=sys.stderr)
+    except KeyboardInterrupt:
+        exit_code = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def _stop_worker(signum, frame):
+    """A worker's SIGTERM handler.  Unwinds worker(), which is
+    blocked in accept() or serving, so that it cleans up."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise SystemExit(0)
+
+
+def run_workers(num_workers, make_socket, worker):
+    """Runs num_workers worker processes until SIGTERM or SIGINT.
+    make_socket(reuse_port) must return a bound, listening
+    server socket, and worker(server_socket) runs a worker's
+    accept loop.  Returns an exit message if the workers keep
+    failing, else None."""
+    if not hasattr(os, "fork"):
+        return NO_FORK_ERR
+    
+    shared_socket = None
+    if not can_reuse_port():
+        shared_socket = make_socket(False)
+    
+    workers = {}    # pid -> time started
+    shutting_down = []
+    
+    def stop_workers(signum, frame):
+        shutting_down.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def forward_signal(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGHUP, forward_signal)
+    
+    for _ in range(num_workers):
+        workers[_start_worker(make_socket, worker, shared_socket)] = \
+            time.monotonic()
+    
+    quick_failures = 0
+    exit_message = None
+    try:
+        while workers:
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            if started is None or shutting_down:
+                continue
+            
+            # Replace the worker, slowly if it keeps dying young
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                quick_failures += 1
+                if quick_failures >= MAX_QUICK_FAILURES:
+                    exit_message = WORKERS_FAILING_ERR
+                    stop_workers(None, None)
+                    continue
+                time.sleep(RESTART_DELAY)
+                if shutting_down:
+                    continue
+            else:
+                quick_failures = 0
+            
+            print(WORKER_EXITED_MESSAGE.format(pid, status))
+            sys.stdout.flush()
+            workers[_start_worker(make_socket, worker, shared_socket)] = \
+                time.monotonic()
+    finally:
+        if shared_socket is not None:
+            shared_socket.close()
+    
+    return exit_message
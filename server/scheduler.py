@@ -0,0 +1,174 @@
+"""Block schedulers that decide which transfer sends next.
+
+Every FileResponse is registered with a scheduler, and before
+each send() the transfer must wait for a turn.  Only SLOTS
+transfers hold a turn at once, so when more transfers than that
+are ready to send, the scheduler picks the order in which their
+blocks go out.  A transfer only asks for a turn once its socket
+is writable, so a stalled client never holds one up.  A transfer
+that finds a slot free and nobody ahead of it takes its turn at
+once, and when a turn ends only the transfer that goes next is
+woken, so the scheduler costs little when the server isn't busy.
+Turns are still taken in priority order, and each waits for the
+pacer (the global token bucket), so more than one slot only lets
+sends overlap, not jump the queue.  With one slot every send()
+of every connection is a hand off between threads.
+
+FairScheduler is start-time fair queueing.  Each transfer has
+a virtual time, the bytes it has been sent since it started,
+and the ready transfer with the lowest virtual time goes next.
+A new transfer starts at the lowest virtual time of the active
+transfers, so it shares bandwidth equally with them from then
+on.  A small interactive request is interleaved with bulk
+downloads, never queued behind them.
+
+SJFScheduler is shortest job first.  The ready transfer with the 
+fewest bytes left to send goes next, so a small file preempts a 
+large transfer at the next block.  The DataLen of every 
+FileResponse is known before any of it is sent, so no guessing 
+is needed.  To stop large files waiting forever, a transfer's 
+bytes remaining are reduced by AGING_RATE bytes for every second 
+since it started.  A file of N bytes therefore waits at most 
+about N / AGING_RATE seconds before it outranks new small 
+requests.
+"""
+
+import threading
+import time
+
+SLOTS = 16                  # Transfers allowed to send at the same time
+AGING_RATE = 1024**2        # Bytes of priority gained per second waited
+
+SCHEDULE_FAIR = "fair"
+SCHEDULE_SJF = "sjf"
+
+
+class ScheduledTransfer(object):
+    """The scheduler's record of one FileResponse being sent."""
+
+    def __init__(self, data_len, virtual_time, lock):
+        self.data_len = data_len
+        self.bytes_sent = 0
+        self.virtual_time = virtual_time
+        self.started = time.monotonic()
+        self.wake = threading.Condition(lock)    # Notified on its turn
+    
+    
+    def bytes_remaining(self):
+        """Returns the number of payload bytes left to send."""
+        return max(self.data_len - self.bytes_sent, 0)
+
+
+class FairScheduler(object):
+    """Gives turns to the ready transfer with the lowest
+    priority(), at most slots at a time."""
+    
+    def __init__(self, slots=SLOTS, pacer=None):
+        self.slots = slots
+        self.pacer = pacer
+        self._busy = 0
+        self._active = set()
+        self._ready = []
+        self._virtual_time = 0
+        self._lock = threading.Lock()
+    
+    
+    def register(self, data_len):
+        """Returns a ScheduledTransfer for a new FileResponse
+        with data_len bytes of payload."""
+        with self._lock:
+            if self._active:
+                self._virtual_time = max(self._virtual_time, min(
+                    t.virtual_time for t in self._active
+                ))
+            transfer = ScheduledTransfer(
+                data_len, self._virtual_time, self._lock
+            )
+            self._active.add(transfer)
+            return transfer
+    
+    
+    def unregister(self, transfer):
+        """Forgets a finished (or failed) transfer."""
+        with self._lock:
+            self._active.discard(transfer)
+    
+    
+    def priority(self, transfer, now):
+        """Returns the key ready transfers are ordered by, lowest
+        first."""
+        return transfer.virtual_time
+    
+    
+    def wait_turn(self, transfer):
+        """Blocks until it is transfer's turn to send."""
+        with self._lock:
+            self._ready.append(transfer)
+            while True:
+                if self._busy < self.slots and \
+                   self._next_ready() is transfer:
+                    # Wait for the pacer before taking the turn
+                    pacer_wait = self.pacer.wait_time() if self.pacer else 0
+                    if pacer_wait <= 0:
+                        break
+                    transfer.wake.wait(pacer_wait)
+                else:
+                    # Priorities change, so the next may not be woken
+                    self._wake_next()
+                    transfer.wake.wait()
+            self._ready.remove(transfer)
+            self._busy += 1
+            self._wake_next()
+    
+    
+    def done(self, transfer, num_bytes):
+        """Ends transfer's turn after it sent num_bytes."""
+        with self._lock:
+            if self.pacer is not None:
+                self.pacer.reserve(num_bytes)
+            self._busy -= 1
+            transfer.bytes_sent += num_bytes
+            transfer.virtual_time += num_bytes
+            self._wake_next()
+    
+    
+    def _wake_next(self):
+        """Wakes the ready transfer that should send next, if 
+        there is a slot for it.  Call holding the lock."""
+        if self._ready and self._busy < self.slots:
+            self._next_ready().wake.notify()
+    
+    
+    def _next_ready(self):
+        """Returns the ready transfer that should send next."""
+        now = time.monotonic()
+        return min(self._ready, key=lambda t: self.priority(t, now))
+
+
+class SJFScheduler(FairScheduler):
+    """Gives turns to the ready transfer with the fewest bytes 
+    remaining, less aging_rate bytes per second since it 
+    started."""
+    
+    def __init__(self, slots=SLOTS, aging_rate=AGING_RATE, pacer=None):
+        super().__init__(slots, pacer)
+        self.aging_rate = aging_rate
+    
+    
+    def priority(self, transfer, now):
+        """Returns the key ready transfers are ordered by, lowest 
+        first."""
+        age = now - transfer.started
+        return transfer.bytes_remaining() - self.aging_rate * age
+
+
+def make_scheduler(schedule, slots=SLOTS, aging_rate=AGING_RATE, 
+                   pacer=None):
+    """Returns the scheduler for schedule (SCHEDULE_FAIR or 
+    SCHEDULE_SJF).  Raises ValueError for any other name."""
+    if schedule == SCHEDULE_FAIR:
+        return FairScheduler(slots, pacer)
+    elif schedule == SCHEDULE_SJF:
+        return SJFScheduler(slots, aging_rate, pacer)
+    else:
+        raise ValueError("Unknown schedule {}".format(schedule))
@@ -1,20 +1,155 @@
 '''This contains the main function for the server.  
-Run with "python server.py <port number>"
+Run with "python server.py <port number> [options]"
+
+Options (see admission.py, shaping.py and scheduler.py for the 
+defaults):
+    --backlog N          length of the kernel listen backlog
+    --max-connections N  open connections before new ones are refused
+    --max-transfers N    transfers in flight before requests are refused
+    --max-bytes N        bytes in flight before requests are refused
+    --global-rate N      bytes per second for the whole server
+    --ip-rate N          bytes per second for each client IP
+    --connection-rate N  bytes per second for each connection
+    --limits FILE        file of rate limits, reloaded on SIGHUP
+    --slots N            transfers that may send at the same time
+    --schedule NAME      "fair" (default) or "sjf", shortest job first
+    --aging-rate N       bytes of priority an sjf transfer gains per second
+    --workers N          worker processes to run (see prefork.py)
+    --unix PATH          also listen on an AF_UNIX socket at PATH
+    --transfer-log FILE  log transfers to FILE as JSON lines
+    --log-bytes N        size the transfer log is rotated at
+    --log-backups N      rotated transfer logs kept
+    --index-interval S   seconds between rescans of the file index
+    --nodelay-bytes N    responses this small are sent with TCP_NODELAY
+    --cork 0|1           cork the header and first block together
+    --tune-buffers 0|1   grow send buffers to the bandwidth-delay product
+    --max-buffer N       largest send buffer to grow to
 
 Creates a server that waits for connections from clients.  
 Accepts a FileRequest and sends back a FileResponse with 
-the file if it exists on the server.
+the file if it exists on the server.  If the FileRequest has 
+FLAG_KEEP_ALIVE set, the connection is kept open for further 
+requests until it has been idle for KEEPALIVE_TIMEOUT.
+
+Each connection is served with its own deadlines.  The request 
+must arrive within READ_TIMEOUT, no single send may stall for 
+longer than WRITE_TIMEOUT, and after THROUGHPUT_GRACE seconds 
+the client must sustain MIN_THROUGHPUT bytes per second.  A 
+client that breaks any of these has its connection closed, 
+and the server goes back to accepting connections.
+
+Each admitted connection is served on its own thread.  When 
+the server is overloaded (see admission.py) the client is sent 
+a header-only FileResponse with StatusCode STATUS_OVERLOADED.
+
+Blocks are sent in the order chosen by a FairScheduler, or by 
+an SJFScheduler that serves small files first (see 
+scheduler.py), and every byte is paid for from the token 
+buckets of a Shaper (see shaping.py).  Time a client spends 
+held back by the server doesn't count against its 
+MIN_THROUGHPUT.
 
 To send the file to the client, the server reads the file 
 locally in blocks; reading a block of BLOCK_SIZE, sending 
 that block, and so on.  This way the entire file is never 
 read into memory.
+
+A client on the same host can connect to the --unix socket 
+instead, and if its FileRequest has FLAG_PASS_FD set the 
+server sends no file data at all.  The file is opened and its 
+descriptor passed with a STATUS_FD_PASSED header, and the 
+client copies the file itself.
+
+A FileRequest with FLAG_VALIDATE carries the size and mtime of 
+the client's cached copy.  If they still match the file, the 
+server replies STATUS_NOT_MODIFIED with no payload.  Either 
+way the response header includes the file's mtime, so the 
+client can validate its copy next time.
+
+A FileRequest with FLAG_RANGE asks for only Length bytes from 
+Offset, so that a client can fetch parts of one file from 
+several servers at once.  The response header then includes 
+the size of the whole file.
+
+A FileRequest with FLAG_CHECKSUM gets a CRC32 of the payload 
+after it (see FileResponse), computed as the blocks are sent.
+
+A ListRequest is answered with a page of the FileIndex (see 
+file_index.py), an index of every file served that is kept up 
+to date in the background, so clients can find what there is 
+to fetch without asking for file after file.
+
+Each connection's socket options are tuned by a ConnectionTuner 
+(see transport.py): TCP_NODELAY for small responses, TCP_CORK 
+around the header and first block, and a send buffer sized to 
+the bandwidth-delay product measured early in the transfer.
+
+Each transfer is recorded in a TransferLog (see 
+transfer_log.py), written by a background thread so that 
+logging never holds up a client.  Without --transfer-log the 
+records are printed to stdout.
 '''
 
-from records import FileRequest, FileResponse, ENCODING_TYPE, BLOCK_SIZE
+from records import FileRequest, FileResponse, ListRequest, ListResponse, \
+    ENCODING_TYPE, BLOCK_SIZE, MAX_FILENAME_LEN, MAX_LIST_ENTRIES, \
+    STATUS_OK, STATUS_OVERLOADED, STATUS_FD_PASSED, STATUS_NOT_MODIFIED, \
+    FILE_REQUEST_TYPE, FILE_REQUEST_EXT_TYPE, LIST_REQUEST_TYPE, \
+    FLAG_KEEP_ALIVE, FLAG_PASS_FD, FLAG_VALIDATE, FLAG_RANGE, \
+    FLAG_CHECKSUM, FLAG_GLOB
+from admission import AdmissionControl, LISTEN_BACKLOG, MAX_CONNECTIONS, \
+    MAX_IN_FLIGHT_TRANSFERS, MAX_BYTES_IN_FLIGHT
+from scheduler import make_scheduler, SLOTS, AGING_RATE, SCHEDULE_FAIR
+from shaping import Shaper, GLOBAL_RATE, IP_RATE, CONNECTION_RATE
+from prefork import run_workers
+from transfer_log import TransferLog, LOG_BYTES, LOG_BACKUPS, EVENT_SENT, \
+    EVENT_MISSING, EVENT_OVERLOADED, EVENT_NOT_MODIFIED, EVENT_FD_PASSED, \
+    EVENT_LISTED, EVENT_TIMEOUT, EVENT_SLOW_CLIENT, EVENT_BAD_REQUEST, \
+    EVENT_SHORT_FILE, EVENT_SEND_ERROR
+from file_index import FileIndex, RESCAN_INTERVAL
+from transport import TransportPolicy
 import socket
 from common import *
 import sys
+import time
+import threading
+import select
+import signal
+import stat
+import struct
+try:
+    import fcntl
+    import termios
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+class SlowClientError(Exception):
+    """Raised when a client recieves data slower than 
+    MIN_THROUGHPUT."""
+
+
+class BadRequestError(Exception):
+    """Raised when a client sends an invalid request, or closes 
+    the connection part way through one.  The message is one of 
+    the *_ERR strings in common.py."""
+
+
+class ShortFileError(Exception):
+    """Raised when a file ends before the DataLen already sent 
+    for it, so the client can only tell by the connection 
+    closing."""
+
+
+class ServerContext(object):
+    """The shared state that every connection is served with."""
+    def __init__(self, admission, scheduler, shaper, transfer_log, 
+                 file_index, transport):
+        self.admission = admission
+        self.scheduler = scheduler
+        self.shaper = shaper
+        self.transfer_log = transfer_log
+        self.file_index = file_index
+        self.transport = transport
 
 
 def get_server_port_number():
@@ -28,6 +163,145 @@ def get_server_port_number():
     return convert_portno_str(port_num_str)
 
 
+def get_admission_control():
+    """Builds an AdmissionControl from the command line options, 
+    falling back to the defaults in admission.py."""
+    return AdmissionControl(
+        get_option("--max-connections", MAX_CONNECTIONS, int),
+        get_option("--max-transfers", MAX_IN_FLIGHT_TRANSFERS, int),
+        get_option("--max-bytes", MAX_BYTES_IN_FLIGHT, int),
+    )
+
+
+def get_scheduler(shaper):
+    """Builds the scheduler named by --schedule from the command 
+    line options, falling back to the defaults in scheduler.py.  
+    The scheduler paces sends with the shaper's global bucket."""
+    try:
+        return make_scheduler(
+            get_option("--schedule", SCHEDULE_FAIR), 
+            get_option("--slots", SLOTS, int), 
+            get_option("--aging-rate", AGING_RATE, int), 
+            shaper.global_bucket
+        )
+    except ValueError:
+        error(BAD_OPTION_ERR.format("--schedule"))
+
+
+def load_limits_file(shaper):
+    """Loads the --limits file (if given) into shaper."""
+    limits_file = get_option("--limits")
+    if limits_file is None:
+        return
+    
+    try:
+        shaper.load_limits(limits_file)
+        print(LIMITS_LOADED_MESSAGE.format(limits_file))
+    except (OSError, ValueError):
+        error(BAD_LIMITS_FILE_ERR.format(limits_file), exit_all=False)
+
+
+def get_shaper():
+    """Builds a Shaper from the command line options, falling 
+    back to the defaults in shaping.py, and loads the --limits 
+    file if given."""
+    shaper = Shaper(
+        get_option("--global-rate", GLOBAL_RATE, int),
+        get_option("--ip-rate", IP_RATE, int),
+        get_option("--connection-rate", CONNECTION_RATE, int),
+    )
+    load_limits_file(shaper)
+    return shaper
+
+
+def get_transfer_log():
+    """Builds a TransferLog from the command line options, 
+    falling back to the defaults in transfer_log.py."""
+    return TransferLog(
+        get_option("--transfer-log"),
+        get_option("--log-bytes", LOG_BYTES, int),
+        get_option("--log-backups", LOG_BACKUPS, int),
+    )
+
+
+def get_server_context():
+    """Builds the ServerContext from the command line options.  
+    Calls error() if any of them are bad."""
+    shaper = get_shaper()
+    return ServerContext(
+        get_admission_control(), get_scheduler(shaper), shaper, 
+        get_transfer_log(), 
+        FileIndex(
+            ".", get_option("--index-interval", RESCAN_INTERVAL, float)
+        ), 
+        TransportPolicy.from_command_line()
+    )
+
+
+def create_server_socket(port_num, reuse_port=False):
+    """Creates a server socket bound to port_num and listening.  
+    With reuse_port, other processes can listen on the same port 
+    (SO_REUSEPORT).  Calls error() on failure."""
+    # Create and Bind
+    try:
+        # Create server socket
+        server_socket = socket.socket()
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1
+            )
+        host_address = socket.gethostbyname(socket.gethostname())
+        # Bind to host address
+        server_socket.bind((host_address, port_num))
+    except OSError:
+        error(COULDNT_BIND_ERR)
+    
+    # Listen
+    try:
+        server_socket.listen(get_option("--backlog", LISTEN_BACKLOG, int))
+    except OSError:
+        error(SOCKET_LISTEN_ERR)
+    
+    return server_socket
+
+
+def create_unix_socket(path):
+    """Creates an AF_UNIX server socket bound to path and 
+    listening.  A socket file left behind by a server that has 
+    exited is replaced.  Calls error() on failure."""
+    if not hasattr(socket, "AF_UNIX"):
+        error(NO_UNIX_SOCKETS_ERR)
+    
+    # Remove a stale socket file, but not one a server is using
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            except OSError:
+                pass
+            finally:
+                probe.close()
+    except OSError:
+        pass
+    
+    try:
+        server_socket = socket.socket(socket.AF_UNIX)
+        server_socket.bind(path)
+    except OSError:
+        error(COULDNT_BIND_ERR)
+    
+    try:
+        server_socket.listen(get_option("--backlog", LISTEN_BACKLOG, int))
+    except OSError:
+        error(SOCKET_LISTEN_ERR)
+    
+    return server_socket
+
+
 def build_file_response(file_name):
     """Takes a file_name (directory) and retuns a valid 
     FileResponse object.  Checks that the file exists on 
@@ -44,112 +318,607 @@ def build_file_response(file_name):
 
 
 
-def print_sent_message(file_name, num_bytes_sent, success=True):
-    """Prints a message describing what was sent to the client."""
-    if success:
-        print(SENT_FILE_MESSAGE.format(
-            os.path.basename(file_name), num_bytes_sent
-        ))
-    else:
-        print(COULDNT_SENT_FILE_MESSAGE.format(
-            os.path.basename(file_name), num_bytes_sent
-        ))
+def throughput_deadline(num_bytes, start_time):
+    """Takes a number of bytes and the time.monotonic() a 
+    transfer started.  Returns the time by which num_bytes 
+    must have been sent to keep up MIN_THROUGHPUT, allowing 
+    THROUGHPUT_GRACE seconds for the transfer to get going."""
+    return start_time + max(THROUGHPUT_GRACE, num_bytes / MIN_THROUGHPUT)
 
 
-def main():
-    """Main function to run the server from.  Needs to be 
-    run from the command line.  See Module docstring."""
-    server_socket = None
-    client_socket = None
-    
+def queued_bytes(sock):
+    """Returns the number of bytes sent on sock that the client 
+    has not yet acknowledged (still in the kernel send buffer).  
+    Returns 0 where this can't be measured."""
+    if fcntl is None or not hasattr(termios, "TIOCOUTQ"):
+        return 0
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0" * 4)
+        return struct.unpack("i", buf)[0]
+    except OSError:
+        return 0
+
+
+def recv_request(client_socket, client_addr, idle_deadline=None):
+    """Recieves a FileRequest or ListRequest from client_socket.  
+    Once its first byte arrives the whole request must arrive 
+    within READ_TIMEOUT.  On a kept-alive connection 
+    idle_deadline is when to give up waiting for the next 
+    request to start, and the connection is closed quietly if 
+    it passes (or the client closes it).  Returns 
+    (FILE_REQUEST_TYPE, file_name, flags, fields), where fields 
+    is a dict of the fields of the flags (see 
+    FileRequest.FLAG_FIELDS), or for a ListRequest 
+    (LIST_REQUEST_TYPE, pattern, flags, fields) (see 
+    recv_list_request()).  Returns None if a kept-alive 
+    connection was closed or went idle, and raises 
+    BadRequestError if the request was invalid or cut short."""
+    # Wait for the request to start
     try:
-        # Get port number from command line args
-        port_num = get_server_port_number()
+        first_byte = recv_all(
+            1, client_socket, 
+            idle_deadline or time.monotonic() + READ_TIMEOUT
+        )
+    except socket.timeout:
+        if idle_deadline is not None:
+            return None
+        raise
+    if len(first_byte) < 1:
+        if idle_deadline is None:
+            raise BadRequestError(CONNECTION_CLOSED_ERR.format(client_addr))
+        return None
+    deadline = time.monotonic() + READ_TIMEOUT
+    
+    # Recieve the rest of the header from connection
+    client_request_header = first_byte + recv_all(
+        FileRequest.header_byte_len() - 1, client_socket, deadline
+    )
+    if len(client_request_header) < FileRequest.header_byte_len():
+        raise BadRequestError(CONNECTION_CLOSED_ERR.format(client_addr))
+    
+    # Convert to host byte order
+    host_request_header = FileRequest.header_to_host_byte_ord(
+        client_request_header
+    )
+    
+    # A ListRequest starts the same way, so tell them apart by Type
+    if FileRequest.get_type_from_header(host_request_header) == \
+       LIST_REQUEST_TYPE:
+        return recv_list_request(
+            client_socket, client_addr, client_request_header, deadline
+        )
+    
+    # Check header validity
+    if not FileRequest.is_valid_header(host_request_header):
+        raise BadRequestError(INVALID_FILE_REQUEST_ERR)
+    
+    # An extended FileRequest has a Flags byte after the header
+    flags = 0
+    fields = {}
+    if FileRequest.get_type_from_header(host_request_header) == \
+       FILE_REQUEST_EXT_TYPE:
+        client_request_header += recv_all(1, client_socket, deadline)
+        if len(client_request_header) < FileRequest.ext_header_byte_len():
+            raise BadRequestError(CONNECTION_CLOSED_ERR.format(client_addr))
+        flags = FileRequest.get_flags_from_ext_header(
+            FileRequest.ext_header_to_host_byte_ord(client_request_header)
+        )
         
-        # Create and Bind
-        try:
-            # Create server socket
-            server_socket = socket.socket()
-            host_address = socket.gethostbyname(socket.gethostname())
-            # Bind to host address
-            server_socket.bind((host_address, port_num))
-        except OSError:
-            error(COULDNT_BIND_ERR)
+        # Then the fields of any flags that have them
+        fields_len = FileRequest.flag_fields_byte_len(flags)
+        fields_bytes = recv_all(fields_len, client_socket, deadline)
+        if len(fields_bytes) < fields_len:
+            raise BadRequestError(CONNECTION_CLOSED_ERR.format(client_addr))
+        fields = FileRequest.get_flag_fields(fields_bytes, flags)
+    
+    # Extract filenameLen from header
+    file_name_len = FileRequest.get_filenameLen_from_header(
+        host_request_header
+    )
+    
+    # Read just the filename from socket
+    file_name_bytes = recv_all(file_name_len, client_socket, deadline)
+    if len(file_name_bytes) < file_name_len:
+        raise BadRequestError(CONNECTION_CLOSED_ERR.format(client_addr))
+    try:
+        file_name = file_name_bytes.decode(ENCODING_TYPE)
+    except UnicodeDecodeError:
+        raise BadRequestError(INVALID_FILE_REQUEST_ERR)
+    
+    return FILE_REQUEST_TYPE, file_name, flags, fields
+
+
+def recv_list_request(client_socket, client_addr, client_request_header, 
+                      deadline):
+    """Recieves the rest of a ListRequest that started with 
+    client_request_header, by deadline.  Returns 
+    (LIST_REQUEST_TYPE, pattern, flags, fields), where fields has 
+    the After path and MaxEntries.  Raises BadRequestError if the 
+    request was invalid or the connection was closed."""
+    client_request_header += recv_all(
+        ListRequest.header_byte_len() - len(client_request_header), 
+        client_socket, deadline
+    )
+    if len(client_request_header) < ListRequest.header_byte_len():
+        raise BadRequestError(CONNECTION_CLOSED_ERR.format(client_addr))
+    
+    # Check header validity
+    host_request_header = ListRequest.header_to_host_byte_ord(
+        client_request_header
+    )
+    if not ListRequest.is_valid_header(host_request_header):
+        raise BadRequestError(INVALID_FILE_REQUEST_ERR)
+    header_fields = ListRequest.get_fields_from_header(host_request_header)
+    
+    # Read the Pattern and After path
+    payload_len = header_fields["PatternLen"] + header_fields["AfterLen"]
+    payload = recv_all(payload_len, client_socket, deadline)
+    if len(payload) < payload_len:
+        raise BadRequestError(CONNECTION_CLOSED_ERR.format(client_addr))
+    try:
+        pattern = payload[:header_fields["PatternLen"]].decode(ENCODING_TYPE)
+        after = payload[header_fields["PatternLen"]:].decode(ENCODING_TYPE)
+    except UnicodeDecodeError:
+        raise BadRequestError(INVALID_FILE_REQUEST_ERR)
+    
+    fields = {"After": after, "MaxEntries": header_fields["MaxEntries"]}
+    return LIST_REQUEST_TYPE, pattern, header_fields["Flags"], fields
+
+
+def wait_writable(sock, deadline):
+    """Blocks until sock can be sent on.  Raises socket.timeout 
+    if deadline (a time.monotonic() value) passes first."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("Deadline passed.")
+    
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        ready = poller.poll(remaining * 1000)
+    else:
+        _, ready, _ = select.select([], [sock], [], remaining)
+    
+    if not ready:
+        raise socket.timeout("Deadline passed.")
+
+
+def send_block(byte_block, client_socket, deadline, transfer, 
+               scheduler, limiter):
+    """Sends byte_block to client_socket with one send() per 
+    turn from the scheduler (which paces turns with the global 
+    token bucket), paying the limiter's connection and client 
+    IP buckets for every byte.  Raises socket.timeout if client_socket 
+    isn't writable before deadline.  Returns the seconds the 
+    server held the block back for (waiting for a turn or for 
+    tokens), which are not the client's fault."""
+    held_time = 0.0
+    block_sent = 0
+    while block_sent < len(byte_block):
+        # Only ask for a turn once the send won't block
+        wait_writable(client_socket, deadline + held_time)
         
-        # Listen
+        held_since = time.monotonic()
+        scheduler.wait_turn(transfer)
+        num_bytes = 0
         try:
-            server_socket.listen()
-        except OSError:
-            error(SOCKET_LISTEN_ERR)
-        
+            num_bytes = client_socket.send(byte_block[block_sent:])
+        finally:
+            scheduler.done(transfer, num_bytes)
         
-        
-        # Continually accept() incomming requests
-        while True:
-            
-            # Accept incomming connection request
-            client_socket, client_addr = server_socket.accept()
-            client_socket.settimeout(TIMEOUT)
-            
-            
-            # Recieve header from connection
-            client_request_header = recv_all(
-                FileRequest.header_byte_len(), client_socket
-            )
-            
-            # Convert to host byte order
-            client_request_header = FileRequest.header_to_host_byte_ord(
-                client_request_header
+        # Pay the connection and client IP buckets after the turn
+        wait_time = limiter.reserve(num_bytes)
+        if wait_time > 0:
+            time.sleep(wait_time)
+        held_time += time.monotonic() - held_since
+        block_sent += num_bytes
+    
+    return held_time
+
+
+def send_file_response(file_response, client_socket, scheduler, limiter, 
+                       tuner):
+    """Sends file_response to client_socket in blocks (see 
+    send_block()), tuning the socket with tuner as it goes.  
+    Each block may stall for at most WRITE_TIMEOUT, and the 
+    client must keep up with MIN_THROUGHPUT (else 
+    SlowClientError), counting only bytes that have left the 
+    send buffer.  Returns the number of bytes sent."""
+    client_socket.settimeout(WRITE_TIMEOUT)
+    data_len = file_response.HEADER_DICT["DataLen"][-1]
+    transfer = scheduler.register(data_len)
+    tuner.start_response(FileResponse.ext_header_byte_len() + data_len)
+    start_time = time.monotonic()
+    num_bytes_sent = 0
+    try:
+        for byte_block in file_response.read_byte_block():
+            write_deadline = time.monotonic() + WRITE_TIMEOUT
+            delivered_bytes = num_bytes_sent - queued_bytes(client_socket)
+            rate_deadline = throughput_deadline(
+                delivered_bytes + len(byte_block), start_time
             )
+            try:
+                held_time = send_block(
+                    byte_block, client_socket, 
+                    min(write_deadline, rate_deadline), 
+                    transfer, scheduler, limiter
+                )
+            except socket.timeout:
+                if rate_deadline < write_deadline:
+                    raise SlowClientError()
+                raise
             
-            # Check header validity
-            if not FileRequest.is_valid_header(client_request_header):
-                error(INVALID_FILE_REQUEST_ERR, exit_all=False)
-                continue
-            
-            
-            # Extract filenameLen from header
-            file_name_len = FileRequest.get_filenameLen_from_header(
-                client_request_header
+            # Time the server held the client back doesn't count
+            start_time += held_time
+            num_bytes_sent += len(byte_block)
+            tuner.block_done(num_bytes_sent - queued_bytes(client_socket))
+    finally:
+        tuner.end_response()
+        scheduler.unregister(transfer)
+    
+    return num_bytes_sent
+
+
+def reject_connection(client_socket):
+    """Sends a header-only FileResponse with StatusCode 
+    STATUS_OVERLOADED without waiting on the client, then 
+    closes client_socket.  Used from the accept loop, so it 
+    never blocks."""
+    try:
+        client_socket.setblocking(False)
+        file_response = FileResponse("", STATUS_OVERLOADED)
+        client_socket.send(file_response.get_bytearray())
+        # Discard any request already recieved, so close() sends a 
+        # FIN after the response rather than a reset
+        try:
+            client_socket.recv(
+                FileRequest.header_byte_len() + MAX_FILENAME_LEN
             )
-            
-            # Read just the filename from socket
-            file_name_bytes = recv_all(file_name_len, client_socket)
-            file_name = file_name_bytes.decode(ENCODING_TYPE)
-            
-            
-            # Send FileResponse in blocks
-            status_code = int(file_exists_locally(file_name))
-            file_response = FileResponse(file_name, status_code)
+        except BlockingIOError:
+            pass
+        client_socket.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+
+def file_mtime(file_name):
+    """Returns the mtime of file_name in whole seconds, as it 
+    fits in the Mtime field of a FileResponse, or 0 if it can't 
+    be read."""
+    try:
+        return int(os.path.getmtime(file_name)) & 0xFFFFFFFF
+    except OSError:
+        return 0
+
+
+def is_not_modified(file_name, fields):
+    """Takes the fields of a FLAG_VALIDATE FileRequest.  Returns 
+    True if the client's copy has the size and mtime of 
+    file_name."""
+    try:
+        size = os.path.getsize(file_name)
+    except OSError:
+        return False
+    return size == fields["ValidSize"] and \
+        file_mtime(file_name) == fields["ValidMtime"]
+
+
+def pass_file_descriptor(file_name, client_socket, mtime=None):
+    """Opens file_name and sends a STATUS_FD_PASSED FileResponse 
+    header (with mtime, if given) to client_socket (AF_UNIX) with 
+    the file descriptor attached.  Returns the size of the file 
+    passed."""
+    file_response = FileResponse(file_name, STATUS_FD_PASSED, mtime)
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        send_fd(
+            file_response.get_bytearray(), fd, client_socket, 
+            time.monotonic() + WRITE_TIMEOUT
+        )
+    finally:
+        os.close(fd)
+    
+    return file_response.HEADER_DICT["DataLen"][-1]
+
+
+def serve_file_request(file_name, flags, fields, client_socket, 
+                       client_addr, context, limiter, tuner):
+    """Sends the FileResponse for file_name to client_socket, 
+    or a header-only STATUS_OVERLOADED FileResponse if the 
+    transfer isn't admitted, and logs the transfer.  If the client asked for 
+    FLAG_PASS_FD over an AF_UNIX socket, the file descriptor is 
+    passed instead, which costs no bandwidth and is always 
+    admitted.  With FLAG_VALIDATE, a header-only 
+    STATUS_NOT_MODIFIED FileResponse is sent if the client's 
+    copy is current.  With FLAG_RANGE, only the requested part 
+    of the file is sent (and never as a file descriptor).  With 
+    FLAG_CHECKSUM, the payload is followed by its CRC32.  Raises 
+    ShortFileError if the file got shorter while it was sent."""
+    admission = context.admission
+    start_time = time.monotonic()
+    
+    def log_transfer(event, status, num_bytes):
+        context.transfer_log.log(
+            event, file_name, status, num_bytes, 
+            time.monotonic() - start_time, str(client_addr[0])
+        )
+    
+    status_code = int(file_exists_locally(file_name))
+    mtime = None
+    if flags & (FLAG_VALIDATE | FLAG_RANGE):
+        mtime = file_mtime(file_name)
+    if flags & FLAG_VALIDATE:
+        if status_code and is_not_modified(file_name, fields):
+            file_response_data = FileResponse(
+                file_name, STATUS_NOT_MODIFIED, mtime
+            ).get_bytearray()
+            tuner.start_response(len(file_response_data))
             try:
-                num_bytes_sent = 0
-                for byte_block in file_response.read_byte_block():
-                    n = send_all(byte_block, client_socket)
-                    num_bytes_sent += n
-            except OSError:
-                error(COULDNT_SEND_ERR)
-            
-            
-            # Close this client socket
-            client_socket.close()
+                send_all(
+                    file_response_data, client_socket, 
+                    time.monotonic() + WRITE_TIMEOUT
+                )
+            finally:
+                tuner.end_response()
+            log_transfer(EVENT_NOT_MODIFIED, STATUS_NOT_MODIFIED, 0)
+            return
+    
+    if status_code and flags & FLAG_PASS_FD and not flags & FLAG_RANGE and \
+       client_socket.family == getattr(socket, "AF_UNIX", None):
+        tuner.start_response(FileResponse.ext_header_byte_len())
+        try:
+            num_bytes_passed = pass_file_descriptor(
+                file_name, client_socket, mtime
+            )
+        finally:
+            tuner.end_response()
+        log_transfer(EVENT_FD_PASSED, STATUS_FD_PASSED, num_bytes_passed)
+        return
+    
+    checksum = bool(flags & FLAG_CHECKSUM)
+    if flags & FLAG_RANGE:
+        file_response = FileResponse(
+            file_name, status_code, mtime, fields["Offset"], 
+            fields["Length"], checksum
+        )
+    else:
+        file_response = FileResponse(
+            file_name, status_code, mtime, checksum=checksum
+        )
+    data_len = file_response.HEADER_DICT["DataLen"][-1]
+    
+    # Refuse the transfer if it would overload the server
+    if not admission.try_admit(data_len):
+        # Header only, so not queued behind the load being shed
+        file_response_data = FileResponse(
+            file_name, STATUS_OVERLOADED, mtime
+        ).get_bytearray()
+        tuner.start_response(len(file_response_data))
+        try:
+            send_all(
+                file_response_data, client_socket, 
+                time.monotonic() + WRITE_TIMEOUT
+            )
+        finally:
+            tuner.end_response()
+        log_transfer(EVENT_OVERLOADED, STATUS_OVERLOADED, 0)
+        return
+    
+    # Send FileResponse in blocks
+    try:
+        num_bytes_sent = send_file_response(
+            file_response, client_socket, context.scheduler, limiter, tuner
+        )
+    finally:
+        admission.release(data_len)
+    
+    # Log the transfer 
+    # (differentiates between sucessful send and not sucessful)
+    log_transfer(
+        EVENT_SENT if status_code else EVENT_MISSING, status_code, 
+        num_bytes_sent
+    )
+    if file_response.truncated:
+        raise ShortFileError()
+
+
+def serve_list_request(pattern, flags, fields, client_socket, client_addr, 
+                       context, tuner):
+    """Sends the ListResponse for a ListRequest to client_socket: 
+    the next page of the FileIndex, and logs it.  Listings are 
+    always admitted, as a page is small and already in memory."""
+    start_time = time.monotonic()
+    max_entries = fields["MaxEntries"]
+    if not 0 < max_entries <= MAX_LIST_ENTRIES:
+        max_entries = MAX_LIST_ENTRIES
+    entries, more = context.file_index.list(
+        pattern, bool(flags & FLAG_GLOB), fields["After"], max_entries
+    )
+    
+    list_response_data = ListResponse(entries, more).get_bytearray()
+    tuner.start_response(len(list_response_data))
+    try:
+        send_all(
+            list_response_data, client_socket, 
+            time.monotonic() + WRITE_TIMEOUT
+        )
+    finally:
+        tuner.end_response()
+    context.transfer_log.log(
+        EVENT_LISTED, pattern, STATUS_OK, len(list_response_data), 
+        time.monotonic() - start_time, str(client_addr[0])
+    )
+
+
+def serve_client(client_socket, client_addr, context):
+    """Serves FileRequests from client_socket; just one, unless 
+    the client sets FLAG_KEEP_ALIVE, in which case the next 
+    request may follow within KEEPALIVE_TIMEOUT.  Any timeout, 
+    slow client, bad request, short file or socket error only 
+    closes this connection, and is recorded in the transfer log 
+    (which never blocks, so a stdout nobody reads can't hold 
+    the connection open).  The socket is always closed (and 
+    uncounted from admission) on return."""
+    limiter = context.shaper.open_connection(client_addr[0])
+    tuner = context.transport.tuner(client_socket)
+    start_time = time.monotonic()
+    name = None
+    
+    def log_error(event, message):
+        context.transfer_log.log(
+            event, name, None, 0, time.monotonic() - start_time, 
+            str(client_addr[0]), message
+        )
+    
+    try:
+        idle_deadline = None
+        while True:
+            request = recv_request(client_socket, client_addr, idle_deadline)
+            if request is None:
+                return
             
+            request_type, name, flags, fields = request
+            if request_type == LIST_REQUEST_TYPE:
+                serve_list_request(
+                    name, flags, fields, client_socket, client_addr, 
+                    context, tuner
+                )
+            else:
+                serve_file_request(
+                    name, flags, fields, client_socket, client_addr, 
+                    context, limiter, tuner
+                )
             
-            # Print an informational message 
-            # (differentiates between sucessful send and not sucessful)
-            print_sent_message(file_name, num_bytes_sent, status_code)
-                    
+            if not flags & FLAG_KEEP_ALIVE:
+                return
+            idle_deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+    
+    except socket.timeout:
+        log_error(EVENT_TIMEOUT, CLIENT_TIMEOUT_ERR.format(client_addr))
+    except SlowClientError:
+        log_error(EVENT_SLOW_CLIENT, SLOW_CLIENT_ERR.format(
+            client_addr, MIN_THROUGHPUT
+        ))
+    except BadRequestError as err:
+        log_error(EVENT_BAD_REQUEST, str(err))
+    except ShortFileError:
+        log_error(
+            EVENT_SHORT_FILE, FILE_SHRANK_ERR.format(name, client_addr)
+        )
+    except OSError:
+        log_error(EVENT_SEND_ERROR, COULDNT_SEND_ERR)
+    finally:
+        client_socket.close()
+        limiter.close()
+        context.admission.close_connection()
+
+
+def accept_connections(server_socket, context):
+    """Continually accepts connections on server_socket and 
+    serves each on its own thread."""
+    client_socket = None
+    is_unix = server_socket.family == getattr(socket, "AF_UNIX", None)
+    try:
+        # Continually accept() incomming requests
+        while True:
             
+            # Accept incomming connection request
+            client_socket, client_addr = server_socket.accept()
+            if is_unix:
+                # AF_UNIX peers have no address, but share one "IP"
+                client_addr = ("localhost", server_socket.getsockname())
             
+            # Shed load before doing any work for this connection
+            if not context.admission.try_open_connection():
+                reject_connection(client_socket)
+                client_socket = None
+                context.transfer_log.log(
+                    EVENT_OVERLOADED, None, STATUS_OVERLOADED, 0, 0.0, 
+                    str(client_addr[0])
+                )
+                continue
             
-    
-    except socket.timeout:
-        error(TIMOUT_ERR)
+            # A failure here only costs this connection
+            threading.Thread(
+                target=serve_client, 
+                args=(client_socket, client_addr, context), 
+                daemon=True
+            ).start()
+            client_socket = None
     
     finally:
         if client_socket is not None:
             client_socket.close()
-        if server_socket is not None:
-            server_socket.close()
+        server_socket.close()
+
+
+def serve_forever(server_sockets, context):
+    """Accepts connections on every socket in server_sockets, 
+    the first on this thread and the others on their own.  
+    Reloads the --limits file on SIGHUP."""
+    def reload_limits(signum, frame):
+        load_limits_file(context.shaper)
+    
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_limits)
+    
+    for server_socket in server_sockets[1:]:
+        threading.Thread(
+            target=accept_connections, args=(server_socket, context), 
+            daemon=True
+        ).start()
+    accept_connections(server_sockets[0], context)
+
+
+def serve_worker(server_sockets, context):
+    """Runs serve_forever() in a worker process (see prefork.py), 
+    and writes out the worker's queued transfer log records 
+    when it is stopped."""
+    try:
+        serve_forever(server_sockets, context)
+    finally:
+        context.transfer_log.close()
+
+
+def main():
+    """Main function to run the server from.  Needs to be 
+    run from the command line.  See Module docstring."""
+    # Get port number and options from command line args
+    port_num = get_server_port_number()
+    num_workers = get_option("--workers", 1, int)
+    unix_path = get_option("--unix")
+    context = get_server_context()
+    
+    # Workers share the one AF_UNIX socket, made before they fork
+    unix_sockets = []
+    if unix_path is not None:
+        unix_sockets.append(create_unix_socket(unix_path))
+    
+    try:
+        if num_workers > 1:
+            # Each worker process serves with its own copy of context
+            exit_message = run_workers(
+                num_workers, 
+                lambda reuse_port: create_server_socket(port_num, reuse_port), 
+                lambda server_socket: serve_worker(
+                    [server_socket] + unix_sockets, context
+                )
+            )
+            if exit_message is not None:
+                error(exit_message)
+        else:
+            serve_forever(
+                [create_server_socket(port_num)] + unix_sockets, context
+            )
+    finally:
+        context.transfer_log.close()
+        if unix_path is not None and unix_sockets:
+            try:
+                os.unlink(unix_path)
+            except OSError:
+                pass
             
         
         
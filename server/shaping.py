@@ -0,0 +1,198 @@
+"""Token bucket bandwidth shaping for the server.
+
+Every byte sent to a client is taken from three token buckets:
+one for the connection, one shared by all connections from the
+same client IP, and one global bucket shared by every connection.
+A rate of 0 means that bucket is unlimited.  The global bucket is
+paid by the block scheduler (see scheduler.py), so that it is the
+scheduler that decides which transfer gets the server's bandwidth.
+
+Buckets are allowed to go into debt.  TokenBucket.reserve()
+always takes the bytes and returns how long the caller must
+wait for the bucket to recover, so a sender pays for a block
+after it is sent and the long term rate never exceeds the limit.
+
+Limits can be changed while the server is running with
+Shaper.set_limits(), or by reloading a limits file of
+"name = value" lines (see LIMIT_NAMES), e.g.
+
+    # bytes per second, 0 is unlimited
+    global_rate = 10000000
+    ip_rate = 2000000
+    connection_rate = 0
+"""
+
+import threading
+import time
+
+GLOBAL_RATE = 0        # Bytes per second for the whole server
+IP_RATE = 0            # Bytes per second for each client IP
+CONNECTION_RATE = 0    # Bytes per second for each connection
+
+BURST_TIME = 0.05      # Seconds of tokens a bucket can store
+MIN_BURST = 16384      # Least bytes a bucket can store
+
+LIMIT_NAMES = ("global_rate", "ip_rate", "connection_rate")
+
+
+class TokenBucket(object):
+    """A thread safe token bucket that refills at rate bytes
+    per second, holding at most burst bytes."""
+    
+    def __init__(self, rate=0, burst=None):
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+    
+    
+    def set_rate(self, rate, burst=None):
+        """Changes the rate (bytes per second, 0 is unlimited)
+        and burst of the bucket, and refills it."""
+        with self._lock:
+            self.rate = rate
+            if burst is None:
+                burst = max(rate * BURST_TIME, MIN_BURST)
+            self.burst = burst
+            self.tokens = burst
+            self.last_refill = time.monotonic()
+    
+    
+    def reserve(self, num_bytes):
+        """Takes num_bytes from the bucket.  Returns the number
+        of seconds the caller should wait before sending more,
+        which is 0.0 unless the bucket is in debt."""
+        if not self.rate:
+            return 0.0    # Unlimited, so no need for the lock
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.last_refill) * self.rate
+            )
+            self.last_refill = now
+            self.tokens -= num_bytes
+            
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+    
+    
+    def wait_time(self):
+        """Returns the number of seconds until the bucket is out 
+        of debt, without taking anything from it."""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            
+            elapsed = time.monotonic() - self.last_refill
+            debt = -(self.tokens + elapsed * self.rate)
+            return max(debt / self.rate, 0.0)
+
+
+class ConnectionLimiter(object):
+    """The buckets that one connection draws from.  Made by
+    Shaper.open_connection(), and must be given back with
+    close()."""
+    
+    def __init__(self, shaper, client_ip, connection_bucket):
+        self.shaper = shaper
+        self.client_ip = client_ip
+        self.connection_bucket = connection_bucket
+        self.ip_bucket = shaper.ip_buckets[client_ip]
+    
+    
+    def reserve(self, num_bytes):
+        """Takes num_bytes from the connection and client IP
+        buckets.  Returns the seconds to wait afterwards."""
+        return max(
+            self.connection_bucket.reserve(num_bytes),
+            self.ip_bucket.reserve(num_bytes)
+        )
+    
+    
+    def close(self):
+        """Gives the buckets back to the Shaper."""
+        self.shaper._close_connection(self)
+
+
+class Shaper(object):
+    """Holds the global bucket, a bucket per client IP (kept
+    while that IP has a connection open), and a bucket per
+    connection."""
+    
+    def __init__(self, global_rate=GLOBAL_RATE, ip_rate=IP_RATE,
+                 connection_rate=CONNECTION_RATE):
+        self.global_rate = global_rate
+        self.ip_rate = ip_rate
+        self.connection_rate = connection_rate
+        
+        self.global_bucket = TokenBucket(global_rate)
+        self.ip_buckets = {}
+        self._ip_connections = {}
+        self._connection_buckets = set()
+        self._lock = threading.Lock()
+    
+    
+    def open_connection(self, client_ip):
+        """Returns a ConnectionLimiter for a new connection from
+        client_ip."""
+        connection_bucket = TokenBucket(self.connection_rate)
+        with self._lock:
+            if client_ip not in self.ip_buckets:
+                self.ip_buckets[client_ip] = TokenBucket(self.ip_rate)
+                self._ip_connections[client_ip] = 0
+            self._ip_connections[client_ip] += 1
+            self._connection_buckets.add(connection_bucket)
+            return ConnectionLimiter(self, client_ip, connection_bucket)
+    
+    
+    def _close_connection(self, limiter):
+        """Forgets the buckets of a closed connection."""
+        with self._lock:
+            self._connection_buckets.discard(limiter.connection_bucket)
+            self._ip_connections[limiter.client_ip] -= 1
+            if self._ip_connections[limiter.client_ip] == 0:
+                del self._ip_connections[limiter.client_ip]
+                del self.ip_buckets[limiter.client_ip]
+    
+    
+    def set_limits(self, global_rate=None, ip_rate=None,
+                   connection_rate=None):
+        """Changes any of the limits that are not None, including
+        for connections that are already open."""
+        with self._lock:
+            if global_rate is not None:
+                self.global_rate = global_rate
+                self.global_bucket.set_rate(global_rate)
+            if ip_rate is not None:
+                self.ip_rate = ip_rate
+                for bucket in self.ip_buckets.values():
+                    bucket.set_rate(ip_rate)
+            if connection_rate is not None:
+                self.connection_rate = connection_rate
+                for bucket in self._connection_buckets:
+                    bucket.set_rate(connection_rate)
+    
+    
+    def load_limits(self, file_name):
+        """Reads "name = value" lines (names in LIMIT_NAMES) from
+        file_name and applies them with set_limits().  Lines
+        starting with # are ignored.  Raises ValueError on a bad
+        line, without changing any limits."""
+        limits = {}
+        with open(file_name) as infile:
+            for line in infile:
+                line = line.split("#")[0].strip()
+                if not line:
+                    continue
+                name, _, value = line.partition("=")
+                name = name.strip()
+                if name not in LIMIT_NAMES:
+                    raise ValueError("Unknown limit {}".format(name))
+                limits[name] = int(value.strip())
+        
+        self.set_limits(**limits)
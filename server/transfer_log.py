@@ -0,0 +1,258 @@
+"""The server's transfer log.
+
+Every transfer the server finishes (or refuses) is recorded with
+TransferLog.log(), which only puts the record on a bounded queue
+and never blocks.  A background thread takes records off the
+queue and writes them out in batches, so a slow disk or a stdout
+nobody is reading holds up the log rather than the clients.
+
+With a log file, each record is written as one line of JSON:
+
+    {"time": 1700000000.123, "event": "sent", "path": "f.bin",
+     "status": 1, "bytes": 1024, "duration": 0.0042,
+     "client": "127.0.0.1"}
+
+The events are "sent", "missing", "overloaded", "not_modified",
+"fd_passed" and "listed" (where path is the ListRequest Pattern).
+A connection turned away by admission control is an "overloaded"
+record with a null path.  A connection closed for an error is one
+of "timeout", "slow_client", "bad_request", "short_file" or
+"send_error", with a null status and a "message" saying what
+happened, and path the file being sent at the time (if any).
+Once the file reaches max_bytes it is rotated: FILE becomes
+FILE.1, FILE.1 becomes FILE.2 and so on, keeping backups old
+files.  Without a log file, the records are printed to stdout as
+the usual messages instead.
+
+If the queue is full the record is dropped and counted, and the
+next batch written includes a "dropped" record with the number
+lost since the last one.
+
+Worker processes (see prefork.py) can share one log file.  Each
+batch is a single write() in append mode, and a worker that
+finds the file has been rotated by another reopens it.
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+from common import SENT_FILE_MESSAGE, COULDNT_SENT_FILE_MESSAGE, \
+    OVERLOADED_MESSAGE, NOT_MODIFIED_MESSAGE, PASSED_FD_MESSAGE, \
+    LISTED_MESSAGE, REJECTED_CONNECTION_MESSAGE
+
+QUEUE_SIZE = 65536          # Records waiting to be written
+LOG_BYTES = 64 * 1024**2    # Size a log file is rotated at
+LOG_BACKUPS = 5             # Rotated log files kept
+FLUSH_INTERVAL = 0.5        # Seconds the writer waits for more records
+
+EVENT_SENT = "sent"
+EVENT_MISSING = "missing"
+EVENT_OVERLOADED = "overloaded"
+EVENT_NOT_MODIFIED = "not_modified"
+EVENT_FD_PASSED = "fd_passed"
+EVENT_LISTED = "listed"
+EVENT_TIMEOUT = "timeout"
+EVENT_SLOW_CLIENT = "slow_client"
+EVENT_BAD_REQUEST = "bad_request"
+EVENT_SHORT_FILE = "short_file"
+EVENT_SEND_ERROR = "send_error"
+EVENT_DROPPED = "dropped"
+
+LOG_DROPPED_MESSAGE = "Transfer log full, dropped {} records."
+
+
+class TransferLog(object):
+    """A queue of transfer records, written to file_name (or
+    stdout) by a background thread.  Thread safe, and log() never
+    blocks."""
+    
+    def __init__(self, file_name=None, max_bytes=LOG_BYTES,
+                 backups=LOG_BACKUPS, queue_size=QUEUE_SIZE):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_size = queue_size
+        self.dropped = 0            # Records dropped in total
+        self._unreported = 0        # Dropped since the last report
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._file = None
+    
+    
+    def log(self, event, path, status, num_bytes, duration, client,
+            message=None):
+        """Queues a record of one transfer (with message, for an 
+        error), or drops it if the queue is full."""
+        self._start()
+        record = {
+            "time": round(time.time(), 3), "event": event,
+            "path": path, "status": status, "bytes": num_bytes,
+            "duration": round(duration, 6), "client": client,
+        }
+        if message is not None:
+            record["message"] = message
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+    
+    
+    def close(self):
+        """Writes every queued record and stops the writer
+        thread."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+    
+    
+    def _start(self):
+        """Starts the writer thread if this process hasn't yet.
+        A forked worker doesn't inherit its parent's thread, so
+        it starts its own with a fresh queue."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._file = None
+            self._thread = threading.Thread(
+                target=self._write_records, daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+    
+    
+    def _write_records(self):
+        """The writer thread.  Writes the queued records in batches
+        until close() queues None."""
+        while True:
+            try:
+                records = [self._queue.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                records = []
+            while records and records[-1] is not None:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            stopping = bool(records) and records[-1] is None
+            if stopping:
+                records.pop()
+            
+            with self._lock:
+                num_dropped, self._unreported = self._unreported, 0
+            if num_dropped:
+                records.append({
+                    "time": round(time.time(), 3), "event": EVENT_DROPPED,
+                    "count": num_dropped,
+                })
+            
+            if records:
+                try:
+                    self._write_batch(records)
+                except (OSError, ValueError):
+                    # Nowhere to write, so these are lost too
+                    with self._lock:
+                        self.dropped += len(records)
+            if stopping:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+    
+    
+    def _write_batch(self, records):
+        """Writes records to the log file, or prints them to stdout
+        if there isn't one."""
+        if self.file_name is None:
+            sys.stdout.write("".join(
+                format_record(record) + "\n" for record in records
+            ))
+            sys.stdout.flush()
+            return
+        
+        self._open_log()
+        self._file.write("".join(
+            json.dumps(record) + "\n"
+            for record in records
+        ).encode("UTF-8"))
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+    
+    
+    def _open_log(self):
+        """Opens the log file for appending, reopening it if
+        another process has rotated it away."""
+        if self._file is not None:
+            try:
+                if os.stat(self.file_name).st_ino == \
+                   os.fstat(self._file.fileno()).st_ino:
+                    return
+            except OSError:
+                pass
+            self._file.close()
+        self._file = open(self.file_name, "ab", buffering=0)
+    
+    
+    def _rotate(self):
+        """Renames the log file to FILE.1 (shifting older backups
+        along and deleting the oldest) and opens a new one."""
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            # Another process may have rotated it while we waited
+            if os.stat(self.file_name).st_ino == \
+               os.fstat(self._file.fileno()).st_ino:
+                for n in range(self.backups - 1, 0, -1):
+                    backup = "{}.{}".format(self.file_name, n)
+                    if os.path.exists(backup):
+                        os.replace(
+                            backup, "{}.{}".format(self.file_name, n + 1)
+                        )
+                if self.backups > 0:
+                    os.replace(self.file_name, self.file_name + ".1")
+                else:
+                    os.remove(self.file_name)
+        finally:
+            self._file.close()    # Also releases the flock()
+            self._file = None
+        self._open_log()
+
+
+def format_record(record):
+    """Returns the message printed for record when there is no
+    log file."""
+    event = record["event"]
+    if event == EVENT_DROPPED:
+        return LOG_DROPPED_MESSAGE.format(record["count"])
+    elif "message" in record:
+        return record["message"]
+    elif record["path"] is None:
+        return REJECTED_CONNECTION_MESSAGE.format(record["client"])
+    name = os.path.basename(record["path"])
+    if event == EVENT_SENT:
+        return SENT_FILE_MESSAGE.format(name, record["bytes"])
+    elif event == EVENT_MISSING:
+        return COULDNT_SENT_FILE_MESSAGE.format(name, record["bytes"])
+    elif event == EVENT_OVERLOADED:
+        return OVERLOADED_MESSAGE.format(name)
+    elif event == EVENT_NOT_MODIFIED:
+        return NOT_MODIFIED_MESSAGE.format(name)
+    elif event == EVENT_LISTED:
+        return LISTED_MESSAGE.format(record["path"], record["bytes"])
+    return PASSED_FD_MESSAGE.format(name, record["bytes"])
@@ -0,0 +1,244 @@
+"""Socket tuning common to client.py and server.py, set per
+connection from what is measured of its path.
+
+A TransportPolicy says what to tune, and a ConnectionTuner made
+from it tunes one connected socket:
+
+  - Nagle: a response of at most nodelay_bytes is sent with
+    TCP_NODELAY, so its last partial segment isn't held back
+    waiting for an ACK that the client is itself delaying.
+    Bigger responses keep Nagle, which fills segments.  Clients
+    always send their (small) requests with TCP_NODELAY.
+  - Corking: the header and first block of a response are sent
+    under TCP_CORK (TCP_NOPUSH on BSD), so they leave in as few
+    full segments as they fit in, however send() splits them.  A
+    small response is corked whole, so a checksum trailer leaves
+    with the payload rather than in a segment of its own.
+  - Buffers: every MEASURE_INTERVAL (or four RTTs, if longer) the
+    bytes delivered are turned into a throughput, and with the RTT
+    from TCP_INFO into a bandwidth-delay product.  If the send
+    (server) or recieve (client) buffer is smaller than
+    BUFFER_HEADROOM times that, it is grown to it, within
+    min_buffer, max_buffer and the kernel's limit
+    (net.core.wmem_max / rmem_max on Linux).  Setting a buffer
+    turns off the kernel's autotuning of it for that socket, so
+    it is only set once the bandwidth-delay product has outgrown
+    what autotuning has reached, and from then on the tuner grows
+    it instead.  Buffers are never shrunk.  Where TCP_INFO isn't
+    available buffers aren't tuned.
+
+None of this applies to AF_UNIX sockets.  Every policy can be set
+on the command line of either side (see
+TransportPolicy.from_command_line()).
+"""
+
+import socket
+import struct
+import sys
+import time
+from common import get_option
+
+SMALL_RESPONSE = 64 * 1024    # Responses sent with TCP_NODELAY
+MIN_BUFFER = 64 * 1024        # Smallest buffer size set
+MAX_BUFFER = 16 * 1024**2     # Largest buffer size set
+BUFFER_HEADROOM = 2.0         # Buffer size over the bandwidth-delay product
+MEASURE_INTERVAL = 0.1        # Least seconds between throughput samples
+
+# struct tcp_info (linux/tcp.h) starts with 8 bytes of flags, then
+# u32 fields, of which tcpi_rtt (microseconds) is the 16th
+TCP_INFO_FORMAT = "8B16I"
+TCP_INFO_RTT = 8 + 15
+TCP_INFO = getattr(socket, "TCP_INFO", None)
+TCP_CORK = getattr(socket, "TCP_CORK", getattr(socket, "TCP_NOPUSH", None))
+
+# Linux reports twice the buffer size set (the rest is for its own
+# bookkeeping), and won't set more than these limits
+BUFFER_OVERHEAD = 2 if sys.platform.startswith("linux") else 1
+BUFFER_LIMIT_FILES = {
+    socket.SO_SNDBUF: "/proc/sys/net/core/wmem_max",
+    socket.SO_RCVBUF: "/proc/sys/net/core/rmem_max",
+}
+
+
+class TransportPolicy(object):
+    """What to tune on each connection.  nodelay_bytes of 0 never
+    sets TCP_NODELAY on responses."""
+    
+    def __init__(self, nodelay_bytes=SMALL_RESPONSE, cork=True,
+                 tune_buffers=True, min_buffer=MIN_BUFFER,
+                 max_buffer=MAX_BUFFER):
+        self.nodelay_bytes = nodelay_bytes
+        self.cork = cork and TCP_CORK is not None
+        self.tune_buffers = tune_buffers and TCP_INFO is not None
+        self.min_buffer = min_buffer
+        self.max_buffer = max_buffer
+        self.buffer_limits = {
+            option: read_buffer_limit(file_name)
+            for option, file_name in BUFFER_LIMIT_FILES.items()
+        }
+    
+    
+    @staticmethod
+    def from_command_line():
+        """Builds a TransportPolicy from the command line options
+        --nodelay-bytes N, --cork 0|1, --tune-buffers 0|1 and
+        --max-buffer N, falling back to the defaults."""
+        return TransportPolicy(
+            get_option("--nodelay-bytes", SMALL_RESPONSE, int),
+            bool(get_option("--cork", 1, int)),
+            bool(get_option("--tune-buffers", 1, int)),
+            MIN_BUFFER,
+            get_option("--max-buffer", MAX_BUFFER, int),
+        )
+    
+    
+    def tuner(self, sock, sending=True):
+        """Returns a ConnectionTuner for sock, tuning its send
+        buffer if sending, else its recieve buffer."""
+        return ConnectionTuner(sock, self, sending)
+    
+    
+    def configure_client(self, sock):
+        """Sets up a newly connected client socket, whose requests
+        should never wait on Nagle."""
+        if is_tcp(sock):
+            set_flag(sock, socket.TCP_NODELAY, True)
+
+
+class ConnectionTuner(object):
+    """Tunes one connected socket as its responses are sent or
+    recieved (see module docstring).  Not thread safe; each
+    connection has its own."""
+    
+    def __init__(self, sock, policy, sending=True):
+        self.sock = sock
+        self.policy = policy
+        self.buffer_option = socket.SO_SNDBUF if sending \
+            else socket.SO_RCVBUF
+        self.enabled = is_tcp(sock)
+        self.nodelay = False
+        self.corked = False
+        self.buffer_size = None
+        self._small = False
+        self._mark = None    # (time, bytes) of the last sample
+    
+    
+    def start_response(self, num_bytes):
+        """Call before sending a response of num_bytes (header
+        and all), or before recieving a payload of num_bytes."""
+        self._mark = None
+        if not self.enabled:
+            return
+        self._small = num_bytes <= self.policy.nodelay_bytes
+        if self._small != self.nodelay and \
+           set_flag(self.sock, socket.TCP_NODELAY, self._small):
+            self.nodelay = self._small
+        if self.policy.cork and not self.corked:
+            self.corked = set_flag(self.sock, TCP_CORK, True)
+    
+    
+    def block_done(self, num_bytes):
+        """Call after each block, with the bytes of the response
+        delivered (or recieved) so far.  Uncorks after the first
+        block of a big response, and resizes the buffer."""
+        if not self.enabled:
+            return
+        if self.corked and not self._small:
+            self.uncork()
+        if self.policy.tune_buffers:
+            self._measure(num_bytes)
+    
+    
+    def end_response(self):
+        """Call once the response has been sent (or has failed)."""
+        if self.enabled:
+            self.uncork()
+    
+    
+    def uncork(self):
+        """Sends anything held back by TCP_CORK."""
+        if self.corked:
+            set_flag(self.sock, TCP_CORK, False)
+            self.corked = False
+    
+    
+    def rtt(self):
+        """Returns the kernel's smoothed RTT of the connection in
+        seconds, or None if it can't be read."""
+        if TCP_INFO is None or not self.enabled:
+            return None
+        try:
+            info = self.sock.getsockopt(
+                socket.IPPROTO_TCP, TCP_INFO,
+                struct.calcsize(TCP_INFO_FORMAT)
+            )
+            rtt_us = struct.unpack_from(TCP_INFO_FORMAT, info)[TCP_INFO_RTT]
+        except (OSError, struct.error):
+            return None
+        return rtt_us / 1e6 if rtt_us else None
+    
+    
+    def _measure(self, num_bytes):
+        """Samples the throughput since the last sample, and grows
+        the buffer to BUFFER_HEADROOM bandwidth-delay products if
+        it is smaller, including what autotuning has grown it
+        to."""
+        now = time.monotonic()
+        if self._mark is None:
+            self._mark = (now, num_bytes)
+            return
+        
+        mark_time, mark_bytes = self._mark
+        if now - mark_time < MEASURE_INTERVAL:
+            return
+        rtt = self.rtt()
+        if rtt is None or now - mark_time < 4 * rtt:
+            return
+        self._mark = (now, num_bytes)
+        
+        throughput = (num_bytes - mark_bytes) / (now - mark_time)
+        target = int(min(
+            max(throughput * rtt * BUFFER_HEADROOM, self.policy.min_buffer),
+            self.policy.max_buffer
+        ))
+        limit = self.policy.buffer_limits.get(self.buffer_option)
+        if limit is not None:
+            target = min(target, limit)
+        try:
+            current = self.sock.getsockopt(
+                socket.SOL_SOCKET, self.buffer_option
+            )
+            # Setting it ends autotuning, so only if it is ahead
+            if target * BUFFER_OVERHEAD > current:
+                self.sock.setsockopt(
+                    socket.SOL_SOCKET, self.buffer_option, target
+                )
+                self.buffer_size = target
+        except OSError:
+            pass
+
+
+def is_tcp(sock):
+    """Returns True if sock is a TCP socket."""
+    return sock.family in (socket.AF_INET, socket.AF_INET6) and \
+        sock.type == socket.SOCK_STREAM
+
+
+def read_buffer_limit(file_name):
+    """Returns the largest buffer size the kernel lets a socket 
+    set, read from file_name, or None if it can't be read."""
+    try:
+        with open(file_name) as limit_file:
+            return int(limit_file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def set_flag(sock, option, value):
+    """Sets the IPPROTO_TCP option to value (True or False).
+    Returns False if it couldn't be set."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, int(value))
+        return True
+    except OSError:
+        return False